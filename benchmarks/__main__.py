@@ -0,0 +1,107 @@
+from pathlib import Path
+import tempfile
+import click
+from toolbox.server.prefork import DEFAULT_THREADS
+from .harnesses import FULL_SIZES, QUICK_SIZES, make_harness
+from .suite import compare_results, load_results, run_suite, save_results
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option(
+    "--quick",
+    is_flag=True,
+    default=False,
+    help="Use smaller listings and files, for checking that the benchmarks run",
+)
+@click.option(
+    "--harness-directory",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Where to generate the served files. Existing files are reused between runs. A temporary directory is used by default.",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    default=DEFAULT_THREADS,
+    show_default=True,
+    help="The number of threads serving requests",
+)
+@click.option(
+    "-s",
+    "--scenario",
+    "scenario_names",
+    multiple=True,
+    help="Only run the given scenario. Can be given multiple times.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    default=None,
+    help="Save the results as JSON, to compare against later runs",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Compare the results against previously saved results",
+)
+def run(quick, harness_directory, threads, scenario_names, output, baseline):
+    sizes = QUICK_SIZES if quick else FULL_SIZES
+    temporary_directory = None
+    if harness_directory is None:
+        temporary_directory = tempfile.TemporaryDirectory(prefix="toolbox-benchmarks-")
+        harness_directory = Path(temporary_directory.name)
+
+    try:
+        click.echo(f"Generating harness in {harness_directory}")
+        harness = make_harness(harness_directory, sizes)
+
+        def print_result(name, result):
+            latency = result["latency_ms"]
+            click.echo(
+                f"{name:<24} {result['requests_per_second']:>10} req/s"
+                f"  p50 {latency['p50']} ms  p99 {latency['p99']} ms"
+                f"  peak RSS {result['peak_rss_bytes'] / 1024 / 1024:.1f} MB"
+                f"  errors {result['errors']}"
+            )
+
+        try:
+            results = run_suite(
+                harness,
+                threads=threads,
+                scenario_names=list(scenario_names),
+                on_result=print_result,
+            )
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--scenario")
+    finally:
+        if temporary_directory is not None:
+            temporary_directory.cleanup()
+
+    if output is not None:
+        save_results(output, results)
+        click.echo(f"Saved results to {output}")
+    if baseline is not None:
+        click.echo(compare_results(load_results(baseline), results))
+
+
+@cli.command()
+@click.argument(
+    "baseline", type=click.Path(exists=True, dir_okay=False, path_type=Path)
+)
+@click.argument("results", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+def compare(baseline, results):
+    """
+    Compares saved results against a saved baseline
+    """
+    click.echo(compare_results(load_results(baseline), load_results(results)))
+
+
+if __name__ == "__main__":
+    cli()
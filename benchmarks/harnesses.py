@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+import json
+import os
+
+Bytes = int
+
+# Written once a harness has been fully generated, so that it can be reused by later
+# runs without being generated again
+COMPLETE_MARKER = ".complete"
+
+
+@dataclass
+class HarnessSizes:
+    listing_entries: List[int]
+    large_file_size: Bytes
+    mount_depth: int
+    mount_breadth: int
+
+
+FULL_SIZES = HarnessSizes(
+    listing_entries=[10_000, 100_000],
+    large_file_size=1024 * 1024 * 1024,
+    mount_depth=8,
+    mount_breadth=4,
+)
+
+QUICK_SIZES = HarnessSizes(
+    listing_entries=[1_000, 10_000],
+    large_file_size=64 * 1024 * 1024,
+    mount_depth=4,
+    mount_breadth=2,
+)
+
+
+@dataclass
+class Harness:
+    root_directory: Path
+    sizes: HarnessSizes
+
+    @property
+    def user_directory(self) -> Path:
+        return self.root_directory / "serve"
+
+    @property
+    def toolbox_directory(self) -> Path:
+        return self.root_directory / "toolbox"
+
+    @property
+    def config_path(self) -> Path:
+        return self.toolbox_directory / "config.json"
+
+    @property
+    def uploads_directory(self) -> Path:
+        return self.user_directory / "uploads"
+
+    def listing_server_path(self, entries: int) -> str:
+        return f"/listing_{entries}"
+
+    @property
+    def large_file_server_path(self) -> str:
+        return "/large.bin"
+
+    @property
+    def deepest_mount_server_path(self) -> str:
+        return "/" + "/".join(
+            f"mount_{depth}" for depth in range(self.sizes.mount_depth)
+        )
+
+
+def make_listing(directory: Path, entries: int):
+    """
+    Creates a directory of empty files and a few directories, which is as expensive
+    to list as a directory of real files
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    for index in range(entries):
+        if index % 100 == 0:
+            (directory / f"directory_{index:06}").mkdir(exist_ok=True)
+        else:
+            (directory / f"file_{index:06}.txt").touch()
+
+
+def make_large_file(path: Path, size: Bytes):
+    """
+    Creates a sparse file, so that large files take no time or disk space to create
+    """
+    with open(path, "wb") as file:
+        file.truncate(size)
+
+
+def make_mount_tree(toolbox_directory: Path, depth: int, breadth: int):
+    """
+    Creates a nested mount at every depth of a directory tree, alongside a number of
+    sibling mounts of files, and writes the server config which maps them
+    """
+    mounts = []
+    server_path = ""
+    local_path = Path("third_party")
+    for level in range(depth):
+        server_path = f"{server_path}/mount_{level}"
+        local_path = local_path / f"level_{level}"
+        (toolbox_directory / local_path).mkdir(parents=True, exist_ok=True)
+        mounts.append({"server_path": server_path, "local_path": str(local_path)})
+
+        for sibling in range(breadth):
+            sibling_path = local_path / f"tool_{sibling}.sh"
+            (toolbox_directory / sibling_path).write_text(f"echo tool {sibling}\n")
+            mounts.append(
+                {
+                    "server_path": f"{server_path}_tool_{sibling}.sh",
+                    "local_path": str(sibling_path),
+                }
+            )
+
+    toolbox_directory.mkdir(parents=True, exist_ok=True)
+    with open(toolbox_directory / "config.json", "w") as config_file:
+        json.dump({"server": mounts}, config_file, indent=4)
+
+
+def make_harness(root_directory: Path, sizes: HarnessSizes) -> Harness:
+    """
+    Generates the files served by the benchmarks. An existing harness for the same
+    sizes is reused.
+    """
+    harness = Harness(root_directory=Path(root_directory), sizes=sizes)
+    marker_path = harness.root_directory / COMPLETE_MARKER
+    if marker_path.exists() and json.loads(marker_path.read_text()) == sizes.__dict__:
+        return harness
+
+    harness.user_directory.mkdir(parents=True, exist_ok=True)
+    harness.uploads_directory.mkdir(exist_ok=True)
+    for entries in sizes.listing_entries:
+        make_listing(
+            harness.user_directory / harness.listing_server_path(entries).lstrip("/"),
+            entries,
+        )
+    make_large_file(
+        harness.user_directory / harness.large_file_server_path.lstrip("/"),
+        sizes.large_file_size,
+    )
+    make_mount_tree(harness.toolbox_directory, sizes.mount_depth, sizes.mount_breadth)
+
+    marker_path.write_text(json.dumps(sizes.__dict__))
+    return harness
+
+
+def clear_uploads(harness: Harness):
+    for entry in os.scandir(harness.uploads_directory):
+        os.unlink(entry.path)
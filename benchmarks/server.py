@@ -0,0 +1,111 @@
+from typing import Optional
+import multiprocessing
+import os
+import sys
+import threading
+from toolbox.server.make_app import get_upload_token_store, make_app
+from toolbox.server.memory import get_peak_rss
+from toolbox.server.prefork import DEFAULT_THREADS, ThreadPoolWSGIServer
+from toolbox.server.upload_tokens import UploadToken
+from .harnesses import Harness
+
+Bytes = int
+
+HOST = "127.0.0.1"
+PASSWORD = "benchmark"
+STARTUP_TIMEOUT = 60
+
+
+def get_upload_token_id(index: int) -> str:
+    return f"benchmark-upload-{index}"
+
+
+def run_server(harness: Harness, threads: int, upload_tokens: int, connection):
+    """
+    Serves the harness until the parent process asks it to stop, then reports the
+    peak memory used by this process
+    """
+    # The console access log would otherwise be interleaved with the results
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.dup2(devnull, sys.stderr.fileno())
+
+    app = make_app(
+        verbose=False,
+        host=HOST,
+        port=0,
+        password=PASSWORD,
+        root_toolbox_directory=harness.toolbox_directory,
+        root_user_directory=harness.user_directory,
+        config_path=harness.config_path,
+    )
+    upload_token_store = get_upload_token_store(app)
+    uploads_directory = harness.uploads_directory.relative_to(harness.user_directory)
+    for index in range(upload_tokens):
+        upload_token_store.add(
+            UploadToken(
+                id=get_upload_token_id(index),
+                file_name=str(uploads_directory / f"upload_{index}.bin"),
+            )
+        )
+
+    server = ThreadPoolWSGIServer(HOST, 0, app, threads=threads)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    connection.send(server.port)
+
+    connection.recv()
+    server.shutdown()
+    server_thread.join()
+    server.server_close()
+    connection.send(get_peak_rss())
+
+
+class BenchmarkServer:
+    """
+    Runs the toolbox server in a new process, so that the memory used by each
+    benchmark can be measured separately from the load generator and from each other
+    """
+
+    def __init__(
+        self, harness: Harness, threads: int = DEFAULT_THREADS, upload_tokens: int = 0
+    ):
+        self.harness = harness
+        self.threads = threads
+        self.upload_tokens = upload_tokens
+        self.port: Optional[int] = None
+        self._process = None
+        self._connection = None
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(
+            target=run_server,
+            args=(self.harness, self.threads, self.upload_tokens, child_connection),
+            daemon=True,
+        )
+        self._process.start()
+        if not self._connection.poll(STARTUP_TIMEOUT):
+            self._process.terminate()
+            raise RuntimeError("The benchmark server did not start")
+        self.port = self._connection.recv()
+
+    def stop(self) -> Bytes:
+        """
+        Stops the server, and returns its peak resident set size
+        """
+        self._connection.send(None)
+        peak_rss = self._connection.recv()
+        self._process.join()
+        self._process = None
+        return peak_rss
+
+    def __enter__(self) -> "BenchmarkServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
@@ -0,0 +1,241 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+import json
+import platform
+import random
+from toolbox.bench import BenchmarkRequest, LoadResult, make_upload_request, run_load
+from .harnesses import Harness, clear_uploads
+from .server import HOST, BenchmarkServer, get_upload_token_id
+
+Bytes = int
+
+RANGE_SIZE: Bytes = 1024 * 1024
+
+
+@dataclass
+class Scenario:
+    name: str
+    make_request: Callable[[int], BenchmarkRequest]
+    total_requests: int
+    concurrency: int
+    upload_tokens: int = 0
+
+
+def make_scenarios(harness: Harness) -> List[Scenario]:
+    sizes = harness.sizes
+    scenarios = []
+    for entries in sizes.listing_entries:
+        listing_path = harness.listing_server_path(entries)
+        scenarios.append(
+            Scenario(
+                name=f"listing_{entries}",
+                make_request=lambda _index, path=listing_path: BenchmarkRequest(
+                    "GET", f"{path}/"
+                ),
+                total_requests=200,
+                concurrency=8,
+            )
+        )
+        scenarios.append(
+            Scenario(
+                name=f"api_listing_{entries}",
+                make_request=lambda _index, path=listing_path: BenchmarkRequest(
+                    "GET", f"/api/files{path}?format=ndjson&limit=5000"
+                ),
+                total_requests=200,
+                concurrency=8,
+            )
+        )
+
+    large_file_path = harness.large_file_server_path
+    scenarios.append(
+        Scenario(
+            name="download_full",
+            make_request=lambda _index: BenchmarkRequest("GET", large_file_path),
+            total_requests=16,
+            concurrency=4,
+        )
+    )
+
+    def make_ranged_request(index: int) -> BenchmarkRequest:
+        # The same ranges are requested by every run
+        start = random.Random(index).randrange(
+            0, max(1, sizes.large_file_size - RANGE_SIZE)
+        )
+        return BenchmarkRequest(
+            "GET",
+            large_file_path,
+            headers={"Range": f"bytes={start}-{start + RANGE_SIZE - 1}"},
+            expected_statuses=(206,),
+        )
+
+    scenarios.append(
+        Scenario(
+            name="download_ranged",
+            make_request=make_ranged_request,
+            total_requests=2000,
+            concurrency=16,
+        )
+    )
+
+    upload_size = min(64 * 1024 * 1024, sizes.large_file_size)
+    scenarios.append(
+        Scenario(
+            name="upload_streamed",
+            make_request=lambda index: make_upload_request(
+                get_upload_token_id(index), upload_size
+            ),
+            total_requests=32,
+            concurrency=4,
+            upload_tokens=32,
+        )
+    )
+    scenarios.append(
+        Scenario(
+            name="shells",
+            make_request=lambda _index: BenchmarkRequest(
+                "GET", "/shells/shell.sh/10.10.10.10/4444"
+            ),
+            total_requests=5000,
+            concurrency=16,
+        )
+    )
+    deepest_mount_path = harness.deepest_mount_server_path
+    scenarios.append(
+        Scenario(
+            name="mount_tree",
+            make_request=lambda _index: BenchmarkRequest(
+                "GET", f"{deepest_mount_path}/"
+            ),
+            total_requests=2000,
+            concurrency=16,
+        )
+    )
+    return scenarios
+
+
+def as_milliseconds(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def as_scenario_result(load_result: LoadResult, peak_rss: Bytes) -> Dict:
+    latencies = sorted(load_result.latencies)
+    return {
+        "requests": load_result.requests,
+        "errors": load_result.errors,
+        "duration_seconds": round(load_result.duration, 3),
+        "requests_per_second": round(load_result.requests_per_second, 2),
+        "bytes_received_per_second": round(load_result.bytes_received_per_second),
+        "latency_ms": {
+            "p50": as_milliseconds(load_result.latency_percentile(50)),
+            "p99": as_milliseconds(load_result.latency_percentile(99)),
+            "max": as_milliseconds(latencies[-1] if latencies else None),
+        },
+        "peak_rss_bytes": peak_rss,
+    }
+
+
+def run_scenario(harness: Harness, scenario: Scenario, threads: int) -> Dict:
+    with BenchmarkServer(
+        harness, threads=threads, upload_tokens=scenario.upload_tokens
+    ) as server:
+        # Warm up caches, such as the directory listing cache, before measuring
+        run_load(
+            HOST,
+            server.port,
+            scenario.make_request,
+            total_requests=1 if scenario.upload_tokens == 0 else 0,
+            concurrency=1,
+        )
+        load_result = run_load(
+            HOST,
+            server.port,
+            scenario.make_request,
+            total_requests=scenario.total_requests,
+            concurrency=scenario.concurrency,
+        )
+        peak_rss = server.stop()
+    clear_uploads(harness)
+    return as_scenario_result(load_result, peak_rss)
+
+
+def run_suite(
+    harness: Harness,
+    threads: int,
+    scenario_names: Optional[List[str]] = None,
+    on_result: Optional[Callable[[str, Dict], None]] = None,
+) -> Dict:
+    scenarios = make_scenarios(harness)
+    if scenario_names:
+        unknown_names = set(scenario_names) - {scenario.name for scenario in scenarios}
+        if unknown_names:
+            raise ValueError(f"Unknown scenarios: {', '.join(sorted(unknown_names))}")
+        scenarios = [
+            scenario for scenario in scenarios if scenario.name in scenario_names
+        ]
+
+    results = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "threads": threads,
+        "sizes": harness.sizes.__dict__,
+        "scenarios": {},
+    }
+    for scenario in scenarios:
+        scenario_result = run_scenario(harness, scenario, threads)
+        results["scenarios"][scenario.name] = scenario_result
+        if on_result is not None:
+            on_result(scenario.name, scenario_result)
+    return results
+
+
+def format_change(baseline: Optional[float], value: Optional[float]) -> str:
+    if baseline is None or value is None:
+        return "-"
+    if baseline == 0:
+        return "0.0%" if value == 0 else "-"
+    return f"{(value - baseline) / baseline * 100:+.1f}%"
+
+
+COMPARED_VALUES = [
+    ("req/s", lambda result: result["requests_per_second"]),
+    ("p50 ms", lambda result: result["latency_ms"]["p50"]),
+    ("p99 ms", lambda result: result["latency_ms"]["p99"]),
+    ("peak RSS MB", lambda result: round(result["peak_rss_bytes"] / 1024 / 1024, 1)),
+]
+
+
+def compare_results(baseline: Dict, results: Dict) -> str:
+    """
+    Formats a table of each scenario's results against the baseline results
+    """
+    lines = [
+        f"{'scenario':<24}"
+        + "".join(f"{name:>28}" for name, _get_value in COMPARED_VALUES)
+    ]
+    for name, result in results["scenarios"].items():
+        baseline_result = baseline["scenarios"].get(name)
+        columns = []
+        for _value_name, get_value in COMPARED_VALUES:
+            value = get_value(result)
+            if baseline_result is None:
+                columns.append(f"{value}")
+                continue
+            baseline_value = get_value(baseline_result)
+            change = format_change(baseline_value, value)
+            columns.append(f"{baseline_value} -> {value} ({change})")
+        lines.append(f"{name:<24}" + "".join(f"{column:>28}" for column in columns))
+    return "\n".join(lines)
+
+
+def load_results(path) -> Dict:
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def save_results(path, results: Dict):
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=4)
+        results_file.write("\n")
@@ -3,8 +3,13 @@ from toolbox.server import make_app
 from pathlib import Path
 from flask import Flask
 from http import HTTPStatus
+import asyncio
 import secrets
+import threading
 from flask_wtf.csrf import CSRFError, CSRFProtect, generate_csrf
+from werkzeug.serving import make_server
+from toolbox.server.request_handler import ToolboxRequestHandler
+from toolbox.server.async_server import AsyncWSGIServer
 
 
 # Open the given response in a browser to inspect the rendered html
@@ -58,3 +63,31 @@ def req_ctx(app):
 @pytest.fixture
 def client(app):
     return app.test_client()
+
+
+# Serve the app over a real socket, for tests which rely on server behavior
+@pytest.fixture
+def live_server(app):
+    server = make_server(
+        "127.0.0.1", 0, app, threaded=True, request_handler=ToolboxRequestHandler
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+# Serve the app with the asyncio server, running its event loop in another thread
+@pytest.fixture
+def async_live_server(app):
+    server = AsyncWSGIServer(app, "127.0.0.1", 0, threads=4)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
@@ -0,0 +1,157 @@
+import pytest
+from http import HTTPStatus
+import io
+import json
+import threading
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import FileWrapper
+from toolbox.server.access_log import (
+    AccessLog,
+    AccessLogMiddleware,
+    AccessLogRecord,
+    AccessLogSink,
+    ConsoleSink,
+    JsonLinesSink,
+)
+
+
+class MemorySink(AccessLogSink):
+    def __init__(self):
+        self.records = []
+
+    def write(self, records):
+        self.records.extend(records)
+
+
+class BlockedSink(MemorySink):
+    def __init__(self):
+        super().__init__()
+        self.is_unblocked = threading.Event()
+
+    def write(self, records):
+        self.is_unblocked.wait(timeout=5)
+        super().write(records)
+
+
+def make_record(**kwargs):
+    return AccessLogRecord(
+        **{
+            "timestamp": 0,
+            "client_ip": "127.0.0.1",
+            "method": "GET",
+            "path": "/simple.txt",
+            "status": 200,
+            "bytes_sent": 15,
+            "duration": 0.0025,
+            "user_agent": "curl/8.0",
+            **kwargs,
+        }
+    )
+
+
+@pytest.fixture
+def memory_sink():
+    return MemorySink()
+
+
+@pytest.fixture
+def logged_client(app, memory_sink):
+    access_log = AccessLog([memory_sink])
+    app.wsgi_app = AccessLogMiddleware(app.wsgi_app, access_log)
+    client = app.test_client()
+    client.access_log = access_log
+    return client
+
+
+def test_requests_are_logged(logged_client, memory_sink):
+    response = logged_client.get(
+        "/simple.txt?raw=1", headers={"User-Agent": "curl/8.0"}
+    )
+    response.close()
+    logged_client.get("/missing.txt").close()
+    logged_client.access_log.join()
+
+    [found, missing] = memory_sink.records
+    assert found.client_ip == "127.0.0.1"
+    assert found.method == "GET"
+    assert found.path == "/simple.txt?raw=1"
+    assert found.status == HTTPStatus.OK
+    assert found.bytes_sent == len(response.data)
+    assert found.user_agent == "curl/8.0"
+    assert found.duration >= 0
+    assert missing.status == HTTPStatus.NOT_FOUND
+
+
+def test_streamed_responses_are_logged_once_sent(logged_client, memory_sink):
+    response = logged_client.get("/folder?archive=tar.gz", buffered=False)
+    assert response.is_streamed
+    data = b"".join(response.response)
+    logged_client.access_log.join()
+    assert memory_sink.records == []
+
+    response.close()
+    logged_client.access_log.join()
+    [record] = memory_sink.records
+    assert record.bytes_sent == len(data)
+
+
+def test_file_wrapper_responses_are_logged_once_sent(app, logged_client, memory_sink):
+    environ = EnvironBuilder(path="/simple.txt").get_environ()
+    environ["wsgi.file_wrapper"] = FileWrapper
+    app_iter = app(environ, lambda status, headers, exc_info=None: None)
+
+    # The server's own file wrapper is returned, so that it can send the file itself
+    assert isinstance(app_iter, FileWrapper)
+    data = b"".join(app_iter)
+    logged_client.access_log.join()
+    assert memory_sink.records == []
+
+    app_iter.close()
+    logged_client.access_log.join()
+    [record] = memory_sink.records
+    assert record.bytes_sent == len(data)
+
+
+def test_full_queues_drop_records_instead_of_blocking():
+    blocked_sink = BlockedSink()
+    access_log = AccessLog([blocked_sink], max_queue_size=2, batch_size=1)
+
+    for _ in range(10):
+        access_log.record(make_record())
+    assert access_log.dropped_count >= 7
+
+    blocked_sink.is_unblocked.set()
+    access_log.join()
+    assert len(blocked_sink.records) == 10 - access_log.dropped_count
+
+
+def test_json_lines_sink(tmp_path):
+    path = tmp_path / "access.jsonl"
+    path.write_text('{"existing": true}\n')
+    sink = JsonLinesSink(path)
+    sink.write([make_record(), make_record(status=404)])
+    sink.close()
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert lines[0] == {"existing": True}
+    assert lines[1] == {
+        "time": "1970-01-01T00:00:00.000+00:00",
+        "client_ip": "127.0.0.1",
+        "method": "GET",
+        "path": "/simple.txt",
+        "status": 200,
+        "bytes_sent": 15,
+        "duration_ms": 2.5,
+        "user_agent": "curl/8.0",
+    }
+    assert lines[2]["status"] == 404
+
+
+def test_console_sink():
+    stream = io.StringIO()
+    sink = ConsoleSink(stream)
+    sink.write([make_record(status=404, bytes_sent=0)])
+
+    line = stream.getvalue()
+    assert line.startswith("127.0.0.1 - - [")
+    assert line.endswith('] "GET /simple.txt" 404 - 2.5ms "curl/8.0"\n')
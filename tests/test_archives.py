@@ -0,0 +1,141 @@
+import pytest
+from http import HTTPStatus
+import io
+import json
+import os
+import tarfile
+import tracemalloc
+import zipfile
+from toolbox.server import archives
+
+
+def read_tar_gz(data):
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar_file:
+        return {
+            member.name: (
+                tar_file.extractfile(member).read() if member.isfile() else None
+            )
+            for member in tar_file.getmembers()
+        }
+
+
+def read_zip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+        assert zip_file.testzip() is None
+        return {
+            info.filename.rstrip("/"): (
+                None if info.is_dir() else zip_file.read(info.filename)
+            )
+            for info in zip_file.infolist()
+        }
+
+
+READERS = {"tar.gz": read_tar_gz, "zip": read_zip}
+
+
+@pytest.fixture
+def loot_directory(app, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    loot_directory = tmp_path / "loot"
+    (loot_directory / "nested" / "empty").mkdir(parents=True)
+    (loot_directory / "creds.txt").write_text("password=hunter2\n")
+    (loot_directory / "nested" / "data.bin").write_bytes(os.urandom(200_000))
+    (loot_directory / "nested" / "loop").symlink_to(loot_directory)
+    (tmp_path / "outside.txt").write_text("outside\n")
+    return loot_directory
+
+
+@pytest.mark.parametrize("archive_format", ["tar.gz", "zip"])
+def test_archive_user_folders(client, loot_directory, archive_format):
+    response = client.get(f"/loot?archive={archive_format}")
+    assert response.status_code == HTTPStatus.OK
+    assert response.is_streamed
+    assert response.mimetype == archives.ARCHIVE_FORMATS[archive_format]
+    assert (
+        response.headers["Content-Disposition"]
+        == f"attachment; filename=loot.{archive_format}"
+    )
+
+    assert READERS[archive_format](response.data) == {
+        "loot": None,
+        "loot/creds.txt": b"password=hunter2\n",
+        "loot/nested": None,
+        "loot/nested/data.bin": (loot_directory / "nested" / "data.bin").read_bytes(),
+        "loot/nested/empty": None,
+    }
+
+
+@pytest.mark.parametrize("archive_format", ["tar.gz", "zip"])
+def test_archive_toolbox_folders(client, archive_format):
+    response = client.get(f"/my_custom_namespace/linux?archive={archive_format}")
+    assert response.status_code == HTTPStatus.OK
+    assert READERS[archive_format](response.data) == {
+        "linux": None,
+        "linux/enum.sh": b"enum.sh content\n",
+    }
+
+
+@pytest.mark.parametrize("archive_format", ["tar.gz", "zip"])
+def test_archives_do_not_follow_symlinks_outside_of_the_directory(
+    app, client, tmp_path, archive_format
+):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    (tmp_path / "loot").mkdir()
+    (tmp_path / "loot" / "passwd").symlink_to("/etc/passwd")
+
+    response = client.get(f"/loot?archive={archive_format}")
+    assert READERS[archive_format](response.data) == {"loot": None}
+
+
+@pytest.mark.parametrize("archive_format", ["tar.gz", "zip"])
+def test_toolbox_archives_do_not_follow_symlinks_outside_of_mounts(
+    app, client, tmp_path, archive_format
+):
+    (tmp_path / "tools").mkdir()
+    (tmp_path / "tools" / "tool.sh").write_text("tool.sh content\n")
+    (tmp_path / "tools" / "secret.txt").symlink_to(tmp_path / "secret.txt")
+    (tmp_path / "secret.txt").write_text("not mounted\n")
+    config = {"server": [{"server_path": "/tools", "local_path": "tools"}]}
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(config))
+    app.config["ROOT_TOOLBOX_DIRECTORY"] = tmp_path
+    app.config["CONFIG_PATH"] = config_path
+
+    response = client.get(f"/tools?archive={archive_format}")
+    assert READERS[archive_format](response.data) == {
+        "tools": None,
+        "tools/tool.sh": b"tool.sh content\n",
+    }
+
+
+def test_archive_invalid_format(client):
+    response = client.get("/folder?archive=rar")
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_zip_archives_store_compressed_files(client, loot_directory):
+    (loot_directory / "tools.zip").write_bytes(b"a" * 1000)
+    (loot_directory / "notes.txt").write_bytes(b"a" * 1000)
+
+    response = client.get("/loot?archive=zip")
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zip_file:
+        assert zip_file.getinfo("loot/tools.zip").compress_type == zipfile.ZIP_STORED
+        assert zip_file.getinfo("loot/notes.txt").compress_type == zipfile.ZIP_DEFLATED
+
+
+@pytest.mark.parametrize("archive_format", ["tar.gz", "zip"])
+def test_archives_use_bounded_memory(client, loot_directory, archive_format):
+    with open(loot_directory / "large.bin", "wb") as large_file:
+        large_file.truncate(20 * 1024 * 1024)
+
+    response = client.get(f"/loot?archive={archive_format}")
+    tracemalloc.start()
+    try:
+        size = sum(len(chunk) for chunk in response.response)
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        response.close()
+
+    assert size > 0
+    assert peak < 2 * 1024 * 1024
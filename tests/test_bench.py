@@ -0,0 +1,134 @@
+import pytest
+from toolbox import bench
+from toolbox.bench import (
+    LoadResult,
+    RequestMix,
+    format_report,
+    get_percentile,
+    make_upload_request,
+    parse_mix,
+    run_load,
+)
+
+
+@pytest.mark.parametrize(
+    "percentile,expected", [(0, 1), (50, 5), (90, 9), (99, 10), (100, 10)]
+)
+def test_get_percentile(percentile, expected):
+    assert get_percentile(list(range(1, 11)), percentile) == expected
+
+
+def test_get_percentile_without_values():
+    assert get_percentile([], 50) is None
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("listing=2,file=6", {"listing": 2, "file": 6}),
+        ("payload", {"payload": 1}),
+        (" file=1 , upload=0", {"file": 1}),
+    ],
+)
+def test_parse_mix(value, expected):
+    assert parse_mix(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value,message",
+    [
+        ("shells=1", "Unknown request kind 'shells'"),
+        ("file=many", "Invalid weight 'many' for file"),
+        ("file=-1", "Invalid weight '-1' for file"),
+        ("file=0", "At least one kind of request must be given a weight"),
+    ],
+)
+def test_parse_mix_invalid(value, message):
+    with pytest.raises(ValueError, match=message):
+        parse_mix(value)
+
+
+def test_upload_request_content_length():
+    request = make_upload_request("token-1", size=2500, chunk_size=1024)
+    body = b"".join(request.body())
+    assert len(body) == int(request.headers["Content-Length"])
+    assert b"token-1" in body
+    assert request.kind == "upload"
+
+
+def test_request_mix():
+    mix = RequestMix(
+        {"listing": 1, "file": 1, "upload": 1, "payload": 1},
+        listing_path="/loot/",
+        file_paths=["/a.txt", "/b.txt"],
+        create_upload_token=lambda index: f"token-{index}",
+    )
+    requests = [mix(index) for index in range(200)]
+
+    assert {request.kind for request in requests} == set(bench.REQUEST_KINDS)
+    assert {request.path for request in requests if request.kind == "file"} == {
+        "/a.txt",
+        "/b.txt",
+    }
+    assert {request.path for request in requests if request.kind == "listing"} == {
+        "/loot/"
+    }
+    # The same requests are made by every run
+    assert [mix(index).path for index in range(200)] == [
+        request.path for request in requests
+    ]
+
+
+def test_run_load(live_server):
+    file_paths = bench.discover_files("127.0.0.1", live_server.port, "/")
+    assert "/simple.txt" in file_paths
+
+    mix = RequestMix(
+        {"listing": 1, "file": 1, "payload": 1}, listing_path="/", file_paths=file_paths
+    )
+    result = run_load(
+        "127.0.0.1", live_server.port, mix, concurrency=4, total_requests=60
+    )
+    assert result.requests == 60
+    assert result.errors == 0
+    assert result.bytes_received > 0
+    assert set(result.latencies_by_kind) == {"listing", "file", "payload"}
+
+
+def test_run_load_counts_errors(live_server):
+    result = run_load(
+        "127.0.0.1",
+        live_server.port,
+        lambda _index: bench.BenchmarkRequest("GET", "/missing", kind="file"),
+        concurrency=2,
+        total_requests=4,
+    )
+    assert result.errors_by_kind == {"file": 4}
+    assert result.error_messages == {"file": "GET /missing responded with 404"}
+
+
+def test_format_report():
+    result = LoadResult(
+        latencies_by_kind={"file": [0.001, 0.002, 0.003], "listing": [0.010]},
+        errors_by_kind={"file": 1},
+        error_messages={"file": "GET /missing responded with 404"},
+        bytes_received=2 * 1024 * 1024,
+        duration=2.0,
+    )
+    report = format_report(result, concurrency=4)
+    lines = report.splitlines()
+    assert lines[0].split()[:4] == ["kind", "requests", "errors", "req/s"]
+    assert lines[1].split() == [
+        "listing",
+        "1",
+        "0",
+        "0.5",
+        "10.0",
+        "10.0",
+        "10.0",
+        "10.0",
+    ]
+    assert lines[2].split() == ["file", "4", "1", "1.5", "2.0", "3.0", "3.0", "3.0"]
+    assert lines[3].split() == ["total", "5", "1", "2.0", "2.0", "10.0", "10.0", "10.0"]
+    assert "5 requests from 4 clients in 2.0s, 2.0 req/s, 1.0 MB/s received" in report
+    assert "First file error: GET /missing responded with 404" in report
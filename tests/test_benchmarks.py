@@ -0,0 +1,44 @@
+from benchmarks.harnesses import HarnessSizes, make_harness
+from benchmarks.suite import compare_results
+from toolbox.server.file_manager import FileManager
+from toolbox.server.file_server import ServerConfig
+
+TINY_SIZES = HarnessSizes(
+    listing_entries=[10], large_file_size=1024, mount_depth=3, mount_breadth=2
+)
+
+
+def test_make_harness(tmp_path):
+    harness = make_harness(tmp_path, TINY_SIZES)
+    assert len(list((harness.user_directory / "listing_10").iterdir())) == 10
+    assert (harness.user_directory / "large.bin").stat().st_size == 1024
+
+    server_config = ServerConfig(
+        root_toolbox_directory=harness.toolbox_directory,
+        config_path=harness.config_path,
+        file_manager=FileManager(
+            root_user_directory=harness.user_directory,
+            root_toolbox_directory=harness.toolbox_directory,
+        ),
+    )
+    mount, remaining = server_config.find_mount(harness.deepest_mount_server_path)
+    assert mount.server_path == "/mount_0/mount_1/mount_2"
+    assert remaining == []
+    assert len(server_config.mounts) == 3 * (1 + 2)
+
+
+def test_compare_results():
+    def make_results(requests_per_second):
+        return {
+            "scenarios": {
+                "shells": {
+                    "requests_per_second": requests_per_second,
+                    "latency_ms": {"p50": 2.0, "p99": 4.0},
+                    "peak_rss_bytes": 50 * 1024 * 1024,
+                }
+            }
+        }
+
+    comparison = compare_results(make_results(100), make_results(150))
+    assert "100 -> 150 (+50.0%)" in comparison
+    assert "50.0 -> 50.0 (+0.0%)" in comparison
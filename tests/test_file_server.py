@@ -4,7 +4,20 @@ from pathlib import Path
 from flask import Flask
 from http import HTTPStatus
 import secrets
+import http.client
 from bs4 import BeautifulSoup
+from toolbox.server.request_handler import ToolboxRequestHandler
+from toolbox.server.file_manager import FileManager, InvalidFilePath, VerifiedPath
+from toolbox.server import file_server, make_app
+from toolbox.server.file_server import (
+    PathTrie,
+    ServerConfig,
+    ToolboxFileIndex,
+    paginate,
+)
+import json
+import os
+import time
 
 
 def assert_response_has_link(response, **options):
@@ -65,6 +78,153 @@ def test_reading_user_files(client, path, expected_data):
     assert response.data == expected_data
 
 
+def test_reading_user_files_are_streamed(client):
+    response = client.get("/simple.txt")
+    assert response.status_code == HTTPStatus.OK
+    assert response.is_streamed
+    assert response.content_length == len(b"simple.txt content\n")
+    assert response.data == b"simple.txt content\n"
+    response.close()
+
+
+@pytest.mark.parametrize(
+    "range_header,expected_data,expected_content_range",
+    [
+        ("bytes=0-5", b"simple", "bytes 0-5/19"),
+        ("bytes=7-", b"txt content\n", "bytes 7-18/19"),
+        ("bytes=-8", b"content\n", "bytes 11-18/19"),
+        ("bytes=11-100", b"content\n", "bytes 11-18/19"),
+    ],
+)
+def test_reading_user_files_with_range(
+    client, range_header, expected_data, expected_content_range
+):
+    response = client.get("/simple.txt", headers={"Range": range_header})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.data == expected_data
+    assert response.headers["Content-Range"] == expected_content_range
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.content_length == len(expected_data)
+
+
+def test_reading_toolbox_files_with_multiple_ranges(client):
+    response = client.get("/enum_linux.sh", headers={"Range": "bytes=0-3,8-14"})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.mimetype == "multipart/byteranges"
+    assert response.content_length == len(response.data)
+
+    boundary = response.mimetype_params["boundary"]
+    parts = response.data.split(f"--{boundary}".encode("ascii"))
+    assert parts[0] == b""
+    assert b"Content-Range: bytes 0-3/16\r\n\r\nenum\r\n" in parts[1]
+    assert b"Content-Range: bytes 8-14/16\r\n\r\ncontent\r\n" in parts[2]
+    assert parts[3] == b"--\r\n"
+
+
+def test_reading_user_files_with_unsatisfiable_range(client):
+    response = client.get("/simple.txt", headers={"Range": "bytes=100-"})
+    assert response.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert response.headers["Content-Range"] == "bytes */19"
+
+
+@pytest.mark.parametrize(
+    "range_header",
+    ["bytes=5-1", "lines=0-5", "bytes=0-1,0-1"],
+)
+def test_reading_user_files_with_invalid_range(client, range_header):
+    response = client.get("/simple.txt", headers={"Range": range_header})
+    assert response.status_code == HTTPStatus.OK
+    assert response.data == b"simple.txt content\n"
+
+
+def test_reading_user_files_with_if_range(client):
+    last_modified = client.get("/simple.txt").headers["Last-Modified"]
+
+    response = client.get(
+        "/simple.txt", headers={"Range": "bytes=0-5", "If-Range": last_modified}
+    )
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.data == b"simple"
+
+    response = client.get(
+        "/simple.txt",
+        headers={"Range": "bytes=0-5", "If-Range": "Wed, 21 Oct 2015 07:28:00 GMT"},
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert response.data == b"simple.txt content\n"
+
+
+def test_reading_user_files_with_if_range_etag(client):
+    etag = client.get("/simple.txt").headers["ETag"]
+
+    response = client.get(
+        "/simple.txt", headers={"Range": "bytes=0-5", "If-Range": etag}
+    )
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.data == b"simple"
+
+    response = client.get(
+        "/simple.txt", headers={"Range": "bytes=0-5", "If-Range": f"W/{etag}"}
+    )
+    assert response.status_code == HTTPStatus.OK
+
+
+@pytest.mark.parametrize("path", ["/simple.txt", "/enum_linux.sh"])
+def test_reading_files_not_modified(mocker, client, path):
+    response = client.get(path)
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    open_spy = mocker.spy(VerifiedPath, "open")
+    for headers in [{"If-None-Match": etag}, {"If-Modified-Since": last_modified}]:
+        response = client.get(path, headers=headers)
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+        assert response.data == b""
+        assert response.headers["ETag"] == etag
+
+    assert open_spy.call_count == 0
+
+
+def test_reading_files_modified(client):
+    response = client.get("/simple.txt", headers={"If-None-Match": '"stale"'})
+    assert response.status_code == HTTPStatus.OK
+    assert response.data == b"simple.txt content\n"
+
+
+@pytest.mark.parametrize("path", ["/", "/folder", "/my_custom_namespace/linux"])
+def test_viewing_folders_is_always_rendered(app, client, path):
+    response = client.get(path)
+    response.close()
+    assert "ETag" not in response.headers
+
+    etag = file_server.as_directory_etag(os.stat(app.config["ROOT_USER_DIRECTORY"]))
+    response = client.get(path, headers={"If-None-Match": f'W/"{etag}"'})
+    response.close()
+    assert response.status_code == HTTPStatus.OK
+
+
+@pytest.mark.parametrize(
+    "headers,expected_status,expected_data",
+    [
+        ({}, HTTPStatus.OK, b"nested_child.txt content\n"),
+        ({"Range": "bytes=7-11"}, HTTPStatus.PARTIAL_CONTENT, b"child"),
+    ],
+)
+def test_reading_user_files_with_sendfile(
+    mocker, live_server, headers, expected_status, expected_data
+):
+    sendfile_spy = mocker.spy(ToolboxRequestHandler, "sendfile")
+    connection = http.client.HTTPConnection("127.0.0.1", live_server.port)
+    connection.request("GET", "/folder/nested_folder/nested_child.txt", headers=headers)
+    response = connection.getresponse()
+
+    assert response.status == expected_status
+    assert response.read() == expected_data
+    assert sendfile_spy.call_count == 1
+    connection.close()
+
+
 @pytest.mark.parametrize(
     "path,expected_links",
     [
@@ -179,6 +339,8 @@ def test_requesting_missing_files(client, path):
         "/my_custom_namespace/../../../../../../../../../../../../../../../../../../etc",
         "/my_custom_namespace/../arbitrary_file_read_test.txt",
         "/my_custom_namespace/../../arbitrary_file_read_test.txt",
+        "/my_custom_namespace/..",
+        "/my_custom_namespace/../",
     ],
 )
 def test_security_against_arbitrary_file_read(client, path):
@@ -264,3 +426,278 @@ def test_debug(client, path):
     response = client.get(path)
     assert response.status_code == HTTPStatus.OK
     assert response.data == b""
+
+
+def test_verified_paths(tmp_path):
+    file_manager = FileManager(
+        root_user_directory=tmp_path / "user",
+        root_toolbox_directory=tmp_path / "toolbox",
+    )
+    (tmp_path / "user").mkdir()
+    (tmp_path / "user" / "file.txt").write_text("file.txt content")
+    (tmp_path / "secret.txt").write_text("secret")
+
+    verified_path = file_manager.verify_user_path(tmp_path / "user" / "file.txt")
+    assert verified_path.is_file
+    with verified_path.open("rb") as file:
+        assert file.read() == b"file.txt content"
+
+    for path in ["missing.txt", "../secret.txt", "../toolbox"]:
+        with pytest.raises(InvalidFilePath):
+            file_manager.verify_user_path(tmp_path / "user" / path)
+
+
+def test_verified_paths_are_not_opened_if_replaced(tmp_path):
+    file_manager = FileManager(
+        root_user_directory=tmp_path, root_toolbox_directory=tmp_path
+    )
+    (tmp_path / "file.txt").write_text("file.txt content")
+    (tmp_path / "secret.txt").write_text("secret")
+    verified_path = file_manager.verify_user_path(tmp_path / "file.txt")
+
+    os.replace(tmp_path / "secret.txt", tmp_path / "file.txt")
+    with pytest.raises(InvalidFilePath):
+        verified_path.open("rb")
+
+
+def test_server_config_is_parsed_once(mocker, client):
+    parse_config_spy = mocker.spy(ServerConfig, "_parse_config")
+    for path in ["/", "/folder", "/enum_linux.sh", "/my_custom_namespace/linux"]:
+        assert client.get(path).status_code == HTTPStatus.OK
+
+    assert parse_config_spy.call_count == 1
+
+
+def test_server_config_is_parsed_when_changed(app, client, tmp_path):
+    def write_config(server_paths, modified_at):
+        config = {
+            "server": [
+                {"server_path": server_path, "local_path": "tool.sh"}
+                for server_path in server_paths
+            ]
+        }
+        config_path.write_text(json.dumps(config))
+        os.utime(config_path, ns=(modified_at, modified_at))
+
+    (tmp_path / "tool.sh").write_text("tool.sh content\n")
+    config_path = tmp_path / "config.json"
+    app.config["ROOT_TOOLBOX_DIRECTORY"] = tmp_path
+    app.config["CONFIG_PATH"] = config_path
+
+    write_config(["/tool.sh"], modified_at=1_000_000_000)
+    assert client.get("/tool.sh").data == b"tool.sh content\n"
+
+    write_config(["/renamed_tool.sh"], modified_at=2_000_000_000)
+    assert client.get("/tool.sh").status_code == HTTPStatus.NOT_FOUND
+    assert client.get("/renamed_tool.sh").data == b"tool.sh content\n"
+
+    # Invalid configuration changes are ignored
+    write_config(["/duplicate.sh", "/duplicate.sh"], modified_at=3_000_000_000)
+    assert client.get("/renamed_tool.sh").data == b"tool.sh content\n"
+
+
+def test_nested_toolbox_mounts(app, client, tmp_path):
+    (tmp_path / "binaries" / "windows").mkdir(parents=True)
+    (tmp_path / "binaries" / "windows" / "tool.exe").write_text("windows tool")
+    (tmp_path / "linux").mkdir()
+    (tmp_path / "linux" / "tool.sh").write_text("linux tool")
+    config = {
+        "server": [
+            {"server_path": "/binaries", "local_path": "binaries"},
+            {"server_path": "/binaries/linux", "local_path": "linux"},
+        ]
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(config))
+    app.config["ROOT_TOOLBOX_DIRECTORY"] = tmp_path
+    app.config["CONFIG_PATH"] = config_path
+
+    assert client.get("/binaries/windows/tool.exe").data == b"windows tool"
+    assert client.get("/binaries/linux/tool.sh").data == b"linux tool"
+    assert client.get("/binaries/linux/../binaries/windows/tool.exe").data == (
+        b"windows tool"
+    )
+    assert_response_has_link(
+        client.get("/binaries/linux"),
+        href="/binaries/linux/tool.sh",
+        string="tool.sh",
+    )
+    assert client.get("/binaries/linux/../config.json").status_code == (
+        HTTPStatus.NOT_FOUND
+    )
+
+
+def test_path_trie_longest_prefix():
+    path_trie = PathTrie()
+    path_trie.insert(["static"], "static")
+    path_trie.insert(["static", "linux"], "linux")
+
+    assert path_trie.longest_prefix(["static", "windows", "tool.exe"]) == (
+        "static",
+        1,
+    )
+    assert path_trie.longest_prefix(["static", "linux", "tool.sh"]) == ("linux", 2)
+    assert path_trie.longest_prefix(["stat"]) is None
+    assert path_trie.longest_prefix([]) is None
+
+
+def test_directory_listings_are_cached_until_modified(mocker, app, client, tmp_path):
+    def set_modified_at(path, modified_at):
+        os.utime(path, ns=(modified_at, modified_at))
+
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    (tmp_path / "first.txt").write_text("first")
+    set_modified_at(tmp_path, 1_000_000_000)
+    list_directory_spy = mocker.spy(file_server, "list_directory")
+
+    for _ in range(3):
+        response = client.get("/")
+        assert b'<a href="/first.txt">first.txt</a>' in response.data
+    assert list_directory_spy.call_count == 1
+
+    (tmp_path / "second.txt").write_text("second")
+    set_modified_at(tmp_path, 2_000_000_000)
+    response = client.get("/")
+    assert b'<a href="/second.txt">second.txt</a>' in response.data
+    assert list_directory_spy.call_count == 2
+
+
+def test_recently_modified_directory_listings_are_not_cached(
+    mocker, app, client, tmp_path
+):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    list_directory_spy = mocker.spy(file_server, "list_directory")
+
+    client.get("/")
+    client.get("/")
+    assert list_directory_spy.call_count == 2
+
+
+def test_directory_listings_with_broken_symlinks(app, client, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    (tmp_path / "broken_link").symlink_to(tmp_path / "missing")
+
+    response = client.get("/")
+    assert response.status_code == HTTPStatus.OK
+    assert b'<a href="/broken_link">broken_link</a>' in response.data
+
+
+def test_directory_listings_skip_removed_entries(mocker, app, client, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    (tmp_path / "kept.txt").write_text("kept")
+    (tmp_path / "removed.txt").write_text("removed")
+    as_server_directory_item_from_entry = (
+        file_server.as_server_directory_item_from_entry
+    )
+
+    def remove_file_before_stat(server_path, entry):
+        # Simulates a file being removed while the directory is being listed
+        if entry.name == "removed.txt":
+            os.remove(entry.path)
+        return as_server_directory_item_from_entry(server_path, entry)
+
+    mocker.patch.object(
+        file_server,
+        "as_server_directory_item_from_entry",
+        side_effect=remove_file_before_stat,
+    )
+
+    response = client.get("/")
+    assert response.status_code == HTTPStatus.OK
+    assert b'<a href="/kept.txt">kept.txt</a>' in response.data
+    assert b"removed.txt" not in response.data
+
+
+def test_upload_files_are_not_served(app, client, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    (tmp_path / "file.txt").write_text("file.txt content")
+    (tmp_path / ".upload-abc123").write_text("incomplete upload")
+
+    response = client.get("/")
+    assert b"file.txt" in response.data
+    assert b".upload-" not in response.data
+    assert client.get("/.upload-abc123").status_code == HTTPStatus.NOT_FOUND
+
+
+def test_toolbox_files_are_indexed_once(mocker, client):
+    client.get("/")
+    as_server_directory_item_spy = mocker.spy(file_server, "as_server_directory_item")
+
+    response = client.get("/")
+    assert_response_has_link(response, href="/enum_linux.sh", string="enum_linux.sh")
+    assert as_server_directory_item_spy.call_count == 0
+
+
+def test_toolbox_file_index_refresh(tmp_path):
+    tool_path = tmp_path / "tool.sh"
+    tool_path.write_text("tool")
+    toolbox_file_index = ToolboxFileIndex(
+        {"/tool.sh": tool_path}, refresh_interval=3600
+    )
+    assert [file.size for file in toolbox_file_index.files] == [4]
+
+    tool_path.write_text("updated tool")
+    toolbox_file_index.refresh()
+    assert [file.size for file in toolbox_file_index.files] == [12]
+
+    tool_path.unlink()
+    toolbox_file_index.refresh()
+    assert toolbox_file_index.files == []
+
+
+def test_toolbox_file_index_refreshes_in_background_when_stale(tmp_path):
+    tool_path = tmp_path / "tool.sh"
+    tool_path.write_text("tool")
+    toolbox_file_index = ToolboxFileIndex({"/tool.sh": tool_path}, refresh_interval=0)
+    tool_path.write_text("updated tool")
+
+    deadline = time.monotonic() + 5
+    while toolbox_file_index.files[0].size != 12:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_viewing_folders_in_pages(app, client, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    for index in range(25):
+        (tmp_path / f"file{index:02}.txt").write_text("content")
+
+    response = client.get("/?offset=10&limit=10")
+    assert response.status_code == HTTPStatus.OK
+    parsed = BeautifulSoup(response.data, features="html.parser")
+    names = [link.string for link in parsed.find_all("a", href=True) if link.string]
+    assert [name for name in names if name.startswith("file")] == [
+        f"file{index:02}.txt" for index in range(10, 20)
+    ]
+    assert parsed.find("td").string == "11"
+    assert_response_has_link(response, href="?offset=0&limit=10", string="Previous")
+    assert_response_has_link(response, href="?offset=20&limit=10", string="Next")
+    assert b"11-20 of 25" in response.data
+
+
+def test_viewing_folders_are_streamed(mocker, app, client, tmp_path):
+    mocker.patch.object(make_app, "DEFAULT_PAGE_SIZE", 2)
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        (tmp_path / name).write_text("content")
+
+    response = client.get("/")
+    assert response.is_streamed
+    assert b'<a href="/b.txt">b.txt</a>' in response.data
+    assert b'<a href="/c.txt">c.txt</a>' not in response.data
+    assert_response_has_link(response, href="?offset=2&limit=2", string="Next")
+
+
+def test_paginate():
+    files = list(range(5))
+    page = paginate(files, offset=0, limit=2)
+    assert (page.files, page.previous_offset, page.next_offset) == ([0, 1], None, 2)
+
+    page = paginate(files, offset=3, limit=2)
+    assert (page.files, page.previous_offset, page.next_offset) == ([3, 4], 1, None)
+    assert page.is_partial
+
+    # Out of range values are clamped
+    page = paginate(files, offset=100, limit=-1)
+    assert (page.files, page.offset, page.limit) == ([4], 4, 1)
+    assert not paginate([], offset=-5, limit=10).is_partial
@@ -1,5 +1,5 @@
 import pytest
-from toolbox.server.formatters import pretty_date
+from toolbox.server.formatters import pretty_date, pretty_size
 from datetime import datetime, timedelta
 
 NOW = datetime(2019, 4, 13)
@@ -22,3 +22,19 @@ NOW = datetime(2019, 4, 13)
 )
 def test_upload_token_creation_missing_csrf_token(date, expected):
     assert pretty_date(date, now=NOW) == expected
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    [
+        (0, "0 B"),
+        (1023, "1023 B"),
+        (1024, "1.0 KiB"),
+        (1536, "1.5 KiB"),
+        (-2048, "-2.0 KiB"),
+        (5 * 1024**2, "5.0 MiB"),
+        (3 * 1024**4, "3072.0 GiB"),
+    ],
+)
+def test_pretty_size(size, expected):
+    assert pretty_size(size) == expected
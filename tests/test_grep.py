@@ -0,0 +1,116 @@
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+import json
+import os
+from toolbox.server import grep
+from toolbox.server.grep import ContentSearcher, grep_file
+
+
+@pytest.fixture
+def content_searcher(tmp_path):
+    content_searcher = ContentSearcher(tmp_path, workers=2)
+    yield content_searcher
+    content_searcher.close()
+
+
+def search(content_searcher, pattern, **kwargs):
+    return sorted(
+        (match.path, match.line_number, match.line)
+        for match in content_searcher.search(pattern, **kwargs)
+    )
+
+
+def test_grep_file(tmp_path):
+    path = tmp_path / "loot.txt"
+    path.write_bytes(b"first line\npassword=secret password\n\nPASSWORD=other\n")
+
+    assert grep_file(str(path), b"password", 0, max_matches=10) == [
+        (2, "password=secret password")
+    ]
+    assert grep_file(str(path), rb"(?i)^password", 8, max_matches=10) == [
+        (2, "password=secret password"),
+        (4, "PASSWORD=other"),
+    ]
+    assert grep_file(str(path), rb"(?i)password", 0, max_matches=1) == [
+        (2, "password=secret password")
+    ]
+    assert grep_file(str(path), b"missing", 0, max_matches=10) == []
+
+
+def test_grep_file_long_lines(mocker, tmp_path):
+    mocker.patch.object(grep, "NEWLINE_CHUNK_SIZE", 4)
+    path = tmp_path / "loot.bin"
+    path.write_bytes(b"\n" * 10 + b"\x00" * 1000 + b"secret" + b"\xff" * 1000)
+
+    [(line_number, line)] = grep_file(str(path), b"secret", 0, max_matches=10)
+    assert line_number == 11
+    assert "secret" in line
+    assert len(line) == grep.MAX_LINE_LENGTH
+
+
+def test_grep_missing_and_empty_files(tmp_path):
+    (tmp_path / "empty.txt").write_bytes(b"")
+    assert grep_file(str(tmp_path / "empty.txt"), b"", 0, max_matches=10) == []
+    assert grep_file(str(tmp_path / "missing.txt"), b"", 0, max_matches=10) == []
+
+
+def test_content_searcher(tmp_path, content_searcher):
+    (tmp_path / "creds.txt").write_text("user=admin\npassword=hunter2\n")
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "nested" / "notes.md").write_text("Password: reused\n")
+    (tmp_path / ".upload-partial").write_text("password=incomplete\n")
+    (tmp_path / "link.txt").symlink_to(tmp_path / "creds.txt")
+
+    assert search(content_searcher, "password", ignore_case=True) == [
+        ("creds.txt", 2, "password=hunter2"),
+        ("nested/notes.md", 1, "Password: reused"),
+    ]
+    assert (
+        len(search(content_searcher, "password", ignore_case=True, max_results=1)) == 1
+    )
+
+
+def test_content_searcher_invalid_pattern(content_searcher):
+    with pytest.raises(grep.re.error):
+        content_searcher.search("(")
+
+
+def test_content_searcher_skips_unchanged_files(mocker, tmp_path, content_searcher):
+    for name in ["first.txt", "second.txt", "third.txt"]:
+        (tmp_path / name).write_text(f"{name} secret\n")
+    submit_spy = mocker.spy(ProcessPoolExecutor, "submit")
+
+    assert len(search(content_searcher, "secret")) == 3
+    assert submit_spy.call_count == 3
+
+    assert len(search(content_searcher, "secret")) == 3
+    assert submit_spy.call_count == 3
+
+    (tmp_path / "second.txt").write_text("second.txt updated secret\n")
+    os.utime(tmp_path / "second.txt", ns=(1_000_000_000, 1_000_000_000))
+    (tmp_path / "third.txt").unlink()
+    assert search(content_searcher, "secret") == [
+        ("first.txt", 1, "first.txt secret"),
+        ("second.txt", 1, "second.txt updated secret"),
+    ]
+    assert submit_spy.call_count == 4
+
+
+def test_grep_endpoint(app, client, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    (tmp_path / "creds.txt").write_text("user=admin\npassword=hunter2\n")
+
+    response = client.get("/grep?q=PASSWORD&ignore_case=1")
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == "application/x-ndjson"
+    assert response.is_streamed
+    assert [json.loads(line) for line in response.data.splitlines()] == [
+        {"path": "/creds.txt", "line_number": 2, "line": "password=hunter2"}
+    ]
+
+
+@pytest.mark.parametrize("path", ["/grep", "/grep?q=", "/grep?q=("])
+def test_grep_endpoint_invalid_queries(client, path):
+    response = client.get(path)
+    assert response.status_code == HTTPStatus.BAD_REQUEST
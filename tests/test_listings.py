@@ -0,0 +1,132 @@
+import pytest
+from http import HTTPStatus
+import json
+from toolbox.server.listings import InvalidCursor, decode_cursor
+
+
+def list_names(response):
+    return [file["name"] for file in response.json["files"]]
+
+
+def test_listing_root_files(client):
+    response = client.get("/api/files/")
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == "application/json"
+    assert "Set-Cookie" not in response.headers
+    assert response.json["path"] == "/"
+    assert response.json["next_cursor"] is None
+    assert list_names(response) == [
+        "folder",
+        "my_custom_namespace",
+        "enum_linux.sh",
+        "enum_windows.exe",
+        "simple.txt",
+    ]
+
+    simple_file = response.json["files"][-1]
+    assert simple_file["path"] == "/simple.txt"
+    assert simple_file["kind"] == "file"
+    assert simple_file["size"] == 19
+    assert simple_file["modified_at"].endswith("+00:00")
+
+
+def test_listing_toolbox_folders(client):
+    response = client.get("/api/files/my_custom_namespace")
+    assert response.status_code == HTTPStatus.OK
+    assert response.json["files"][0] == {
+        **response.json["files"][0],
+        "name": "linux",
+        "path": "/my_custom_namespace/linux",
+        "kind": "directory",
+    }
+
+
+@pytest.mark.parametrize(
+    "query,expected_names",
+    [
+        ("type=directory", ["folder", "my_custom_namespace"]),
+        ("type=file&ext=exe", ["enum_windows.exe"]),
+        ("ext=.SH,txt", ["enum_linux.sh", "simple.txt"]),
+        ("ext=sh&ext=exe", ["enum_linux.sh", "enum_windows.exe"]),
+    ],
+)
+def test_listing_files_with_filters(client, query, expected_names):
+    response = client.get(f"/api/files/?{query}")
+    assert response.status_code == HTTPStatus.OK
+    assert list_names(response) == expected_names
+
+
+def test_listing_files_with_cursor(app, client, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    for index in range(5):
+        (tmp_path / f"file{index}.txt").write_text("content")
+
+    names = []
+    cursor = ""
+    for _ in range(3):
+        response = client.get(f"/api/files/?limit=2&type=file{cursor}")
+        assert response.status_code == HTTPStatus.OK
+        names += list_names(response)
+        next_cursor = response.json["next_cursor"]
+        assert response.headers.get("Toolbox-Next-Cursor") == next_cursor
+        cursor = f"&cursor={next_cursor}"
+
+        # Files added before the cursor do not shift the following pages
+        (tmp_path / "a_new_file.txt").write_text("content")
+
+    assert names == [
+        "enum_linux.sh",
+        "enum_windows.exe",
+        "file0.txt",
+        "file1.txt",
+        "file2.txt",
+        "file3.txt",
+    ]
+
+
+def test_listing_files_as_ndjson(client):
+    response = client.get("/api/files/?format=ndjson&type=file")
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == "application/x-ndjson"
+    assert response.is_streamed
+    lines = response.data.decode("utf-8").splitlines()
+    assert [json.loads(line)["name"] for line in lines] == [
+        "enum_linux.sh",
+        "enum_windows.exe",
+        "simple.txt",
+    ]
+
+    response = client.get("/api/files/?format=ndjson&type=file&limit=1")
+    assert len(response.data.splitlines()) == 1
+    cursor = response.headers["Toolbox-Next-Cursor"]
+    response = client.get(f"/api/files/?format=ndjson&type=file&cursor={cursor}")
+    assert len(response.data.splitlines()) == 2
+
+
+def test_listing_files_not_modified(client):
+    etag = client.get("/api/files/folder").headers["ETag"]
+    response = client.get("/api/files/folder", headers={"If-None-Match": etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+
+@pytest.mark.parametrize(
+    "path,expected_status",
+    [
+        ("/api/files/missing", HTTPStatus.NOT_FOUND),
+        ("/api/files/simple.txt", HTTPStatus.BAD_REQUEST),
+        ("/api/files/?format=xml", HTTPStatus.BAD_REQUEST),
+        ("/api/files/?type=symlink", HTTPStatus.BAD_REQUEST),
+        ("/api/files/?cursor=invalid", HTTPStatus.BAD_REQUEST),
+        ("/api/files/../..", HTTPStatus.NOT_FOUND),
+    ],
+)
+def test_listing_files_errors(client, path, expected_status):
+    response = client.get(path)
+    assert response.status_code == expected_status
+    assert "error" in response.json
+
+
+@pytest.mark.parametrize("cursor", ["", "e30", "WzEsIDIsIDNd", "!!!"])
+def test_decode_invalid_cursors(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
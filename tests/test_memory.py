@@ -0,0 +1,60 @@
+import pytest
+from http import HTTPStatus
+import tracemalloc
+from toolbox.server.memory import MemoryDiagnostics
+
+
+@pytest.fixture
+def memory_diagnostics():
+    memory_diagnostics = MemoryDiagnostics()
+    memory_diagnostics.start()
+    yield memory_diagnostics
+    tracemalloc.stop()
+
+
+@pytest.fixture
+def memory_client(app, memory_diagnostics):
+    app.extensions["toolbox_memory_diagnostics"] = memory_diagnostics
+    return app.test_client()
+
+
+def test_memory_report(memory_diagnostics):
+    first_report = memory_diagnostics.report()
+    assert first_report.changes is None
+    assert first_report.current <= first_report.peak
+
+    allocated = [bytearray(1024) for _ in range(1024)]
+    report = memory_diagnostics.report(limit=5)
+    assert len(report.top_statistics) <= 5
+    [allocation] = [
+        change for change in report.changes if change.traceback[0].filename == __file__
+    ]
+    assert allocation.size_diff >= 1024 * 1024
+    assert allocation.count_diff >= 1024
+    assert report.seconds_since_previous >= 0
+    del allocated
+
+
+def test_memory_report_by_filename(memory_diagnostics):
+    report = memory_diagnostics.report(group_by="filename")
+    assert f"{report.top_statistics[0].traceback[0].filename}\n" in report.as_text()
+
+
+def test_memory_endpoint(memory_client):
+    response = memory_client.get("/memory")
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert text.startswith("Traced memory: current ")
+    assert "Top 20 allocations by lineno:" in text
+    assert "No previous snapshot to compare against" in text
+
+    response = memory_client.get("/memory?limit=3")
+    text = response.get_data(as_text=True)
+    assert "Top 3 allocations by lineno:" in text
+    assert "changes since the previous snapshot" in text
+
+
+def test_memory_endpoint_without_memory_diagnostics(client):
+    response = client.get("/memory")
+    assert response.status_code == HTTPStatus.NOT_FOUND
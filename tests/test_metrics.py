@@ -0,0 +1,203 @@
+import pytest
+from http import HTTPStatus
+import os
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import FileWrapper
+from toolbox.server.make_app import get_metrics
+from toolbox.server.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsRegistry,
+    SharedMetricValues,
+)
+
+
+def test_render_metrics():
+    registry = MetricsRegistry()
+    requests = registry.register(
+        Counter("requests_total", "Requests handled", ["route"])
+    )
+    in_progress = registry.register(Gauge("in_progress", "Requests in progress"))
+    requests.inc(route="index")
+    requests.inc(2, route='say "hi"\n')
+    in_progress.inc()
+    in_progress.dec()
+
+    assert registry.render() == (
+        "# HELP requests_total Requests handled\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{route="index"} 1\n'
+        'requests_total{route="say \\"hi\\"\\n"} 2\n'
+        "# HELP in_progress Requests in progress\n"
+        "# TYPE in_progress gauge\n"
+        "in_progress 0\n"
+    )
+
+
+def test_render_histogram():
+    registry = MetricsRegistry()
+    duration = registry.register(
+        Histogram("duration_seconds", "Durations", ["route"], buckets=[0.1, 1])
+    )
+    for value in [0.05, 0.1, 0.5, 3]:
+        duration.observe(value, route="index")
+
+    assert registry.render() == (
+        "# HELP duration_seconds Durations\n"
+        "# TYPE duration_seconds histogram\n"
+        'duration_seconds_bucket{route="index",le="0.1"} 2\n'
+        'duration_seconds_bucket{route="index",le="1"} 3\n'
+        'duration_seconds_bucket{route="index",le="+Inf"} 4\n'
+        'duration_seconds_sum{route="index"} 3.65\n'
+        'duration_seconds_count{route="index"} 4\n'
+    )
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_shared_metrics_are_added_across_processes(tmp_path):
+    registry = MetricsRegistry(SharedMetricValues(tmp_path))
+    requests = registry.register(
+        Counter("requests_total", "Requests handled", ["route"])
+    )
+    in_progress = registry.register(Gauge("in_progress", "Requests in progress"))
+    duration = registry.register(
+        Histogram("duration_seconds", "Durations", buckets=[1])
+    )
+    requests.inc(route="index")
+
+    exited_pid = os.fork()
+    if exited_pid == 0:
+        try:
+            requests.inc(2, route="index")
+            in_progress.inc()
+            duration.observe(0.5)
+        finally:
+            os._exit(0)
+    os.waitpid(exited_pid, 0)
+
+    ready_read, ready_write = os.pipe()
+    stop_read, stop_write = os.pipe()
+    running_pid = os.fork()
+    if running_pid == 0:
+        try:
+            requests.inc(route="index")
+            in_progress.inc()
+            duration.observe(2)
+            os.write(ready_write, b"1")
+            os.read(stop_read, 1)
+        finally:
+            os._exit(0)
+
+    try:
+        os.read(ready_read, 1)
+        assert requests.get(route="index") == 4
+        # Gauges only include the processes which are still running
+        assert in_progress.get() == 1
+        assert registry.render() == (
+            "# HELP requests_total Requests handled\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{route="index"} 4\n'
+            "# HELP in_progress Requests in progress\n"
+            "# TYPE in_progress gauge\n"
+            "in_progress 1\n"
+            "# HELP duration_seconds Durations\n"
+            "# TYPE duration_seconds histogram\n"
+            'duration_seconds_bucket{le="1"} 1\n'
+            'duration_seconds_bucket{le="+Inf"} 2\n'
+            "duration_seconds_sum 2.5\n"
+            "duration_seconds_count 2\n"
+        )
+    finally:
+        os.write(stop_write, b"1")
+        os.waitpid(running_pid, 0)
+        for fd in [ready_read, ready_write, stop_read, stop_write]:
+            os.close(fd)
+
+
+def test_shared_metrics_files_grow(tmp_path):
+    registry = MetricsRegistry(SharedMetricValues(tmp_path))
+    requests = registry.register(
+        Counter("requests_total", "Requests handled", ["route"])
+    )
+    routes = [f"route_{index}" for index in range(5000)]
+    for route in routes:
+        requests.inc(route=route)
+    requests.inc(route=routes[0])
+    assert requests.get(route=routes[0]) == 2
+    assert requests.get(route=routes[-1]) == 1
+
+    # A file left with the same pid is added to
+    registry = MetricsRegistry(SharedMetricValues(tmp_path))
+    requests = registry.register(
+        Counter("requests_total", "Requests handled", ["route"])
+    )
+    requests.inc(route=routes[0])
+    requests.inc(route="new")
+    assert requests.get(route=routes[0]) == 3
+    assert requests.get(route="new") == 1
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_metrics_validate_labels():
+    counter = Counter("requests_total", "Requests handled", ["route"])
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(-1, route="index")
+
+
+def test_request_metrics(app, client):
+    metrics = get_metrics(app)
+    client.get("/simple.txt").close()
+    client.get("/missing.txt").close()
+    client.get("/debug/namespace?value=dGVzdA==").close()
+
+    assert metrics.requests.get(route="index", method="GET", status="200") == 1
+    assert metrics.requests.get(route="index", method="GET", status="404") == 1
+    assert metrics.requests.get(route="debug", method="GET", status="200") == 1
+    assert metrics.request_duration.get_count(route="index") == 2
+    assert metrics.served.get(result="file") == 1
+    assert metrics.served.get(result="not_found") == 1
+
+
+def test_file_transfer_metrics(app, client):
+    metrics = get_metrics(app)
+    response = client.get("/simple.txt")
+    assert metrics.active_file_transfers.get() == 1
+    response.close()
+
+    assert metrics.active_file_transfers.get() == 0
+    assert metrics.file_transfers.get() == 1
+    assert metrics.file_bytes_sent.get() == len(response.data)
+
+
+def test_file_wrapper_metrics(app):
+    metrics = get_metrics(app)
+    environ = EnvironBuilder(path="/simple.txt").get_environ()
+    environ["wsgi.file_wrapper"] = FileWrapper
+    app_iter = app(environ, lambda status, headers, exc_info=None: None)
+
+    # The server's own file wrapper is returned, so that it can send the file itself
+    assert isinstance(app_iter, FileWrapper)
+    assert metrics.active_file_transfers.get() == 1
+    assert metrics.file_bytes_sent.get() == 0
+    data = b"".join(app_iter)
+    app_iter.close()
+
+    assert metrics.active_file_transfers.get() == 0
+    assert metrics.file_bytes_sent.get() == len(data)
+    assert metrics.request_duration.get_count(route="index") == 1
+
+
+def test_metrics_endpoint(client):
+    client.get("/simple.txt").close()
+
+    response = client.get("/metrics")
+    assert response.status_code == HTTPStatus.OK
+    assert response.content_type == "text/plain; version=0.0.4; charset=utf-8"
+    assert (
+        'toolbox_http_requests_total{route="index",method="GET",status="200"} 1'
+        in response.text
+    )
+    assert "toolbox_file_bytes_sent_total" in response.text
@@ -0,0 +1,100 @@
+import pytest
+from http import HTTPStatus
+import pstats
+import re
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import FileWrapper
+from toolbox.server.profiling import ProfilingMiddleware, RequestProfiler
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    return RequestProfiler(tmp_path / "profiles", sample_rate=1.0)
+
+
+@pytest.fixture
+def profiled_client(app, profiler):
+    app.extensions["toolbox_profiler"] = profiler
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, profiler)
+    return app.test_client()
+
+
+def test_requests_are_profiled(profiled_client, profiler):
+    profiled_client.get("/simple.txt").close()
+    profiled_client.get("/missing.txt").close()
+
+    [found, missing] = sorted(
+        profiler.output_directory.iterdir(), key=lambda path: path.name[-7:]
+    )
+    assert re.search(r"-index-\d+ms-\d+-1\.prof$", found.name)
+    assert re.search(r"-index-\d+ms-\d+-2\.prof$", missing.name)
+    stats = pstats.Stats(str(found))
+    assert any(function == "make_file_response" for _, _, function in stats.stats)
+    assert profiler.profiled_count == 2
+
+
+def test_streamed_responses_are_profiled_once_sent(profiled_client, profiler):
+    response = profiled_client.get("/folder?archive=tar.gz", buffered=False)
+    b"".join(response.response)
+    assert profiler.profiled_count == 0
+
+    response.close()
+    [profile_path] = profiler.output_directory.iterdir()
+    stats = pstats.Stats(str(profile_path))
+    # The archive is written while the body is sent
+    assert any(function == "iter_tar" for _, _, function in stats.stats)
+
+
+def test_file_wrapper_responses_are_profiled_once_sent(app, profiled_client, profiler):
+    environ = EnvironBuilder(path="/simple.txt").get_environ()
+    environ["wsgi.file_wrapper"] = FileWrapper
+    app_iter = app(environ, lambda status, headers, exc_info=None: None)
+
+    # The server's own file wrapper is returned, so that it can send the file itself
+    assert isinstance(app_iter, FileWrapper)
+    b"".join(app_iter)
+    assert profiler.profiled_count == 0
+
+    app_iter.close()
+    assert profiler.profiled_count == 1
+
+
+@pytest.mark.parametrize(
+    "path,expected", [("/api/files/", True), ("/simple.txt", False)]
+)
+def test_requests_matching_the_path_pattern_are_profiled(tmp_path, path, expected):
+    profiler = RequestProfiler(tmp_path, path_pattern=re.compile("^/api/"))
+    assert profiler.sample_rate == 1.0
+    assert profiler.should_profile(path) == expected
+
+
+def test_requests_are_sampled(mocker, tmp_path):
+    profiler = RequestProfiler(tmp_path, sample_rate=0.25)
+    mocker.patch("random.random", side_effect=[0.1, 0.5])
+    assert profiler.should_profile("/simple.txt")
+    assert not profiler.should_profile("/simple.txt")
+
+
+def test_one_request_is_profiled_at_a_time(tmp_path):
+    profiler = RequestProfiler(tmp_path, sample_rate=1.0)
+    assert profiler.try_start()
+    assert not profiler.try_start()
+    assert profiler.skipped_count == 1
+
+
+def test_profile_summary(profiled_client, profiler):
+    for _ in range(3):
+        profiled_client.get("/simple.txt").close()
+
+    response = profiled_client.get("/profiles?sort=tottime&limit=5")
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == "text/plain"
+    summary = response.get_data(as_text=True)
+    assert summary.startswith("3 request(s) profiled, 0 skipped")
+    assert "Ordered by: internal time" in summary
+    assert "List reduced from" in summary
+
+
+def test_profile_summary_without_profiling(client):
+    response = client.get("/profiles")
+    assert response.status_code == HTTPStatus.NOT_FOUND
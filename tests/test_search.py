@@ -0,0 +1,157 @@
+import pytest
+from http import HTTPStatus
+import os
+from toolbox.server.make_app import get_search_index
+from toolbox.server.search import SearchIndex, as_query_trigrams
+
+
+@pytest.fixture
+def search_client(app, client):
+    assert get_search_index(app).is_ready.wait(timeout=5)
+    return client
+
+
+def search_paths(response):
+    return [file["path"] for file in response.json["files"]]
+
+
+@pytest.mark.parametrize(
+    "query,expected_paths",
+    [
+        (
+            "enum",
+            [
+                "/enum_linux.sh",
+                "/enum_windows.exe",
+                "/my_custom_namespace/linux/enum.sh",
+                "/my_custom_namespace/windows/enum.exe",
+            ],
+        ),
+        ("SIMPLE", ["/simple.txt"]),
+        ("*.exe", ["/enum_windows.exe", "/my_custom_namespace/windows/enum.exe"]),
+        ("enum_*", ["/enum_linux.sh", "/enum_windows.exe"]),
+        ("ol", ["/folder", "/folder/nested_folder"]),
+        (
+            "namespace/lin",
+            ["/my_custom_namespace/linux", "/my_custom_namespace/linux/enum.sh"],
+        ),
+        ("/my_custom_namespace/*/*.sh", ["/my_custom_namespace/linux/enum.sh"]),
+        ("missing", []),
+    ],
+)
+def test_search(search_client, query, expected_paths):
+    response = search_client.get("/search", query_string={"q": query})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json["is_complete"]
+    assert search_paths(response) == expected_paths
+
+
+def test_search_results(search_client):
+    response = search_client.get("/search?q=linux&limit=1")
+    assert response.json["files"] == [
+        {"name": "enum_linux.sh", "path": "/enum_linux.sh", "kind": "file"}
+    ]
+    assert response.json["is_truncated"]
+
+
+def test_search_without_query(client):
+    response = client.get("/search?q=")
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_search_index_is_replaced_when_roots_change(app, tmp_path):
+    search_index = get_search_index(app)
+    assert get_search_index(app) is search_index
+
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    assert get_search_index(app) is not search_index
+
+
+def test_search_index_refreshes_changed_directories(tmp_path):
+    def set_modified_at(path, modified_at):
+        os.utime(path, ns=(modified_at, modified_at))
+
+    (tmp_path / "tools").mkdir()
+    (tmp_path / "tools" / "first_tool.sh").write_text("first")
+    search_index = SearchIndex((("", tmp_path),))
+    search_index.build()
+    assert [entry.server_path for entry in search_index.search("tool").entries] == [
+        "/tools",
+        "/tools/first_tool.sh",
+    ]
+
+    (tmp_path / "tools" / "second_tool.sh").write_text("second")
+    (tmp_path / "tools" / "nested").mkdir()
+    (tmp_path / "tools" / "nested" / "nested_tool.sh").write_text("nested")
+    set_modified_at(tmp_path / "tools", 1_000_000_000)
+    search_index.refresh()
+    assert [
+        entry.server_path for entry in search_index.search("*_tool.sh").entries
+    ] == [
+        "/tools/first_tool.sh",
+        "/tools/nested/nested_tool.sh",
+        "/tools/second_tool.sh",
+    ]
+
+    (tmp_path / "tools" / "nested" / "nested_tool.sh").unlink()
+    (tmp_path / "tools" / "nested").rmdir()
+    set_modified_at(tmp_path / "tools", 2_000_000_000)
+    search_index.refresh()
+    assert [entry.server_path for entry in search_index.search("tool").entries] == [
+        "/tools",
+        "/tools/first_tool.sh",
+        "/tools/second_tool.sh",
+    ]
+    assert search_index.search("nested").entries == []
+
+
+def test_search_index_refreshes_entries_which_change_kind(tmp_path):
+    (tmp_path / "tools").write_text("tools")
+    search_index = SearchIndex((("", tmp_path),))
+    search_index.build()
+    [entry] = search_index.search("tools").entries
+    assert not entry.is_dir
+
+    (tmp_path / "tools").unlink()
+    (tmp_path / "tools").mkdir()
+    (tmp_path / "tools" / "nested_tool.sh").write_text("nested")
+    os.utime(tmp_path, ns=(1_000_000_000, 1_000_000_000))
+    search_index.refresh()
+    assert [
+        (entry.server_path, entry.is_dir)
+        for entry in search_index.search("tool").entries
+    ] == [("/tools", True), ("/tools/nested_tool.sh", False)]
+
+
+def test_search_index_nested_mounts(tmp_path):
+    (tmp_path / "static" / "linux").mkdir(parents=True)
+    (tmp_path / "static" / "linux" / "shadowed_tool.sh").write_text("shadowed")
+    (tmp_path / "linux").mkdir()
+    (tmp_path / "linux" / "linux_tool.sh").write_text("linux")
+    search_index = SearchIndex(
+        (
+            ("/static", tmp_path / "static"),
+            ("/static/linux", tmp_path / "linux"),
+        )
+    )
+    search_index.build()
+
+    # Nested mounts are served, and indexed, from the more specific mount only
+    assert [entry.server_path for entry in search_index.search("linux").entries] == [
+        "/static/linux",
+        "/static/linux/linux_tool.sh",
+    ]
+    assert search_index.search("shadowed").entries == []
+
+
+@pytest.mark.parametrize(
+    "query,expected_trigrams",
+    [
+        ("enum", {"enu", "num"}),
+        ("*.exe", {".ex", "exe"}),
+        ("a*bcd?e[fgh]", {"bcd"}),
+        ("ab", set()),
+    ],
+)
+def test_as_query_trigrams(query, expected_trigrams):
+    assert as_query_trigrams(query) == expected_trigrams
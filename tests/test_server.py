@@ -0,0 +1,290 @@
+import pytest
+from http import HTTPStatus
+import asyncio
+import http.client
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import flask
+from flask import Flask
+from toolbox.server.make_app import csrf
+from toolbox.server.prefork import ThreadPoolWSGIServer
+from toolbox.server.async_server import AsyncWSGIServer
+
+PREFORK_SERVER_SCRIPT = """
+import os
+import sys
+import time
+import flask
+from flask import Flask
+from toolbox.server.make_app import csrf
+from toolbox.server.prefork import ThreadPoolWSGIServer, serve_prefork
+
+app = Flask(__name__)
+
+@app.route("/pid")
+def pid():
+    return str(os.getpid())
+
+@app.route("/slow")
+def slow():
+    time.sleep(1)
+    return "slow"
+
+server = ThreadPoolWSGIServer("127.0.0.1", 0, app, threads=2, multiprocess=True)
+print(server.port, flush=True)
+serve_prefork(server, workers=2)
+"""
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def test_thread_pool_server():
+    app = Flask(__name__)
+
+    @app.route("/")
+    def index():
+        return threading.current_thread().name
+
+    server = ThreadPoolWSGIServer("127.0.0.1", 0, app, threads=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        for _ in range(4):
+            status, data = get(server.port, "/")
+            assert status == HTTPStatus.OK
+            assert data.startswith(b"toolbox-worker")
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_prefork_server_stops_gracefully_on_sigterm():
+    process = subprocess.Popen(
+        [sys.executable, "-c", PREFORK_SERVER_SCRIPT], stdout=subprocess.PIPE
+    )
+    try:
+        port = int(process.stdout.readline())
+
+        worker_pids = set()
+        for _ in range(20):
+            status, data = get(port, "/pid")
+            assert status == HTTPStatus.OK
+            worker_pids.add(int(data))
+        assert process.pid not in worker_pids
+
+        # In-flight requests are completed before the workers exit
+        slow_response = {}
+
+        def request_slow():
+            slow_response["value"] = get(port, "/slow")
+
+        slow_request = threading.Thread(target=request_slow)
+        slow_request.start()
+        time.sleep(0.2)
+        process.send_signal(signal.SIGTERM)
+        slow_request.join()
+
+        assert slow_response["value"] == (HTTPStatus.OK, b"slow")
+        assert process.wait(timeout=10) == 0
+    finally:
+        process.kill()
+        process.stdout.close()
+
+
+def request(server, method, path, body=None, headers={}, **kwargs):
+    connection = http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+    try:
+        connection.request(method, path, body=body, headers=headers, **kwargs)
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        connection.close()
+
+
+def test_async_server_reading_files(mocker, async_live_server):
+    sendfile_spy = mocker.spy(asyncio.BaseEventLoop, "sendfile")
+
+    status, headers, data = request(async_live_server, "GET", "/simple.txt")
+    assert status == HTTPStatus.OK
+    assert headers["Content-Length"] == "19"
+    assert data == b"simple.txt content\n"
+    assert sendfile_spy.call_count == 1
+
+    status, headers, data = request(
+        async_live_server, "GET", "/enum_linux.sh", headers={"Range": "bytes=0-3"}
+    )
+    assert status == HTTPStatus.PARTIAL_CONTENT
+    assert data == b"enum"
+
+
+def test_async_server_head_requests(async_live_server):
+    status, headers, data = request(async_live_server, "HEAD", "/simple.txt")
+    assert status == HTTPStatus.OK
+    assert headers["Content-Length"] == "19"
+    assert data == b""
+
+
+def test_async_server_viewing_folders(async_live_server):
+    status, _headers, data = request(async_live_server, "GET", "/my_custom_namespace")
+    assert status == HTTPStatus.OK
+    assert b'href="/my_custom_namespace/linux"' in data
+
+    status, _headers, _data = request(async_live_server, "GET", "/missing.sh")
+    assert status == HTTPStatus.NOT_FOUND
+
+
+def test_async_server_keep_alive(async_live_server):
+    connection = http.client.HTTPConnection(
+        "127.0.0.1", async_live_server.port, timeout=10
+    )
+    try:
+        for path in ["/simple.txt", "/", "/simple.txt"]:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            assert response.status == HTTPStatus.OK
+            response.read()
+            assert not response.will_close
+    finally:
+        connection.close()
+
+
+def test_async_server_chunked_request_bodies(app, client, async_live_server, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    csrf_token = client.get("/csrf_token").data.decode("utf-8")
+    response = client.post(
+        "/tokens",
+        data=dict(csrf_token=csrf_token, file_name="uploaded.txt"),
+        follow_redirects=True,
+    )
+    token_id = re.search(r'token_id=(\w+)" http', response.data.decode("utf-8"))[1]
+
+    status, headers, data = request(
+        async_live_server,
+        "PATCH",
+        f"/uploads/{token_id}",
+        body=iter([b"first chunk\n", b"second chunk\n"]),
+        headers={"Upload-Offset": "0"},
+        encode_chunked=True,
+    )
+    assert status == HTTPStatus.OK
+    assert data == b'{ "offset": 25 }\n'
+
+    status, _headers, _data = request(async_live_server, "POST", f"/uploads/{token_id}")
+    assert status == HTTPStatus.CREATED
+    assert (tmp_path / "uploaded.txt").read_bytes() == b"first chunk\nsecond chunk\n"
+
+
+def test_async_server_rejects_oversized_request_bodies(async_live_server):
+    async_live_server.max_request_body_size = 4
+
+    status, _headers, _data = request(
+        async_live_server, "PATCH", "/uploads/token_id", body=b"a" * 10
+    )
+    assert status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+
+@pytest.fixture
+def stream_lines(app):
+    received = []
+
+    @app.route("/lines", methods=["POST"])
+    @csrf.exempt
+    def lines():
+        received.append(flask.request.stream.readline())
+        received.append(flask.request.stream.read())
+        return "lines"
+
+    return received
+
+
+def test_async_server_streams_request_bodies(async_live_server, stream_lines):
+    status, _headers, _data = request(
+        async_live_server,
+        "POST",
+        "/lines",
+        body=iter([b"first line\nsecond ", b"line\n"]),
+        encode_chunked=True,
+    )
+    assert status == HTTPStatus.OK
+    assert stream_lines == [b"first line\n", b"second line\n"]
+
+
+def test_async_server_rejects_oversized_chunked_request_bodies(
+    async_live_server, stream_lines
+):
+    async_live_server.max_request_body_size = 4
+
+    status, _headers, _data = request(
+        async_live_server,
+        "POST",
+        "/lines",
+        body=iter([b"a\n", b"a" * 3, b"a" * 3]),
+        encode_chunked=True,
+    )
+    assert status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+
+def test_async_server_rejects_request_bodies_before_they_are_sent(async_live_server):
+    with socket.create_connection(("127.0.0.1", async_live_server.port)) as sock:
+        sock.sendall(
+            b"PATCH /uploads/invalid_token HTTP/1.1\r\n"
+            b"Content-Length: 1000000000\r\n"
+            b"Expect: 100-continue\r\n\r\n"
+        )
+        response = sock.makefile("rb").read()
+    # The response is sent without waiting for the body, and without inviting it
+    assert response.startswith(b"HTTP/1.1 400 ")
+    assert b"100 Continue" not in response
+    assert b"Connection: close" in response
+
+
+@pytest.mark.parametrize(
+    "raw_request",
+    [
+        b"GET\r\n\r\n",
+        b"GET / HTTP/2.0\r\n\r\n",
+        b"GET / HTTP/1.1\r\nContent-Length: invalid\r\n\r\n",
+        b"GET / HTTP/1.1\r\nX-Header: " + b"a" * 128 * 1024 + b"\r\n\r\n",
+    ],
+)
+def test_async_server_invalid_requests(async_live_server, raw_request):
+    with socket.create_connection(("127.0.0.1", async_live_server.port)) as sock:
+        sock.sendall(raw_request)
+        response = sock.makefile("rb").read()
+    assert re.match(rb"HTTP/1.1 (400|431|505) ", response)
+    assert b"Connection: close" in response
+
+
+def test_async_server_closes_idle_connections_on_stop(app):
+    server = AsyncWSGIServer(app, "127.0.0.1", 0, threads=2)
+
+    async def run():
+        await server.start()
+        readers_and_writers = [
+            await asyncio.open_connection("127.0.0.1", server.port) for _ in range(50)
+        ]
+        await asyncio.sleep(0.1)
+        assert len(server.connections) == 50
+
+        await asyncio.wait_for(server.stop(), timeout=5)
+        for reader, writer in readers_and_writers:
+            assert await reader.read() == b""
+            writer.close()
+
+    asyncio.run(run())
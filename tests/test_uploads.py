@@ -10,7 +10,25 @@ import re
 import io
 import os
 import builtins
+import errno
+import time
+from bs4 import BeautifulSoup
 from pytest_mock import MockerFixture
+from concurrent.futures import ThreadPoolExecutor
+from toolbox.server.make_app import (
+    get_metrics,
+    get_partial_upload_directory,
+    get_upload_token_store,
+)
+from toolbox.server.file_manager import FileManager
+from toolbox.server.file_server import as_directory_etag
+from toolbox.server.upload_tokens import (
+    MemoryUploadTokenStore,
+    SqliteUploadTokenStore,
+    UploadToken,
+    UploadTokenStore,
+)
+from toolbox.server.uploads import PartialUpload, UploadInProgress
 from pathlib import Path
 
 
@@ -41,6 +59,26 @@ def test_upload_token_creation(app, client, req_ctx):
     assert extract_token_id(response, file_name="./test_upload_file.txt") is not None
 
 
+def test_upload_token_creation_after_revalidating_the_index(app, client):
+    etag = as_directory_etag(os.stat(app.config["ROOT_USER_DIRECTORY"]))
+    client.get("/").close()
+    # Restarting the server signs csrf tokens with a new key
+    app.secret_key = secrets.token_bytes(32)
+
+    response = client.get("/", headers={"If-None-Match": f'W/"{etag}"'})
+    assert response.status_code == HTTPStatus.OK
+    parsed = BeautifulSoup(response.data, features="html.parser")
+    csrf_token = parsed.find("input", attrs={"name": "csrf_token"})["value"]
+    response = client.post(
+        "/tokens",
+        content_type="application/x-www-form-urlencoded",
+        data=dict(csrf_token=csrf_token, file_name="revalidated.txt"),
+        follow_redirects=True,
+    )
+
+    assert extract_token_id(response, file_name="./revalidated.txt") is not None
+
+
 @pytest.mark.parametrize(
     "csrf_token,expected_data",
     [
@@ -62,28 +100,25 @@ def test_upload_token_creation_missing_csrf_token(
     assert expected_data in response.data
 
 
-def test_upload_file(mocker: MockerFixture, app, client, req_ctx):
-    def _mock_open(path, mode):
-        if path.name == "config.json":
-            return open(path, mode)
-        elif path.name == "test_upload_file.txt":
-            return tempfile.TemporaryFile(mode)
-        else:
-            raise "Unexpected scenario"
+@pytest.fixture
+def user_directory(app, tmp_path):
+    app.config["ROOT_USER_DIRECTORY"] = tmp_path
+    return tmp_path
 
-    mock_open = mocker.Mock()
-    mock_open.side_effect = _mock_open
 
-    file_manager_open_stub = mocker.patch("toolbox.server.file_manager.open", mock_open)
+def create_upload_token(client, file_name):
     csrf_token = client.get("/csrf_token").data.decode("utf-8")
     response = client.post(
         "/tokens",
         content_type="application/x-www-form-urlencoded",
-        data=dict(csrf_token=csrf_token, file_name="test_upload_file.txt"),
+        data=dict(csrf_token=csrf_token, file_name=file_name),
         follow_redirects=True,
     )
+    return extract_token_id(response, file_name=f"./{file_name}")
+
 
-    token_id = extract_token_id(response, file_name="./test_upload_file.txt")
+def test_upload_file(app, client, req_ctx, user_directory):
+    token_id = create_upload_token(client, "test_upload_file.txt")
     new_file_content = b"testing file upload content\n"
     response = client.post(
         "/uploads",
@@ -96,10 +131,66 @@ def test_upload_file(mocker: MockerFixture, app, client, req_ctx):
 
     assert response.status_code == HTTPStatus.CREATED
     assert response.data == b'{ "success": true }\n'
-    file_manager_open_stub.assert_called_with(
-        Path("./tests/harnesses/simple/serve/test_upload_file.txt").resolve(), "wb"
+    assert os.listdir(user_directory) == ["test_upload_file.txt"]
+    assert (user_directory / "test_upload_file.txt").read_bytes() == new_file_content
+
+
+def test_upload_large_binary_file(app, client, req_ctx, user_directory):
+    token_id = create_upload_token(client, "test_upload_file.bin")
+    new_file_content = b"\r" + os.urandom(1024 * 1024) + b"\n" * 1024
+    response = client.post(
+        "/uploads",
+        content_type="multipart/form-data",
+        data=dict(
+            token_id=token_id,
+            file=(io.BytesIO(new_file_content), "test_upload_file.bin"),
+        ),
     )
 
+    assert response.status_code == HTTPStatus.CREATED
+    assert (user_directory / "test_upload_file.bin").read_bytes() == new_file_content
+
+
+def test_upload_file_token_is_single_use(app, client, req_ctx, user_directory):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    for expected_status in [HTTPStatus.CREATED, HTTPStatus.BAD_REQUEST]:
+        response = client.post(
+            "/uploads",
+            content_type="multipart/form-data",
+            data=dict(
+                token_id=token_id,
+                file=(io.BytesIO(b"content"), "test_upload_file.txt"),
+            ),
+        )
+        assert response.status_code == expected_status
+
+
+def test_upload_file_exceeding_max_upload_size(app, client, req_ctx, user_directory):
+    app.config["MAX_UPLOAD_SIZE"] = 1024
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    response = client.post(
+        "/uploads",
+        content_type="multipart/form-data",
+        data=dict(
+            token_id=token_id,
+            file=(io.BytesIO(b"a" * 2048), "test_upload_file.txt"),
+        ),
+    )
+
+    assert response.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    assert os.listdir(user_directory) == []
+
+    response = client.post(
+        "/uploads",
+        content_type="multipart/form-data",
+        data=dict(
+            token_id=token_id,
+            file=(io.BytesIO(b"a" * 1024), "test_upload_file.txt"),
+        ),
+    )
+    assert response.status_code == HTTPStatus.CREATED
+    assert os.listdir(user_directory) == ["test_upload_file.txt"]
+
 
 @pytest.mark.parametrize(
     "file_name",
@@ -108,7 +199,9 @@ def test_upload_file(mocker: MockerFixture, app, client, req_ctx):
         "/tmp/arbitrary_write.txt",
     ],
 )
-def test_local_file_inclusion(mocker: MockerFixture, app, client, req_ctx, file_name):
+def test_local_file_inclusion(
+    mocker: MockerFixture, app, client, req_ctx, user_directory, file_name
+):
     def _mock_open(path, mode):
         if path.name == "config.json":
             return open(path, mode)
@@ -140,6 +233,7 @@ def test_local_file_inclusion(mocker: MockerFixture, app, client, req_ctx, file_
 
     assert response.status_code == HTTPStatus.BAD_REQUEST
     assert response.data == b'{ "error": "invalid path" }\n'
+    assert os.listdir(user_directory) == []
 
 
 def test_upload_token_creation_invalid_token(
@@ -159,3 +253,314 @@ def test_upload_token_creation_invalid_token(
     assert response.status_code == HTTPStatus.BAD_REQUEST
     assert response.data == b'{ "error": "token not valid" }\n'
     file_manager_open_stub.assert_not_called()
+
+
+def append_chunk(client, token_id, offset, data):
+    return client.patch(
+        f"/uploads/{token_id}", headers={"Upload-Offset": str(offset)}, data=data
+    )
+
+
+def test_resumable_upload(app, client, req_ctx, user_directory):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+
+    response = client.head(f"/uploads/{token_id}")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["Upload-Offset"] == "0"
+
+    response = append_chunk(client, token_id, 0, b"first chunk\n")
+    assert response.status_code == HTTPStatus.OK
+    assert response.data == b'{ "offset": 12 }\n'
+
+    response = client.head(f"/uploads/{token_id}")
+    assert response.headers["Upload-Offset"] == "12"
+
+    response = append_chunk(client, token_id, 12, b"second chunk\n")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["Upload-Offset"] == "25"
+    assert not (user_directory / "test_upload_file.txt").exists()
+
+    response = client.post(f"/uploads/{token_id}")
+    assert response.status_code == HTTPStatus.CREATED
+    assert response.data == b'{ "success": true }\n'
+    assert os.listdir(user_directory) == ["test_upload_file.txt"]
+    assert (
+        user_directory / "test_upload_file.txt"
+    ).read_bytes() == b"first chunk\nsecond chunk\n"
+
+    response = client.head(f"/uploads/{token_id}")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    assert os.listdir(get_partial_upload_directory(app)) == []
+
+
+def test_partial_uploads_are_not_served(app, client, req_ctx, user_directory):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    append_chunk(client, token_id, 0, b"first chunk\n")
+
+    assert os.listdir(user_directory) == []
+    [partial_upload_name] = os.listdir(get_partial_upload_directory(app))
+    assert token_id not in partial_upload_name
+
+
+def test_failed_commit_keeps_the_upload_token(
+    mocker, app, client, req_ctx, user_directory
+):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    append_chunk(client, token_id, 0, b"first chunk\n")
+    mocker.patch.object(
+        FileManager, "move_into_user_directory", side_effect=OSError("disk full")
+    )
+
+    response = client.post(f"/uploads/{token_id}")
+    assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert client.head(f"/uploads/{token_id}").headers["Upload-Offset"] == "12"
+
+    mocker.stopall()
+    response = client.post(f"/uploads/{token_id}")
+    assert response.status_code == HTTPStatus.CREATED
+    assert (user_directory / "test_upload_file.txt").read_bytes() == b"first chunk\n"
+
+
+def test_partial_uploads_are_locked(tmp_path):
+    file_manager = FileManager(
+        root_user_directory=tmp_path, root_toolbox_directory=tmp_path
+    )
+    partial_upload = PartialUpload(file_manager, tmp_path, "partial_upload_id")
+    partial_upload.append(io.BytesIO(b"first chunk\n"), offset=0, max_upload_size=None)
+
+    # The lock is held by open files, so it is also held across worker processes
+    with open(partial_upload.path, "rb") as file:
+        fcntl = pytest.importorskip("fcntl")
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        with pytest.raises(UploadInProgress):
+            partial_upload.append(io.BytesIO(b"chunk"), offset=12, max_upload_size=None)
+        with pytest.raises(UploadInProgress):
+            partial_upload.commit(tmp_path / "file.txt")
+
+    partial_upload.commit(tmp_path / "file.txt")
+    assert os.listdir(tmp_path) == ["file.txt"]
+
+
+def test_moving_uploads_across_file_systems(mocker, tmp_path):
+    user_directory = tmp_path / "serve"
+    user_directory.mkdir()
+    source_path = tmp_path / "upload.part"
+    source_path.write_bytes(b"content")
+    file_manager = FileManager(
+        root_user_directory=user_directory, root_toolbox_directory=tmp_path
+    )
+    replace = os.replace
+
+    def replace_within_file_system(source, destination):
+        if Path(source) == source_path:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        replace(source, destination)
+
+    mocker.patch("os.replace", side_effect=replace_within_file_system)
+
+    file_manager.move_into_user_directory(source_path, user_directory / "file.txt")
+    assert (user_directory / "file.txt").read_bytes() == b"content"
+    assert not source_path.exists()
+
+
+def test_failed_moves_across_file_systems_remove_the_copy(mocker, tmp_path):
+    user_directory = tmp_path / "serve"
+    user_directory.mkdir()
+    source_path = tmp_path / "upload.part"
+    source_path.write_bytes(b"content")
+    file_manager = FileManager(
+        root_user_directory=user_directory, root_toolbox_directory=tmp_path
+    )
+    mocker.patch(
+        "os.replace", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")
+    )
+    mocker.patch("shutil.copyfileobj", side_effect=OSError(errno.ENOSPC, "disk full"))
+
+    with pytest.raises(OSError):
+        file_manager.move_into_user_directory(source_path, user_directory / "file.txt")
+    assert os.listdir(user_directory) == []
+    assert source_path.read_bytes() == b"content"
+
+
+def test_upload_metrics(app, client, req_ctx, user_directory):
+    metrics = get_metrics(app)
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    client.post(
+        "/uploads",
+        content_type="multipart/form-data",
+        data=dict(token_id=token_id, file=(io.BytesIO(b"form\n"), "upload.txt")),
+    )
+    token_id = create_upload_token(client, "test_resumable_file.txt")
+    append_chunk(client, token_id, 0, b"first chunk\n")
+    client.post(f"/uploads/{token_id}")
+
+    assert metrics.uploads.get() == 2
+    assert metrics.upload_bytes_received.get() == len(b"form\nfirst chunk\n")
+
+
+def test_resumable_upload_offset_mismatch(app, client, req_ctx, user_directory):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    append_chunk(client, token_id, 0, b"first chunk\n")
+
+    for offset in [0, 5, 100]:
+        response = append_chunk(client, token_id, offset, b"retried chunk\n")
+        assert response.status_code == HTTPStatus.CONFLICT
+        assert response.data == b'{ "error": "offset mismatch", "offset": 12 }\n'
+        assert response.headers["Upload-Offset"] == "12"
+
+
+def test_resumable_upload_exceeding_max_upload_size(
+    app, client, req_ctx, user_directory
+):
+    app.config["MAX_UPLOAD_SIZE"] = 16
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    append_chunk(client, token_id, 0, b"a" * 10)
+
+    response = append_chunk(client, token_id, 10, b"a" * 10)
+    assert response.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    assert client.head(f"/uploads/{token_id}").headers["Upload-Offset"] == "10"
+
+
+@pytest.mark.parametrize("method", ["head", "patch", "post"])
+def test_resumable_upload_invalid_token(app, client, req_ctx, user_directory, method):
+    response = getattr(client, method)("/uploads/invalid_token")
+    assert response.status_code in (HTTPStatus.NOT_FOUND, HTTPStatus.BAD_REQUEST)
+    assert os.listdir(user_directory) == []
+
+
+def test_resumable_upload_commit_without_data(app, client, req_ctx, user_directory):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    response = client.post(f"/uploads/{token_id}")
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.data == b'{ "error": "no data uploaded" }\n'
+
+
+def test_expired_upload_tokens_are_rejected(app, client, req_ctx, user_directory):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    upload_token_store = get_upload_token_store(app)
+    upload_token_store.clock = lambda: time.time() + upload_token_store.ttl
+    response = client.post(
+        "/uploads",
+        content_type="multipart/form-data",
+        data=dict(token_id=token_id, file=(io.BytesIO(b"content"), "file.txt")),
+    )
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.data == b'{ "error": "token not valid" }\n'
+    assert os.listdir(user_directory) == []
+
+
+def test_evicted_upload_tokens_discard_partial_uploads(
+    app, client, req_ctx, user_directory
+):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    append_chunk(client, token_id, 0, b"first chunk\n")
+    partial_upload_directory = get_partial_upload_directory(app)
+    assert len(os.listdir(partial_upload_directory)) == 1
+
+    upload_token_store = get_upload_token_store(app)
+    upload_token_store.clock = lambda: time.time() + upload_token_store.ttl
+    assert [token.id for token in upload_token_store.evict_expired()] == [token_id]
+    assert os.listdir(partial_upload_directory) == []
+
+
+def test_consumed_expired_upload_tokens_discard_partial_uploads(
+    app, client, req_ctx, user_directory
+):
+    token_id = create_upload_token(client, "test_upload_file.txt")
+    append_chunk(client, token_id, 0, b"first chunk\n")
+    partial_upload_directory = get_partial_upload_directory(app)
+
+    upload_token_store = get_upload_token_store(app)
+    upload_token_store.clock = lambda: time.time() + upload_token_store.ttl
+    assert upload_token_store.consume(token_id) is None
+    assert os.listdir(partial_upload_directory) == []
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def create_upload_token_store(request, tmp_path):
+    def _create_upload_token_store(**options):
+        if request.param == "memory":
+            return MemoryUploadTokenStore(**options)
+        return SqliteUploadTokenStore(tmp_path / "upload_tokens.db", **options)
+
+    return _create_upload_token_store
+
+
+def test_upload_token_store_expiry(create_upload_token_store):
+    clock = FakeClock()
+    evicted_tokens = []
+    upload_token_store = create_upload_token_store(
+        ttl=60, clock=clock, on_evict=evicted_tokens.append
+    )
+    upload_token = UploadToken(id="token_id", file_name="file.txt")
+    upload_token_store.add(upload_token)
+
+    clock.now += 59
+    assert upload_token_store.get("token_id") == upload_token
+    assert upload_token_store.evict_expired() == []
+
+    clock.now += 1
+    assert upload_token_store.get("token_id") is None
+    assert upload_token_store.consume("token_id") is None
+    # Expired tokens are evicted when an upload attempts to use them
+    assert evicted_tokens == [upload_token]
+    assert upload_token_store.evict_expired() == []
+    assert evicted_tokens == [upload_token]
+
+
+def test_upload_token_store_eviction(create_upload_token_store):
+    clock = FakeClock()
+    evicted_tokens = []
+    upload_token_store = create_upload_token_store(
+        ttl=60, clock=clock, on_evict=evicted_tokens.append
+    )
+    upload_token_store.add(UploadToken(id="expired", file_name="expired.txt"))
+    clock.now += 30
+    upload_token_store.add(UploadToken(id="valid", file_name="valid.txt"))
+    clock.now += 30
+
+    expired_token = UploadToken(id="expired", file_name="expired.txt")
+    assert upload_token_store.evict_expired() == [expired_token]
+    assert evicted_tokens == [expired_token]
+    assert upload_token_store.get("valid") is not None
+
+
+def test_upload_token_store_consume_is_atomic(create_upload_token_store):
+    upload_token_store = create_upload_token_store()
+    upload_token = UploadToken(id="token_id", file_name="file.txt")
+    upload_token_store.add(upload_token)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(upload_token_store.consume, ["token_id"] * 32))
+
+    assert results.count(upload_token) == 1
+    assert results.count(None) == 31
+
+
+def test_upload_token_stores_must_implement_storage():
+    class IncompleteUploadTokenStore(UploadTokenStore):
+        def _add(self, upload_token, expires_at):
+            pass
+
+    with pytest.raises(TypeError):
+        IncompleteUploadTokenStore()
+
+
+def test_sqlite_upload_token_store_is_shared(tmp_path):
+    database_path = tmp_path / "upload_tokens.db"
+    upload_token = UploadToken(id="token_id", file_name="file.txt")
+    SqliteUploadTokenStore(database_path).add(upload_token)
+
+    shared_token = SqliteUploadTokenStore(database_path).consume("token_id")
+    assert shared_token == upload_token
+    assert shared_token.partial_upload_id == upload_token.partial_upload_id
+    assert SqliteUploadTokenStore(database_path).get("token_id") is None
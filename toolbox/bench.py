@@ -0,0 +1,521 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.client import HTTPConnection, HTTPException
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import secrets
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from .server.async_server import (
+    DEFAULT_THREADS as DEFAULT_ASYNC_THREADS,
+    AsyncWSGIServer,
+)
+from .server.make_app import get_upload_token_store, make_app
+from .server.prefork import DEFAULT_THREADS, ThreadPoolWSGIServer, serve_prefork
+from .server.upload_tokens import UploadToken
+
+Bytes = int
+Seconds = float
+
+READ_BUFFER_SIZE: Bytes = 1024 * 1024
+UPLOAD_CHUNK_SIZE: Bytes = 1024 * 1024
+MAX_DISCOVERED_FILES = 100
+SERVER_STARTUP_TIMEOUT: Seconds = 60
+
+REQUEST_KINDS = ["listing", "file", "upload", "payload"]
+DEFAULT_MIX = {"listing": 2, "file": 6, "upload": 1, "payload": 1}
+PAYLOAD_NAMES = ["shell.sh", "shell_bash.sh", "shell.py", "shell.php"]
+PERCENTILES = [50, 90, 99]
+
+# The files served when no directory is given
+SAMPLE_FILE_SIZES: List[Bytes] = [4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+
+
+@dataclass
+class BenchmarkRequest:
+    method: str
+    path: str
+    headers: Dict[str, str] = field(default_factory=dict)
+    # Creates the request body, which is sent as it is produced
+    body: Optional[Callable[[], Iterable[bytes]]] = None
+    expected_statuses: Sequence[int] = (200,)
+    # Results are reported separately for each kind of request
+    kind: str = "request"
+
+
+@dataclass
+class LoadResult:
+    latencies_by_kind: Dict[str, List[Seconds]]
+    errors_by_kind: Dict[str, int]
+    # The first error seen for each kind of request
+    error_messages: Dict[str, str]
+    bytes_received: Bytes
+    duration: Seconds
+
+    @property
+    def latencies(self) -> List[Seconds]:
+        return list(itertools.chain.from_iterable(self.latencies_by_kind.values()))
+
+    @property
+    def errors(self) -> int:
+        return sum(self.errors_by_kind.values())
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies) + self.errors
+
+    @property
+    def requests_per_second(self) -> float:
+        return len(self.latencies) / self.duration if self.duration else 0
+
+    @property
+    def bytes_received_per_second(self) -> float:
+        return self.bytes_received / self.duration if self.duration else 0
+
+    def latency_percentile(self, percentile: float) -> Optional[Seconds]:
+        return get_percentile(sorted(self.latencies), percentile)
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> Optional[float]:
+    """
+    Returns the nearest-rank percentile of the already sorted values
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percentile // 100))
+    return sorted_values[min(int(rank), len(sorted_values)) - 1]
+
+
+def send_request(connection: HTTPConnection, request: BenchmarkRequest, buffer) -> int:
+    """
+    Sends the request and reads the full response, returning the size of the
+    response body. The body is read into the given buffer and discarded.
+    """
+    body = request.body() if request.body is not None else None
+    connection.request(request.method, request.path, body=body, headers=request.headers)
+    response = connection.getresponse()
+    size = 0
+    while True:
+        read = response.readinto(buffer)
+        if not read:
+            break
+        size += read
+    if response.status not in request.expected_statuses:
+        raise ValueError(
+            f"{request.method} {request.path} responded with {response.status}"
+        )
+    return size
+
+
+def run_load(
+    host: str,
+    port: int,
+    make_request: Callable[[int], BenchmarkRequest],
+    concurrency: int,
+    total_requests: Optional[int] = None,
+    duration: Optional[Seconds] = None,
+) -> LoadResult:
+    """
+    Sends requests from a pool of clients, each reusing one keep-alive connection,
+    until the total number of requests have been sent or the duration has passed
+    """
+    indexes = itertools.count()
+    lock = threading.Lock()
+    latencies_by_kind: Dict[str, List[Seconds]] = {}
+    errors_by_kind: Dict[str, int] = {}
+    error_messages: Dict[str, str] = {}
+    bytes_received = 0
+    started_at = time.perf_counter()
+    stop_at = None if duration is None else started_at + duration
+
+    def run_client():
+        nonlocal bytes_received
+        buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        connection = HTTPConnection(host, port)
+        client_latencies: Dict[str, List[Seconds]] = {}
+        try:
+            while stop_at is None or time.perf_counter() < stop_at:
+                index = next(indexes)
+                if total_requests is not None and index >= total_requests:
+                    break
+                request = make_request(index)
+                request_started_at = time.perf_counter()
+                try:
+                    size = send_request(connection, request, buffer)
+                except (HTTPException, OSError, ValueError) as e:
+                    connection.close()
+                    connection = HTTPConnection(host, port)
+                    with lock:
+                        errors_by_kind[request.kind] = (
+                            errors_by_kind.get(request.kind, 0) + 1
+                        )
+                        error_messages.setdefault(request.kind, str(e) or repr(e))
+                    continue
+                client_latencies.setdefault(request.kind, []).append(
+                    time.perf_counter() - request_started_at
+                )
+                with lock:
+                    bytes_received += size
+        finally:
+            connection.close()
+            with lock:
+                for kind, latencies in client_latencies.items():
+                    latencies_by_kind.setdefault(kind, []).extend(latencies)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(run_client) for _ in range(concurrency)]:
+            future.result()
+
+    return LoadResult(
+        latencies_by_kind=latencies_by_kind,
+        errors_by_kind=errors_by_kind,
+        error_messages=error_messages,
+        bytes_received=bytes_received,
+        duration=time.perf_counter() - started_at,
+    )
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    """
+    Parses a request mix such as listing=2,file=6,upload=1,payload=1 into the weight
+    of each kind of request. Kinds which are not given are not requested.
+    """
+    mix = {}
+    for part in value.split(","):
+        kind, separator, weight = part.strip().partition("=")
+        if kind not in REQUEST_KINDS:
+            raise ValueError(
+                f"Unknown request kind '{kind}', "
+                f"expected one of {', '.join(REQUEST_KINDS)}"
+            )
+        try:
+            mix[kind] = int(weight) if separator else 1
+        except ValueError:
+            raise ValueError(f"Invalid weight '{weight}' for {kind}")
+        if mix[kind] < 0:
+            raise ValueError(f"Invalid weight '{weight}' for {kind}")
+
+    mix = {kind: weight for kind, weight in mix.items() if weight > 0}
+    if not mix:
+        raise ValueError("At least one kind of request must be given a weight")
+    return mix
+
+
+def make_upload_request(
+    token_id: str, size: Bytes, chunk_size: Bytes = UPLOAD_CHUNK_SIZE
+) -> BenchmarkRequest:
+    """
+    Creates a multipart form upload, whose file contents are generated as they are
+    sent rather than held in memory
+    """
+    boundary = secrets.token_hex(16)
+    prefix = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="token_id"\r\n'
+        "\r\n"
+        f"{token_id}\r\n"
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="upload.bin"\r\n'
+        "Content-Type: application/octet-stream\r\n"
+        "\r\n"
+    ).encode("ascii")
+    suffix = f"\r\n--{boundary}--\r\n".encode("ascii")
+
+    def body() -> Iterator[bytes]:
+        yield prefix
+        chunk = bytes(chunk_size)
+        remaining = size
+        while remaining > 0:
+            yield chunk[: min(chunk_size, remaining)]
+            remaining -= chunk_size
+        yield suffix
+
+    return BenchmarkRequest(
+        "POST",
+        "/uploads",
+        headers={
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(prefix) + size + len(suffix)),
+        },
+        body=body,
+        expected_statuses=(201,),
+        kind="upload",
+    )
+
+
+def discover_files(host: str, port: int, listing_path: str) -> List[str]:
+    """
+    Returns the server paths of the files within the listed directory
+    """
+    connection = HTTPConnection(host, port)
+    try:
+        path = listing_path.strip("/")
+        connection.request(
+            "GET",
+            f"/api/files/{path}?type=file&format=ndjson&limit={MAX_DISCOVERED_FILES}",
+        )
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            return []
+        return [json.loads(line)["path"] for line in body.splitlines()]
+    finally:
+        connection.close()
+
+
+class RequestMix:
+    """
+    Chooses the kind of each request by the weights of the mix. The same requests are
+    made by every run with the same mix.
+    """
+
+    def __init__(
+        self,
+        mix: Dict[str, int],
+        listing_path: str = "/",
+        file_paths: Sequence[str] = (),
+        create_upload_token: Optional[Callable[[int], str]] = None,
+        upload_size: Bytes = UPLOAD_CHUNK_SIZE,
+    ):
+        self.mix = mix
+        self.listing_path = listing_path
+        self.file_paths = list(file_paths)
+        self.create_upload_token = create_upload_token
+        self.upload_size = upload_size
+        self._kinds = list(mix.keys())
+        self._weights = list(mix.values())
+
+    def __call__(self, index: int) -> BenchmarkRequest:
+        [kind] = random.Random(index).choices(self._kinds, weights=self._weights)
+        if kind == "listing":
+            return BenchmarkRequest("GET", self.listing_path, kind=kind)
+        if kind == "file":
+            return BenchmarkRequest(
+                "GET", self.file_paths[index % len(self.file_paths)], kind=kind
+            )
+        if kind == "upload":
+            return make_upload_request(
+                self.create_upload_token(index), self.upload_size
+            )
+        return BenchmarkRequest(
+            "GET",
+            f"/shells/{PAYLOAD_NAMES[index % len(PAYLOAD_NAMES)]}/127.0.0.1/4444",
+            kind=kind,
+        )
+
+
+def _run_server(
+    app,
+    host: str,
+    threads: int,
+    workers: int,
+    use_async: bool,
+    connection,
+):
+    # The server's access log would otherwise be interleaved with the report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.dup2(devnull, sys.stderr.fileno())
+
+    if use_async:
+        server = AsyncWSGIServer(app, host, 0, threads=threads)
+        asyncio.run(server.serve_until_stopped(on_started=connection.send))
+        return
+
+    server = ThreadPoolWSGIServer(
+        host, 0, app, threads=threads, multiprocess=workers > 1
+    )
+    connection.send(server.port)
+    serve_prefork(server, workers=workers)
+
+
+class BenchServer:
+    """
+    Serves the app from a forked process, so that the server and the clients
+    generating load do not compete for the same interpreter lock
+    """
+
+    def __init__(
+        self,
+        app,
+        host: str = "127.0.0.1",
+        threads: int = DEFAULT_THREADS,
+        workers: int = 1,
+        use_async: bool = False,
+    ):
+        self.app = app
+        self.host = host
+        self.threads = threads
+        self.workers = workers
+        self.use_async = use_async
+        self.port: Optional[int] = None
+        self._process = None
+
+    def __enter__(self) -> "BenchServer":
+        context = multiprocessing.get_context("fork")
+        connection, child_connection = context.Pipe()
+        self._process = context.Process(
+            target=_run_server,
+            args=(
+                self.app,
+                self.host,
+                self.threads,
+                self.workers,
+                self.use_async,
+                child_connection,
+            ),
+            daemon=False,
+        )
+        self._process.start()
+        if not connection.poll(SERVER_STARTUP_TIMEOUT):
+            self._process.kill()
+            raise RuntimeError("The server did not start")
+        self.port = connection.recv()
+        return self
+
+    def __exit__(self, *exc_info):
+        # Stops the server gracefully, as with SIGTERM
+        self._process.terminate()
+        self._process.join()
+
+
+def format_milliseconds(seconds: Optional[Seconds]) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def format_report(result: LoadResult, concurrency: int) -> str:
+    """
+    Formats the throughput and latency percentiles of each kind of request, and of
+    all requests
+    """
+    header = (
+        f"{'kind':<10}{'requests':>10}{'errors':>8}{'req/s':>10}"
+        + "".join(f"{f'p{percentile} ms':>10}" for percentile in PERCENTILES)
+        + f"{'max ms':>10}"
+    )
+    lines = [header]
+    rows = [
+        (
+            kind,
+            result.latencies_by_kind.get(kind, []),
+            result.errors_by_kind.get(kind, 0),
+        )
+        for kind in REQUEST_KINDS
+        if kind in result.latencies_by_kind or kind in result.errors_by_kind
+    ]
+    rows.append(("total", result.latencies, result.errors))
+    for kind, latencies, errors in rows:
+        latencies = sorted(latencies)
+        requests_per_second = len(latencies) / result.duration if result.duration else 0
+        lines.append(
+            f"{kind:<10}{len(latencies) + errors:>10}{errors:>8}"
+            f"{requests_per_second:>10.1f}"
+            + "".join(
+                f"{format_milliseconds(get_percentile(latencies, percentile)):>10}"
+                for percentile in PERCENTILES
+            )
+            + f"{format_milliseconds(latencies[-1] if latencies else None):>10}"
+        )
+
+    lines.append("")
+    lines.append(
+        f"{result.requests} requests from {concurrency} clients "
+        f"in {result.duration:.1f}s, "
+        f"{result.requests_per_second:.1f} req/s, "
+        f"{result.bytes_received_per_second / 1024 / 1024:.1f} MB/s received"
+    )
+    for kind, message in result.error_messages.items():
+        lines.append(f"First {kind} error: {message}")
+    return "\n".join(lines)
+
+
+@dataclass
+class BenchTarget:
+    host: str
+    port: int
+    # Creates a token for the upload with the given index, when uploads are supported
+    create_upload_token: Optional[Callable[[int], str]] = None
+
+
+def create_sample_files(directory: Path):
+    for size in SAMPLE_FILE_SIZES:
+        with open(directory / f"sample_{size}.bin", "wb") as file:
+            file.truncate(size)
+
+
+@contextmanager
+def serve_in_process(
+    root_toolbox_directory: Path,
+    config_path: Path,
+    root_user_directory: Optional[Path] = None,
+    threads: int = DEFAULT_THREADS,
+    workers: int = 1,
+    use_async: bool = False,
+) -> Iterator[BenchTarget]:
+    """
+    Serves the given directory, or a temporary directory of sample files, for the
+    duration of the benchmark. Uploads can only be written within the served
+    directory, so they are written to a temporary .toolbox-bench-* directory within
+    it, which is removed afterwards.
+    """
+    with tempfile.TemporaryDirectory(prefix="toolbox-bench-") as temporary_directory:
+        if root_user_directory is None:
+            root_user_directory = Path(temporary_directory) / "serve"
+            root_user_directory.mkdir()
+            create_sample_files(root_user_directory)
+        uploads_directory = Path(
+            tempfile.mkdtemp(prefix=".toolbox-bench-", dir=root_user_directory)
+        )
+
+        # Workers share their metrics as they do when serving with --workers
+        metrics_directory = None
+        if workers > 1:
+            metrics_directory = Path(temporary_directory) / "metrics"
+            metrics_directory.mkdir()
+
+        try:
+            app = make_app(
+                verbose=False,
+                host="127.0.0.1",
+                port=0,
+                password=secrets.token_urlsafe(16),
+                root_toolbox_directory=root_toolbox_directory,
+                root_user_directory=root_user_directory,
+                config_path=config_path,
+                # Tokens are added by the benchmark while the server is running
+                upload_token_store_path=Path(temporary_directory) / "upload_tokens.db",
+                metrics_directory=metrics_directory,
+            )
+            upload_token_store = get_upload_token_store(app)
+
+            def create_upload_token(index: int) -> str:
+                upload_token = UploadToken(
+                    id=secrets.token_urlsafe(16),
+                    file_name=f"{uploads_directory.name}/upload_{index}.bin",
+                )
+                upload_token_store.add(upload_token)
+                return upload_token.id
+
+            with BenchServer(
+                app,
+                threads=threads,
+                workers=workers,
+                use_async=use_async,
+            ) as server:
+                yield BenchTarget(
+                    host=server.host,
+                    port=server.port,
+                    create_upload_token=create_upload_token,
+                )
+        finally:
+            shutil.rmtree(uploads_directory, ignore_errors=True)
@@ -1,9 +1,21 @@
 import click
 from toolbox import __version__
 from toolbox.server import server
+from toolbox.server.upload_tokens import DEFAULT_UPLOAD_TOKEN_TTL
+from toolbox.server.grep import DEFAULT_MAX_RESULTS, ContentSearcher
+from toolbox.server.color import Color
+from toolbox.server.make_app import ToolboxServerException
+from toolbox import bench as benchmark
 
+from dataclasses import asdict
 from os import path
+import json
+import os
+import re
+import ipaddress
+import socket
 from pathlib import Path
+from urllib.parse import urlsplit
 
 
 def validate_port_permissions(ctx, param, value):
@@ -26,6 +38,37 @@ def validate_directory(ctx, param, value):
     return str(resolved_path)
 
 
+def validate_file_size(ctx, param, value):
+    if value is None:
+        return None
+
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    size = value.strip().upper()
+    multiplier = 1
+    if size and size[-1] in units:
+        multiplier = units[size[-1]]
+        size = size[:-1]
+
+    try:
+        return int(size) * multiplier
+    except ValueError:
+        raise click.BadParameter(
+            f"value '{value}' is not a valid size, such as 500M or 2G"
+        )
+
+
+def validate_pattern(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        return re.compile(value)
+    except re.error as e:
+        raise click.BadParameter(
+            f"value '{value}' is not a valid regular expression: {e}"
+        )
+
+
 @click.version_option(__version__)
 @click.group()
 def cli():
@@ -37,7 +80,7 @@ def cli():
     "--debug/--no-debug",
     is_flag=True,
     default=False,
-    help="Enable debug mode. Note this exposes `/console` which could potentially be accessed remotely and access could be bruteforced.",
+    help="Enable debug mode. Note this exposes `/console` which could potentially be accessed remotely and access could be bruteforced. Can not be used with --workers.",
 )
 @click.option(
     "--reload/--no-reload",
@@ -45,6 +88,27 @@ def cli():
     default=False,
     help="Enable reloading of files. This includes python files *and* python files",
 )
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    required=False,
+    default=None,
+    help="Serve with a pool of forked worker processes instead of the development server",
+)
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    default=False,
+    help="Serve with an asyncio server, which can hold many slow or idle connections open cheaply",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    required=False,
+    default=None,
+    help="The number of threads that each worker process, or the asyncio server, uses to serve requests",
+)
 @click.option(
     "-v", "--verbose", is_flag=True, default=False, help="Enable verbose logging"
 )
@@ -54,6 +118,73 @@ def cli():
     default=None,
     help="A password is required to upload files. There is no username.",
 )
+@click.option(
+    "--max-upload-size",
+    required=False,
+    default=None,
+    callback=validate_file_size,
+    help="The maximum size of an uploaded file, such as 500M or 2G. Unlimited by default.",
+)
+@click.option(
+    "--upload-token-ttl",
+    type=click.IntRange(min=1),
+    default=DEFAULT_UPLOAD_TOKEN_TTL,
+    show_default=True,
+    help="The number of seconds before an unused upload token expires",
+)
+@click.option(
+    "--upload-token-store",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    required=False,
+    default=None,
+    help=(
+        "A SQLite database to store upload tokens in. Incomplete resumable uploads "
+        "are kept in a directory alongside it. A temporary database is used when "
+        "serving with multiple workers."
+    ),
+)
+@click.option(
+    "--access-log",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    required=False,
+    default=None,
+    help="A file to append each request to as a line of JSON. Requests are always logged to the console.",
+)
+@click.option(
+    "--profile",
+    "profile_directory",
+    type=click.Path(file_okay=False, writable=True, path_type=Path),
+    required=False,
+    default=None,
+    help=(
+        "Profile a sample of requests with cProfile, writing each profile to this "
+        "directory. A summary is available from /profiles."
+    ),
+)
+@click.option(
+    "--profile-sample-rate",
+    type=click.FloatRange(min=0, max=1),
+    required=False,
+    default=None,
+    help=(
+        "The fraction of requests to profile. Defaults to 0.01, or to every request "
+        "matching --profile-path."
+    ),
+)
+@click.option(
+    "--profile-path",
+    "profile_path_pattern",
+    required=False,
+    default=None,
+    callback=validate_pattern,
+    help="Only profile requests whose path matches this regular expression",
+)
+@click.option(
+    "--memory-diagnostics",
+    is_flag=True,
+    default=False,
+    help="Trace memory allocations with tracemalloc, reported from /memory. This slows down the server.",
+)
 @click.option(
     "-p",
     "--port",
@@ -63,8 +194,48 @@ def cli():
     help="the port to serve from",
 )
 @click.argument("root_user_directory", required=True, callback=validate_directory)
-def serve(host, port, password, debug, reload, verbose, root_user_directory):
+def serve(
+    host,
+    port,
+    password,
+    max_upload_size,
+    upload_token_ttl,
+    upload_token_store,
+    access_log,
+    profile_directory,
+    profile_sample_rate,
+    profile_path_pattern,
+    memory_diagnostics,
+    debug,
+    reload,
+    workers,
+    use_async,
+    threads,
+    verbose,
+    root_user_directory,
+):
     root_toolbox_directory = Path(__file__).parent.parent
+    if reload and (workers is not None or threads is not None or use_async):
+        raise click.UsageError(
+            "--reload can not be used with --workers, --threads or --async"
+        )
+    if use_async and workers is not None:
+        raise click.UsageError("--async can not be used with --workers")
+    # The debugger's tracebacks and consoles are only held by the process which
+    # served the failed request
+    if debug and workers is not None:
+        raise click.UsageError("--debug can not be used with --workers")
+    if (workers or 1) > 1 and not hasattr(os, "fork"):
+        raise click.BadParameter(
+            "multiple workers are not supported on this platform",
+            param_hint="--workers",
+        )
+    if profile_directory is None and (
+        profile_sample_rate is not None or profile_path_pattern is not None
+    ):
+        raise click.UsageError(
+            "--profile-sample-rate and --profile-path require --profile"
+        )
 
     server.serve(
         host=host,
@@ -76,7 +247,308 @@ def serve(host, port, password, debug, reload, verbose, root_user_directory):
         config_path=Path(__file__).parent / "config.json",
         use_debugger=debug,
         use_reloader=reload,
+        max_upload_size=max_upload_size,
+        upload_token_ttl=upload_token_ttl,
+        upload_token_store_path=upload_token_store,
+        access_log_path=access_log,
+        profile_directory=profile_directory,
+        profile_sample_rate=profile_sample_rate,
+        profile_path_pattern=profile_path_pattern,
+        memory_diagnostics=memory_diagnostics,
+        workers=workers,
+        threads=threads,
+        use_async=use_async,
+    )
+
+
+@cli.command()
+@click.option(
+    "-i",
+    "--ignore-case",
+    is_flag=True,
+    default=False,
+    help="Match the pattern case insensitively",
+)
+@click.option(
+    "--json",
+    "as_json",
+    is_flag=True,
+    default=False,
+    help="Output each matching line as newline delimited JSON",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    required=False,
+    default=None,
+    help="The number of processes used to search files. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--max-results",
+    type=click.IntRange(min=1),
+    default=DEFAULT_MAX_RESULTS,
+    show_default=True,
+    help="Stop searching after this many matching lines",
+)
+@click.argument("pattern", required=True)
+@click.argument("directory", required=False, default=".", callback=validate_directory)
+def grep(ignore_case, as_json, workers, max_results, pattern, directory):
+    """
+    Search the contents of every file within a directory, such as the uploads
+    directory, for a regular expression
+    """
+    content_searcher = ContentSearcher(Path(directory), workers=workers)
+    try:
+        matches = content_searcher.search(
+            pattern, ignore_case=ignore_case, max_results=max_results
+        )
+    except re.error as e:
+        raise click.BadParameter(
+            f"invalid regular expression: {e}", param_hint="PATTERN"
+        )
+
+    try:
+        for match in matches:
+            if as_json:
+                click.echo(json.dumps(asdict(match)))
+            else:
+                click.echo(
+                    f"{Color.green(match.path)}:{match.line_number}:{match.line}"
+                )
+    finally:
+        content_searcher.close()
+
+
+def validate_mix(ctx, param, value):
+    try:
+        return benchmark.parse_mix(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def validate_local_url(ctx, param, value):
+    if value is None:
+        return None
+
+    url = urlsplit(value)
+    if url.scheme != "http" or not url.hostname:
+        raise click.BadParameter(
+            f"value '{value}' is not an http url, such as http://127.0.0.1:8000"
+        )
+    try:
+        is_loopback = ipaddress.ip_address(
+            socket.gethostbyname(url.hostname)
+        ).is_loopback
+    except (OSError, ValueError):
+        is_loopback = False
+    # Only servers on this machine can be benchmarked
+    if not is_loopback:
+        raise click.BadParameter(f"host '{url.hostname}' is not a local address")
+    return url
+
+
+@cli.command()
+@click.option(
+    "--url",
+    default=None,
+    callback=validate_local_url,
+    help="Benchmark a server which is already running on this machine, such as http://127.0.0.1:8000. By default a server is started in-process.",
+)
+@click.option(
+    "-c",
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="The number of concurrent clients",
+)
+@click.option(
+    "-n",
+    "--requests",
+    "total_requests",
+    type=click.IntRange(min=1),
+    default=None,
+    help="The number of requests to send. Defaults to 1000 unless --duration is given.",
+)
+@click.option(
+    "-d",
+    "--duration",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Send requests for this many seconds",
+)
+@click.option(
+    "--mix",
+    default="listing=2,file=6,upload=1,payload=1",
+    show_default=True,
+    callback=validate_mix,
+    help="The weight of each kind of request",
+)
+@click.option(
+    "--listing-path",
+    default="/",
+    show_default=True,
+    help="The directory to request listings of",
+)
+@click.option(
+    "--file-path",
+    "file_paths",
+    multiple=True,
+    help="A file to fetch. Can be given multiple times. Defaults to the files within the listed directory.",
+)
+@click.option(
+    "--upload-size",
+    default="1M",
+    show_default=True,
+    callback=validate_file_size,
+    help="The size of each uploaded file",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="The number of worker processes of the in-process server",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    default=None,
+    help="The number of threads of the in-process server",
+)
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    default=False,
+    help="Serve the in-process server asynchronously",
+)
+@click.argument("directory", required=False, default=None)
+def bench(
+    url,
+    concurrency,
+    total_requests,
+    duration,
+    mix,
+    listing_path,
+    file_paths,
+    upload_size,
+    workers,
+    threads,
+    use_async,
+    directory,
+):
+    """
+    Measure the throughput and latency of the server under a mix of listing, file,
+    upload and payload requests. Serves the directory, or a directory of sample files,
+    unless --url is given.
+
+    Uploads are written to a temporary hidden directory within the served
+    directory, which is removed once the benchmark completes.
+    """
+    if total_requests is None and duration is None:
+        total_requests = 1000
+    if use_async and workers > 1:
+        raise click.UsageError("--async can not be used with --workers")
+    if url is not None and (
+        directory is not None or workers > 1 or threads is not None or use_async
+    ):
+        raise click.UsageError(
+            "DIRECTORY, --workers, --threads and --async can not be used with --url"
+        )
+    if not hasattr(os, "fork") and url is None:
+        raise click.UsageError(
+            "the in-process server is not supported on this platform, use --url"
+        )
+    if directory is not None:
+        directory = Path(validate_directory(None, None, directory))
+
+    if url is not None:
+        if "upload" in mix:
+            # Upload tokens can only be created for the in-process server
+            click.echo("Skipping uploads, which can only be benchmarked in-process")
+            mix = {kind: weight for kind, weight in mix.items() if kind != "upload"}
+            if not mix:
+                raise click.UsageError("no requests to send")
+        target = benchmark.BenchTarget(host=url.hostname, port=url.port or 80)
+        run_bench(
+            target,
+            concurrency,
+            total_requests,
+            duration,
+            mix,
+            listing_path,
+            file_paths,
+            upload_size,
+        )
+        return
+
+    root_toolbox_directory = Path(__file__).parent.parent
+    try:
+        with benchmark.serve_in_process(
+            root_toolbox_directory=root_toolbox_directory,
+            config_path=Path(__file__).parent / "config.json",
+            root_user_directory=directory,
+            threads=threads
+            or (
+                benchmark.DEFAULT_ASYNC_THREADS
+                if use_async
+                else benchmark.DEFAULT_THREADS
+            ),
+            workers=workers,
+            use_async=use_async,
+        ) as target:
+            run_bench(
+                target,
+                concurrency,
+                total_requests,
+                duration,
+                mix,
+                listing_path,
+                file_paths,
+                upload_size,
+            )
+    except ToolboxServerException as e:
+        print(str(e))
+        exit(1)
+
+
+def run_bench(
+    target,
+    concurrency,
+    total_requests,
+    duration,
+    mix,
+    listing_path,
+    file_paths,
+    upload_size,
+):
+    if "file" in mix and not file_paths:
+        file_paths = benchmark.discover_files(target.host, target.port, listing_path)
+        if not file_paths:
+            raise click.UsageError(
+                f"no files found within '{listing_path}' to fetch, use --file-path"
+            )
+
+    request_mix = benchmark.RequestMix(
+        mix,
+        listing_path=listing_path,
+        file_paths=file_paths,
+        create_upload_token=target.create_upload_token,
+        upload_size=upload_size,
+    )
+    click.echo(
+        f"Benchmarking http://{target.host}:{target.port} with {concurrency} clients"
+    )
+    result = benchmark.run_load(
+        target.host,
+        target.port,
+        request_mix,
+        concurrency=concurrency,
+        total_requests=total_requests,
+        duration=duration,
     )
+    click.echo(benchmark.format_report(result, concurrency=concurrency))
 
 
 def run():
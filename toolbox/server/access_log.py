@@ -0,0 +1,328 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, TextIO
+from urllib.parse import quote
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from .color import Color
+from .file_server import Bytes
+from .request_handler import SENDFILE_ENVIRON_KEY, call_on_close, is_file_wrapper
+
+logger = logging.getLogger(__name__)
+
+Seconds = float
+
+DEFAULT_MAX_QUEUE_SIZE = 10_000
+DEFAULT_BATCH_SIZE = 256
+
+
+@dataclass
+class AccessLogRecord:
+    # Unix timestamp of when the request was received
+    timestamp: float
+    client_ip: str
+    method: str
+    # The requested path, including the query string
+    path: str
+    status: int
+    bytes_sent: Bytes
+    # Measured until the response has been fully sent
+    duration: Seconds
+    user_agent: str
+
+    def as_json(self) -> str:
+        return json.dumps(
+            {
+                "time": datetime.fromtimestamp(self.timestamp, timezone.utc).isoformat(
+                    timespec="milliseconds"
+                ),
+                "client_ip": self.client_ip,
+                "method": self.method,
+                "path": self.path,
+                "status": self.status,
+                "bytes_sent": self.bytes_sent,
+                "duration_ms": round(self.duration * 1000, 3),
+                "user_agent": self.user_agent,
+            }
+        )
+
+
+class AccessLogSink(ABC):
+    @abstractmethod
+    def write(self, records: List[AccessLogRecord]):
+        """
+        Writes a batch of records, from the access log's writer thread
+        """
+
+
+class JsonLinesSink(AccessLogSink):
+    """
+    Appends each record as a line of JSON. The file is opened in append mode and
+    each batch is written with a single write, so that the worker processes of a
+    prefork server can share the same file without interleaving their lines.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def write(self, records: List[AccessLogRecord]):
+        data = "".join(f"{record.as_json()}\n" for record in records).encode("utf-8")
+        view = memoryview(data)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+
+    def close(self):
+        os.close(self._fd)
+
+
+class ConsoleSink(AccessLogSink):
+    """
+    Writes each record in a format similar to the common log format, highlighting
+    client and server errors when writing to a terminal
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        self.stream = stream or sys.stderr
+        try:
+            self.use_color = self.stream.isatty()
+        except (AttributeError, ValueError):
+            self.use_color = False
+
+    def format(self, record: AccessLogRecord) -> str:
+        status = str(record.status)
+        if self.use_color:
+            if record.status >= 500:
+                status = Color.red(status)
+            elif record.status >= 400:
+                status = Color.yellow(status)
+            else:
+                status = Color.green(status)
+
+        received_at = time.strftime(
+            "%d/%b/%Y %H:%M:%S", time.localtime(record.timestamp)
+        )
+        return (
+            f'{record.client_ip} - - [{received_at}] "{record.method} {record.path}" '
+            f"{status} {record.bytes_sent or '-'} {record.duration * 1000:.1f}ms "
+            f'"{record.user_agent}"'
+        )
+
+    def write(self, records: List[AccessLogRecord]):
+        self.stream.write("".join(f"{self.format(record)}\n" for record in records))
+        self.stream.flush()
+
+
+class AccessLog:
+    """
+    Queues access log records for a background thread to write to each sink, so that
+    requests never wait on terminal or disk writes. The queue is bounded - when the
+    sinks can not keep up with a burst of requests, records are dropped and counted
+    rather than blocking the request threads.
+
+    The background thread is started lazily in each process that records a request,
+    so that the log can be created before the server forks its worker processes.
+    """
+
+    def __init__(
+        self,
+        sinks: Iterable[AccessLogSink],
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ):
+        self.sinks = list(sinks)
+        self.batch_size = batch_size
+        self.dropped_count = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._writer_pid: Optional[int] = None
+
+    def record(self, record: AccessLogRecord):
+        self._start_writer()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped_count += 1
+
+    def join(self):
+        """
+        Waits until every queued record has been written
+        """
+        self._queue.join()
+
+    def write_pending(self) -> int:
+        """
+        Writes the next batch of queued records to each sink, waiting for a record if
+        the queue is empty. Returns the number of records written.
+        """
+        records = [self._queue.get()]
+        while len(records) < self.batch_size:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            for sink in self.sinks:
+                try:
+                    sink.write(records)
+                except Exception:
+                    logger.exception("Failed to write access log records")
+        finally:
+            for _record in records:
+                self._queue.task_done()
+        return len(records)
+
+    def _start_writer(self):
+        pid = os.getpid()
+        if self._writer_pid == pid:
+            return
+
+        with self._lock:
+            if self._writer_pid == pid:
+                return
+            # Records queued before forking belong to the parent process
+            self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._writer_pid = pid
+            threading.Thread(target=self._write_forever, daemon=True).start()
+
+    def _write_forever(self):
+        while True:
+            self.write_pending()
+
+
+class AccessLoggedResponse:
+    """
+    Wraps a WSGI response to count the bytes sent, and records the request once the
+    server closes the response - so that the duration includes streaming the body
+    """
+
+    def __init__(self, app_iter: Iterable[bytes], request_log: "RequestLog"):
+        self.app_iter = app_iter
+        self.request_log = request_log
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self.app_iter:
+            self.request_log.bytes_sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            self.request_log.finish()
+
+
+class RequestLog:
+    def __init__(self, environ, access_log: AccessLog):
+        self.environ = environ
+        self.access_log = access_log
+        self.timestamp = time.time()
+        self.started_at = time.perf_counter()
+        self.status = 0
+        self.content_length: Optional[Bytes] = None
+        self.bytes_sent: Bytes = 0
+        self.is_finished = False
+
+    def start_response(self, start_response):
+        def logged_start_response(status, headers, exc_info=None):
+            self.status = int(status.split(" ", 1)[0])
+            for name, value in headers:
+                if name.lower() == "content-length":
+                    self.content_length = int(value)
+            write = start_response(status, headers, exc_info)
+
+            def logged_write(data: bytes):
+                self.bytes_sent += len(data)
+                return write(data)
+
+            return logged_write
+
+        return logged_start_response
+
+    def sendfile(self, sendfile):
+        def logged_sendfile(file, offset: Bytes, count: Bytes) -> Bytes:
+            sent = sendfile(file, offset, count)
+            self.bytes_sent += sent
+            return sent
+
+        return logged_sendfile
+
+    def finish_file_wrapper(self):
+        # The server sends file wrappers itself, so the whole body is counted once
+        # the server closes it
+        self.bytes_sent += self.content_length or 0
+        self.finish()
+
+    def finish(self):
+        if self.is_finished:
+            return
+        self.is_finished = True
+        environ = self.environ
+        self.access_log.record(
+            AccessLogRecord(
+                timestamp=self.timestamp,
+                client_ip=environ.get("REMOTE_ADDR", "-"),
+                method=environ.get("REQUEST_METHOD", "-"),
+                path=get_request_path(environ),
+                status=self.status,
+                bytes_sent=self.bytes_sent,
+                duration=time.perf_counter() - self.started_at,
+                user_agent=environ.get("HTTP_USER_AGENT", "-"),
+            )
+        )
+
+
+def get_request_path(environ) -> str:
+    raw_uri = environ.get("RAW_URI") or environ.get("REQUEST_URI")
+    if raw_uri:
+        return raw_uri
+
+    path = quote(
+        (environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "")).encode(
+            "latin-1"
+        ),
+        safe="/:@!$&'()*+,;=-._~",
+    )
+    query_string = environ.get("QUERY_STRING")
+    return f"{path}?{query_string}" if query_string else path
+
+
+class AccessLogMiddleware:
+    """
+    WSGI middleware which records the client, request, response status, bytes sent,
+    duration and user agent of every request to the access log
+    """
+
+    def __init__(self, app, access_log: AccessLog):
+        self.app = app
+        self.access_log = access_log
+
+    def __call__(self, environ, start_response):
+        request_log = RequestLog(environ, self.access_log)
+        sendfile = environ.get(SENDFILE_ENVIRON_KEY)
+        if sendfile is not None:
+            environ[SENDFILE_ENVIRON_KEY] = request_log.sendfile(sendfile)
+
+        try:
+            app_iter = self.app(environ, request_log.start_response(start_response))
+        except BaseException:
+            request_log.status = request_log.status or 500
+            request_log.finish()
+            raise
+
+        # The server's own file wrapper is returned as-is, so that it can still send
+        # the file itself
+        if is_file_wrapper(environ, app_iter):
+            return call_on_close(environ, app_iter, request_log.finish_file_wrapper)
+        return AccessLoggedResponse(app_iter, request_log)
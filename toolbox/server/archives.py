@@ -0,0 +1,286 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Set, Tuple
+import logging
+import os
+import stat
+import tarfile
+import time
+import zipfile
+import zlib
+from flask import Response
+from .file_manager import InvalidFilePath, VerifiedPath
+from .file_server import CHUNK_SIZE, Bytes, ServerDirectoryListing
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMATS = {
+    "tar.gz": "application/gzip",
+    "zip": "application/zip",
+}
+
+# Files which are already compressed are stored as-is within zip archives, as
+# compressing them again wastes time for little or no benefit
+COMPRESSED_EXTENSIONS = {
+    ".7z",
+    ".apk",
+    ".br",
+    ".bz2",
+    ".cab",
+    ".docx",
+    ".gif",
+    ".gz",
+    ".jar",
+    ".jpeg",
+    ".jpg",
+    ".lz4",
+    ".lzma",
+    ".mp3",
+    ".mp4",
+    ".nupkg",
+    ".png",
+    ".rar",
+    ".tgz",
+    ".whl",
+    ".xlsx",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+
+TAR_BLOCK_SIZE: Bytes = tarfile.BLOCKSIZE
+TAR_RECORD_SIZE: Bytes = tarfile.RECORDSIZE
+
+
+@dataclass
+class ArchiveEntry:
+    # Relative path within the archive, using forward slashes
+    name: str
+    verified_path: VerifiedPath
+
+
+class ArchiveBuffer:
+    """
+    An unseekable file which an archive is written to. The written data is
+    drained after each chunk is written, so that only a chunk's worth of
+    the archive is held in memory at a time.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_archive_entries(
+    directory_listing: ServerDirectoryListing, root_name: str
+) -> Iterator[ArchiveEntry]:
+    """
+    Yields every file and directory within the listed directory. Each path is
+    verified before it is archived, so that symlinks can not be used to read files
+    which could not otherwise be served. Directories are only visited once, to
+    avoid symlink loops.
+    """
+    try:
+        root_path = directory_listing.verify_path(directory_listing.local_path)
+    except InvalidFilePath:
+        return
+
+    visited_directories: Set[Tuple[int, int]] = set()
+    pending = [(root_name, root_path)]
+    while pending:
+        name, verified_path = pending.pop()
+        directory_key = (verified_path.stat.st_dev, verified_path.stat.st_ino)
+        if directory_key in visited_directories:
+            continue
+        visited_directories.add(directory_key)
+        yield ArchiveEntry(name=name, verified_path=verified_path)
+
+        try:
+            with os.scandir(verified_path.local_path) as entries:
+                child_names = sorted(entry.name for entry in entries)
+        except OSError:
+            logger.warning("Unable to archive %s", verified_path.local_path)
+            continue
+
+        child_directories = []
+        for child_name in child_names:
+            try:
+                child_path = directory_listing.verify_path(
+                    verified_path.local_path / child_name
+                )
+            except InvalidFilePath:
+                continue
+
+            entry = ArchiveEntry(name=f"{name}/{child_name}", verified_path=child_path)
+            if child_path.is_dir:
+                child_directories.append((entry.name, child_path))
+            elif child_path.is_file:
+                yield entry
+        pending.extend(reversed(child_directories))
+
+
+def as_tar_info(entry: ArchiveEntry) -> tarfile.TarInfo:
+    file_stat = entry.verified_path.stat
+    tar_info = tarfile.TarInfo(entry.name)
+    tar_info.mtime = int(file_stat.st_mtime)
+    tar_info.mode = stat.S_IMODE(file_stat.st_mode)
+    if entry.verified_path.is_dir:
+        tar_info.type = tarfile.DIRTYPE
+    else:
+        tar_info.type = tarfile.REGTYPE
+        tar_info.size = file_stat.st_size
+    return tar_info
+
+
+def as_zip_info(entry: ArchiveEntry) -> zipfile.ZipInfo:
+    file_stat = entry.verified_path.stat
+    # Zip timestamps can only represent the years 1980 to 2107
+    date_time = time.localtime(file_stat.st_mtime)[:6]
+    date_time = max((1980, 1, 1, 0, 0, 0), min(date_time, (2107, 12, 31, 23, 59, 58)))
+
+    if entry.verified_path.is_dir:
+        zip_info = zipfile.ZipInfo(f"{entry.name}/", date_time)
+        zip_info.external_attr = (file_stat.st_mode & 0xFFFF) << 16 | 0x10
+        return zip_info
+
+    zip_info = zipfile.ZipInfo(entry.name, date_time)
+    zip_info.external_attr = (file_stat.st_mode & 0xFFFF) << 16
+    # A known size allows zipfile to decide whether zip64 extensions are required
+    zip_info.file_size = file_stat.st_size
+    if Path(entry.name).suffix.lower() in COMPRESSED_EXTENSIONS:
+        zip_info.compress_type = zipfile.ZIP_STORED
+    else:
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+    return zip_info
+
+
+def iter_tar(entries: Iterator[ArchiveEntry]) -> Iterator[bytes]:
+    """
+    Writes a tar archive of the given entries. Each header is written by tarfile,
+    but the file contents are streamed in fixed size chunks rather than copied by
+    tarfile in one call.
+    """
+    written: Bytes = 0
+    for entry in entries:
+        tar_info = as_tar_info(entry)
+        if entry.verified_path.is_dir:
+            header = tar_info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            written += len(header)
+            yield header
+            continue
+
+        try:
+            file = entry.verified_path.open("rb")
+        except (InvalidFilePath, OSError):
+            logger.warning("Unable to archive %s", entry.verified_path.local_path)
+            continue
+
+        with file:
+            header = tar_info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            written += len(header)
+            yield header
+
+            # The header's size must be respected, even if the file has changed
+            remaining = tar_info.size
+            while remaining > 0:
+                chunk = file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+            while remaining > 0:
+                padding_size = min(CHUNK_SIZE, remaining)
+                remaining -= padding_size
+                yield bytes(padding_size)
+
+        padding = bytes(-tar_info.size % TAR_BLOCK_SIZE)
+        written += tar_info.size + len(padding)
+        yield padding
+
+    end_of_archive = bytes(2 * TAR_BLOCK_SIZE)
+    written += len(end_of_archive)
+    yield end_of_archive + bytes(-written % TAR_RECORD_SIZE)
+
+
+def iter_tar_gz(
+    entries: Iterator[ArchiveEntry], compression_level: int = 6
+) -> Iterator[bytes]:
+    # A window size of 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 31)
+    for chunk in iter_tar(entries):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_zip(entries: Iterator[ArchiveEntry]) -> Iterator[bytes]:
+    """
+    Writes a zip archive of the given entries. As the archive is written to an
+    unseekable buffer, zipfile writes each entry's sizes and checksum after its
+    contents - so the files are only read once.
+    """
+    buffer = ArchiveBuffer()
+    with zipfile.ZipFile(buffer, "w", allowZip64=True) as zip_file:
+        for entry in entries:
+            zip_info = as_zip_info(entry)
+            if entry.verified_path.is_dir:
+                zip_file.writestr(zip_info, b"")
+                yield buffer.drain()
+                continue
+
+            try:
+                file = entry.verified_path.open("rb")
+            except (InvalidFilePath, OSError):
+                logger.warning("Unable to archive %s", entry.verified_path.local_path)
+                continue
+
+            with file, zip_file.open(zip_info, "w") as zip_entry:
+                while True:
+                    chunk = file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    zip_entry.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def make_archive_response(
+    directory_listing: ServerDirectoryListing, archive_format: str
+) -> Response:
+    """
+    Streams an archive of the listed directory as it is built, without writing it
+    to disk first
+    """
+    root_name = (
+        Path(directory_listing.server_path).name
+        or directory_listing.local_path.name
+        or "files"
+    )
+    entries = iter_archive_entries(directory_listing, root_name)
+    if archive_format == "zip":
+        body = iter_zip(entries)
+    else:
+        body = iter_tar_gz(entries)
+
+    response = Response(body, mimetype=ARCHIVE_FORMATS[archive_format])
+    response.headers.set(
+        "Content-Disposition",
+        "attachment",
+        filename=f"{root_name}.{archive_format}",
+    )
+    return response
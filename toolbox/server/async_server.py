@@ -0,0 +1,664 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.utils import formatdate
+from http import HTTPStatus
+from typing import AsyncIterator, BinaryIO, Callable, List, Optional, Set, Tuple
+from urllib.parse import unquote_to_bytes, urlsplit
+import asyncio
+import contextvars
+import logging
+import signal
+import sys
+from .file_server import CHUNK_SIZE, Bytes
+from .request_handler import SENDFILE_ENVIRON_KEY
+
+logger = logging.getLogger(__name__)
+
+SERVER_SOFTWARE = "toolbox-async"
+DEFAULT_THREADS = 32
+MAX_HEADER_SIZE: Bytes = 64 * 1024
+MAX_HEADERS = 100
+
+# Seconds that an idle keep-alive connection is held open for
+KEEP_ALIVE_TIMEOUT = 75
+
+# Seconds to wait for the next part of a request body, while the application waits
+# for it on a pool thread
+REQUEST_BODY_TIMEOUT = 60
+
+# Seconds to wait for in-flight requests to complete when stopping the server
+SHUTDOWN_TIMEOUT = 30
+
+
+class RequestError(Exception):
+    def __init__(self, status: HTTPStatus):
+        super().__init__(f"{status.value} {status.phrase}")
+        self.status = status
+
+
+@dataclass
+class AsyncRequest:
+    method: str
+    target: str
+    version: str
+    headers: List[Tuple[str, str]]
+
+    @property
+    def request_line(self) -> str:
+        return f"{self.method} {self.target} {self.version}"
+
+    def get_header(self, name: str) -> Optional[str]:
+        name = name.lower()
+        for header_name, value in self.headers:
+            if header_name.lower() == name:
+                return value
+        return None
+
+
+class AsyncRequestBody:
+    """
+    The wsgi.input stream of a request. The body is received from the connection
+    only as the application reads it, so that it is never buffered in full, and
+    a request which is rejected without reading its body - i.e. with an invalid
+    upload token - does not have to be received.
+
+    The stream is read from the thread pool, and each read waits for the event
+    loop to receive the next part of the body.
+    """
+
+    def __init__(
+        self,
+        connection: "AsyncConnection",
+        chunks: Optional[AsyncIterator[bytes]],
+        content_length: Optional[Bytes],
+        max_size: Optional[Bytes],
+        send_continue: bool,
+    ):
+        self.connection = connection
+        self.content_length = content_length
+        self.max_size = max_size
+        self.size: Bytes = 0
+        self.is_complete = chunks is None or content_length == 0
+        self.error: Optional[BaseException] = None
+        self._chunks = chunks
+        self._send_continue = send_continue
+        self._buffer = b""
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(CHUNK_SIZE), b""))
+
+        if not self._buffer and not self.is_complete:
+            self._buffer = self._receive()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size: Optional[int] = -1) -> bytes:
+        line = b""
+        while size is None or size < 0 or len(line) < size:
+            limit = CHUNK_SIZE if size is None or size < 0 else size - len(line)
+            if not self._buffer and not self.is_complete:
+                self._buffer = self._receive()
+            if not self._buffer:
+                break
+            end = self._buffer.find(b"\n", 0, limit) + 1 or limit
+            line += self._buffer[:end]
+            self._buffer = self._buffer[end:]
+            if line.endswith(b"\n"):
+                break
+        return line
+
+    def readlines(self, hint: Optional[int] = -1) -> List[bytes]:
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def _receive(self) -> bytes:
+        if self.error is not None:
+            raise self.error
+        future = asyncio.run_coroutine_threadsafe(
+            self._receive_chunk(), self.connection.loop
+        )
+        try:
+            return future.result()
+        except BaseException as e:
+            # Checked once the application has returned, in case it handled the
+            # error itself
+            self.error = e
+            raise
+
+    async def _receive_chunk(self) -> bytes:
+        if self._send_continue:
+            self._send_continue = False
+            self.connection.writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await self.connection.writer.drain()
+
+        try:
+            chunk = await asyncio.wait_for(
+                self._chunks.__anext__(), REQUEST_BODY_TIMEOUT
+            )
+        except StopAsyncIteration:
+            self.is_complete = True
+            return b""
+
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        if self.content_length is not None and self.size >= self.content_length:
+            self.is_complete = True
+        return chunk
+
+
+class AsyncWSGIServer:
+    """
+    An HTTP/1.1 server which handles connections with non-blocking socket I/O on an
+    asyncio event loop, so that slow or idle connections only cost a coroutine
+    rather than a thread.
+
+    The WSGI application and any blocking work - such as iterating the response
+    body or reading files - is run on a thread pool. Request bodies are streamed to
+    the application as it reads them, and file ranges which the application hands
+    to the SENDFILE_ENVIRON_KEY callable are sent from the event loop with sendfile.
+    """
+
+    def __init__(
+        self,
+        app,
+        host: str,
+        port: int,
+        threads: int = DEFAULT_THREADS,
+        max_request_body_size: Optional[Bytes] = None,
+    ):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.max_request_body_size = max_request_body_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="toolbox-async"
+        )
+        self.connections: Set["AsyncConnection"] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self._handle_connection,
+            self.host,
+            self.port,
+            limit=MAX_HEADER_SIZE,
+            reuse_address=True,
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Stops accepting new connections, and waits for in-flight requests to
+        complete. Idle keep-alive connections are closed immediately.
+        """
+        self.server.close()
+        for connection in list(self.connections):
+            connection.close_when_idle()
+
+        tasks = [connection.task for connection in self.connections]
+        if tasks:
+            _done, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def serve_until_stopped(
+        self, on_started: Optional[Callable[[int], None]] = None
+    ):
+        """
+        Serves until SIGTERM or SIGINT is received. The on_started callback is called
+        with the listening port once connections are being accepted.
+        """
+        await self.start()
+        if on_started is not None:
+            on_started(self.port)
+
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(stop_signal, stopped.set)
+            except NotImplementedError:
+                # Windows event loops do not support signal handlers
+                pass
+
+        try:
+            await stopped.wait()
+        finally:
+            await self.stop()
+
+    async def _handle_connection(self, reader, writer):
+        connection = AsyncConnection(self, reader, writer)
+        self.connections.add(connection)
+        try:
+            await connection.serve()
+        finally:
+            self.connections.discard(connection)
+
+
+class AsyncConnection:
+    def __init__(self, server: AsyncWSGIServer, reader, writer):
+        self.server = server
+        self.reader: asyncio.StreamReader = reader
+        self.writer: asyncio.StreamWriter = writer
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        peername = writer.get_extra_info("peername") or ("", 0)
+        self.remote_addr = peername[0]
+        self.remote_port = peername[1]
+        self.is_idle = False
+        self.is_closing = False
+
+    def close_when_idle(self):
+        self.is_closing = True
+        if self.is_idle:
+            self.writer.close()
+
+    async def serve(self):
+        try:
+            while not self.is_closing:
+                self.is_idle = True
+                try:
+                    request = await asyncio.wait_for(
+                        self._read_request_head(), KEEP_ALIVE_TIMEOUT
+                    )
+                finally:
+                    self.is_idle = False
+
+                if request is None or not await self._handle_request(request):
+                    break
+        except RequestError as e:
+            await self._send_error(e.status)
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writer.close()
+
+    async def _read_request_head(self) -> Optional[AsyncRequest]:
+        try:
+            head = await self.reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise RequestError(HTTPStatus.BAD_REQUEST)
+            return None
+        except asyncio.LimitOverrunError:
+            raise RequestError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+        lines = head.decode("latin-1").lstrip("\r\n").split("\r\n")
+        request_line = lines[0].split(" ")
+        if len(request_line) != 3:
+            raise RequestError(HTTPStatus.BAD_REQUEST)
+
+        method, target, version = request_line
+        if version not in ("HTTP/1.0", "HTTP/1.1"):
+            raise RequestError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+
+        headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, separator, value = line.partition(":")
+            if not separator or not name or name != name.strip():
+                raise RequestError(HTTPStatus.BAD_REQUEST)
+            headers.append((name, value.strip()))
+
+        if len(headers) > MAX_HEADERS:
+            raise RequestError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+        return AsyncRequest(
+            method=method, target=target, version=version, headers=headers
+        )
+
+    async def _handle_request(self, request: AsyncRequest) -> bool:
+        """
+        Responds to the given request, returning True if the connection can be
+        used for further requests
+        """
+        connection_header = (request.get_header("Connection") or "").lower()
+        if request.version == "HTTP/1.1":
+            keep_alive = "close" not in connection_header
+        else:
+            keep_alive = "keep-alive" in connection_header
+
+        body = self._make_body(request)
+        response = AsyncResponse(self, request, body, keep_alive=keep_alive)
+        try:
+            environ = self._make_environ(request, body, response)
+            await self._run_app(environ, response)
+        except RequestError as e:
+            if not response.headers_sent:
+                await self._send_error(e.status)
+            return False
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return False
+        except Exception:
+            logger.exception("Error handling request %s", request.request_line)
+            if not response.headers_sent:
+                await self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+            return False
+
+        # Any unread part of the body would be read as the next request
+        return response.keep_alive and body.is_complete and not self.is_closing
+
+    def _make_body(self, request: AsyncRequest) -> AsyncRequestBody:
+        transfer_encoding = request.get_header("Transfer-Encoding")
+        content_length = request.get_header("Content-Length")
+        max_size = self.server.max_request_body_size
+
+        length = None
+        if transfer_encoding is not None:
+            if transfer_encoding.lower() != "chunked":
+                raise RequestError(HTTPStatus.NOT_IMPLEMENTED)
+            chunks = self._read_chunked_body()
+        elif content_length is not None:
+            try:
+                length = int(content_length)
+            except ValueError:
+                raise RequestError(HTTPStatus.BAD_REQUEST)
+            if length < 0:
+                raise RequestError(HTTPStatus.BAD_REQUEST)
+            if max_size is not None and length > max_size:
+                raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            chunks = self._read_sized_body(length)
+        else:
+            chunks = None
+
+        expect = request.get_header("Expect")
+        return AsyncRequestBody(
+            self,
+            chunks,
+            content_length=length,
+            max_size=max_size,
+            send_continue=(
+                request.version == "HTTP/1.1"
+                and (expect or "").lower() == "100-continue"
+            ),
+        )
+
+    async def _read_sized_body(self, length: Bytes) -> AsyncIterator[bytes]:
+        remaining = length
+        while remaining > 0:
+            chunk = await self.reader.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(chunk)
+            yield chunk
+
+    async def _read_chunked_body(self) -> AsyncIterator[bytes]:
+        while True:
+            size_line = await self.reader.readline()
+            try:
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise RequestError(HTTPStatus.BAD_REQUEST)
+            if size < 0:
+                raise RequestError(HTTPStatus.BAD_REQUEST)
+
+            if size == 0:
+                # Skip any trailer headers
+                while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+
+            async for chunk in self._read_sized_body(size):
+                yield chunk
+
+            if (await self.reader.readline()) not in (b"\r\n", b"\n"):
+                raise RequestError(HTTPStatus.BAD_REQUEST)
+
+    def _make_environ(
+        self,
+        request: AsyncRequest,
+        body: AsyncRequestBody,
+        response: "AsyncResponse",
+    ):
+        path, _, query = request.target.partition("?")
+        if not path.startswith("/"):
+            url = urlsplit(request.target)
+            path, query = url.path or "/", url.query
+
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "REQUEST_URI": request.target,
+            "RAW_URI": request.target,
+            "SERVER_NAME": self.server.host,
+            "SERVER_PORT": str(self.server.port),
+            "SERVER_PROTOCOL": request.version,
+            "SERVER_SOFTWARE": SERVER_SOFTWARE,
+            "REMOTE_ADDR": self.remote_addr,
+            "REMOTE_PORT": self.remote_port,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            # The body stream ends with the request body, including chunked bodies
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            SENDFILE_ENVIRON_KEY: response.sendfile,
+        }
+
+        for name, value in request.headers:
+            key = name.upper().replace("-", "_")
+            # Chunked bodies are decoded as they are read
+            if key == "TRANSFER_ENCODING":
+                continue
+            if key != "CONTENT_TYPE":
+                key = f"HTTP_{key}"
+            if key in environ:
+                environ[key] = f"{environ[key]},{value}"
+            else:
+                environ[key] = value
+
+        return environ
+
+    async def _run_app(self, environ, response: "AsyncResponse"):
+        executor = self.server.executor
+        # The application and its response iterator can run on different pool
+        # threads, but must share context variables - i.e. so that streamed
+        # responses keep Flask's request context
+        context = contextvars.Context()
+        app_iter = await self.loop.run_in_executor(
+            executor, context.run, self.server.app, environ, response.start_response
+        )
+        try:
+            # The application may have turned a failure to receive the body into
+            # an error response of its own
+            body = environ["wsgi.input"]
+            if body.error is not None:
+                raise body.error
+            iterator = iter(app_iter)
+            while True:
+                chunk = await self.loop.run_in_executor(
+                    executor, context.run, next, iterator, None
+                )
+                await response.flush_pending()
+                if chunk is None:
+                    break
+                if chunk:
+                    await response.write(chunk)
+            await response.finish()
+        finally:
+            if hasattr(app_iter, "close"):
+                await self.loop.run_in_executor(executor, context.run, app_iter.close)
+
+    async def _send_error(self, status: HTTPStatus):
+        body = f"{status.value} {status.phrase}\n".encode("ascii")
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+        try:
+            self.writer.write(head.encode("latin-1") + body)
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+
+class AsyncResponse:
+    """
+    Writes a WSGI application's response to the connection. The WSGI callables are
+    called from the thread pool, and only record what should be sent - which is
+    then written out from the event loop.
+    """
+
+    def __init__(
+        self,
+        connection: AsyncConnection,
+        request: AsyncRequest,
+        body: AsyncRequestBody,
+        keep_alive,
+    ):
+        self.connection = connection
+        self.writer = connection.writer
+        self.request = request
+        self.body = body
+        self.keep_alive = keep_alive
+        self.status: Optional[str] = None
+        self.headers: List[Tuple[str, str]] = []
+        self.headers_sent = False
+        self.has_body = True
+        self.is_chunked = False
+        self.bytes_sent: Bytes = 0
+        self.pending_writes: List[bytes] = []
+        self.pending_sendfiles: List[Tuple[BinaryIO, Bytes, Bytes]] = []
+
+    @property
+    def status_code(self) -> Optional[int]:
+        if self.status is None:
+            return None
+        return int(self.status.split(" ", 1)[0])
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self.headers_sent:
+            raise exc_info[1].with_traceback(exc_info[2])
+
+        self.status = status
+        self.headers = list(headers)
+        return self.pending_writes.append
+
+    def sendfile(self, file: BinaryIO, offset: Bytes, count: Bytes) -> Bytes:
+        self.pending_sendfiles.append((file, offset, count))
+        return count
+
+    async def flush_pending(self):
+        """
+        Sends any data which was passed to the WSGI write callable or the sendfile
+        callable while the application was producing its last chunk
+        """
+        pending_writes, self.pending_writes = self.pending_writes, []
+        for data in pending_writes:
+            await self.write(data)
+
+        pending_sendfiles, self.pending_sendfiles = self.pending_sendfiles, []
+        for file, offset, count in pending_sendfiles:
+            await self._send_headers()
+            if not self.has_body or count == 0:
+                continue
+            if self.is_chunked:
+                self.writer.write(b"%x\r\n" % count)
+            await self.writer.drain()
+            await self.connection.loop.sendfile(
+                self.writer.transport, file, offset, count
+            )
+            if self.is_chunked:
+                self.writer.write(b"\r\n")
+            self.bytes_sent += count
+
+    async def write(self, data: bytes):
+        await self._send_headers()
+        if not self.has_body:
+            return
+
+        self.bytes_sent += len(data)
+        if self.is_chunked:
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def finish(self):
+        await self._send_headers()
+        if self.is_chunked:
+            self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+    async def _send_headers(self):
+        if self.headers_sent:
+            return
+        if self.status is None:
+            raise RuntimeError("The application did not call start_response")
+
+        status_code = self.status_code
+        header_names = {name.lower() for name, _value in self.headers}
+        self.has_body = (
+            self.request.method != "HEAD"
+            and status_code >= HTTPStatus.OK
+            and status_code not in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED)
+        )
+
+        # The connection is closed rather than reading a body which the application
+        # did not read
+        if not self.body.is_complete:
+            self.keep_alive = False
+
+        headers = list(self.headers)
+        if self.has_body and "content-length" not in header_names:
+            if self.request.version == "HTTP/1.1":
+                self.is_chunked = True
+                headers.append(("Transfer-Encoding", "chunked"))
+            else:
+                # The end of the body can only be signaled by closing the connection
+                self.keep_alive = False
+
+        if not self.keep_alive:
+            headers.append(("Connection", "close"))
+        elif self.request.version == "HTTP/1.0":
+            headers.append(("Connection", "keep-alive"))
+        if "date" not in header_names:
+            headers.append(("Date", formatdate(usegmt=True)))
+        if "server" not in header_names:
+            headers.append(("Server", SERVER_SOFTWARE))
+
+        lines = [f"HTTP/1.1 {self.status}"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        self.headers_sent = True
+
+
+def serve_async(
+    app,
+    host: str,
+    port: int,
+    threads: int = DEFAULT_THREADS,
+    max_request_body_size: Optional[Bytes] = None,
+):
+    """
+    Serves the given WSGI application with the asyncio server until SIGTERM or
+    SIGINT is received
+    """
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
+    if not logger.hasHandlers():
+        logger.addHandler(logging.StreamHandler())
+
+    server = AsyncWSGIServer(
+        app,
+        host,
+        port,
+        threads=threads,
+        max_request_body_size=max_request_body_size,
+    )
+    asyncio.run(server.serve_until_stopped())
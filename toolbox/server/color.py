@@ -2,3 +2,11 @@ class Color:
     @classmethod
     def green(self, s: str) -> str:
         return f"\033[32m{s}\x1b[0m"
+
+    @classmethod
+    def yellow(self, s: str) -> str:
+        return f"\033[33m{s}\x1b[0m"
+
+    @classmethod
+    def red(self, s: str) -> str:
+        return f"\033[31m{s}\x1b[0m"
@@ -1,5 +1,16 @@
-from contextlib import contextmanager
 from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+import errno
+import os
+import shutil
+import tempfile
+
+# Files which are still being uploaded are never served, listed or searched
+UPLOAD_FILE_PREFIX = ".upload-"
+
+
+def is_upload_file(name: str) -> bool:
+    return name.startswith(UPLOAD_FILE_PREFIX)
 
 
 class InvalidFilePath(Exception):
@@ -10,6 +21,47 @@ class InvalidFilePermissions(Exception):
     pass
 
 
+class VerifiedPath:
+    """
+    A resolved path which has been verified to exist within an allowed directory,
+    alongside its stat. The path is only opened when its contents are needed, at
+    which point the opened file must still be the same file that was verified -
+    so that it can not be swapped out between being checked and being opened.
+    """
+
+    def __init__(self, local_path: Path, stat: os.stat_result):
+        self.local_path = local_path
+        self.stat = stat
+
+    @property
+    def is_file(self) -> bool:
+        return S_ISREG(self.stat.st_mode)
+
+    @property
+    def is_dir(self) -> bool:
+        return S_ISDIR(self.stat.st_mode)
+
+    def open(self, mode="rb"):
+        if mode not in ("r", "rb"):
+            raise InvalidFilePermissions
+
+        # The verified path is already resolved, so it should never be a symlink
+        flags = os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0) | getattr(os, "O_CLOEXEC", 0)
+        try:
+            fd = os.open(self.local_path, flags)
+        except OSError as e:
+            raise InvalidFilePath from e
+
+        try:
+            stat = os.fstat(fd)
+            if (stat.st_dev, stat.st_ino) != (self.stat.st_dev, self.stat.st_ino):
+                raise InvalidFilePath
+            return os.fdopen(fd, mode)
+        except Exception:
+            os.close(fd)
+            raise
+
+
 class FileManager:
     """
     A file manager that can read and write files. Ensures that no
@@ -22,15 +74,66 @@ class FileManager:
         self.root_user_directory = Path(root_user_directory)
         self.root_toolbox_directory = Path(root_toolbox_directory)
 
-    @contextmanager
     def open_user_file(self, path, mode):
+        """
+        Opens a user file. The returned file object can be used as a context
+        manager, or handed off to a response stream which will close it
+        """
         if not self.is_allowed_user_file_path(path):
             raise InvalidFilePath
 
-        with open(path, mode) as f:
-            yield f
+        return open(path, mode)
+
+    def create_user_temporary_file(self):
+        """
+        Creates a temporary file within the user directory, which can later be
+        atomically renamed with replace_user_file. The caller is responsible for
+        removing the file if it is not renamed.
+        """
+        return tempfile.NamedTemporaryFile(
+            mode="w+b",
+            dir=self.root_user_directory,
+            prefix=UPLOAD_FILE_PREFIX,
+            delete=False,
+        )
+
+    def replace_user_file(self, source_path, destination_path):
+        if not (
+            self.is_allowed_user_file_path(source_path)
+            and self.is_allowed_user_file_path(destination_path)
+        ):
+            raise InvalidFilePath
+
+        os.replace(source_path, destination_path)
+
+    def move_into_user_directory(self, source_path, destination_path):
+        """
+        Moves a file from outside of the user directory into it, replacing the
+        destination atomically. Files on another file system are first copied into
+        a temporary file within the user directory.
+        """
+        if not self.is_allowed_user_file_path(destination_path):
+            raise InvalidFilePath
+
+        try:
+            os.replace(source_path, destination_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        with open(source_path, "rb") as source:
+            with self.create_user_temporary_file() as temporary_file:
+                try:
+                    shutil.copyfileobj(source, temporary_file)
+                    temporary_file.close()
+                    os.replace(temporary_file.name, destination_path)
+                except BaseException:
+                    # Upload files are hidden, and would otherwise never be removed
+                    os.unlink(temporary_file.name)
+                    raise
+        os.unlink(source_path)
 
-    @contextmanager
     def open_toolbox_file(self, path, mode="r"):
         if not self.is_allowed_toolbox_file_path(path):
             raise InvalidFilePath
@@ -38,8 +141,37 @@ class FileManager:
         if not (mode == "r" or "rb"):
             raise InvalidFilePermissions
 
-        with open(path, mode) as f:
-            yield f
+        return open(path, mode)
+
+    def verify_user_path(self, path) -> VerifiedPath:
+        """
+        Resolves and stats the given path once, raising InvalidFilePath if it does
+        not exist within the user directory, or is a file which is still being
+        uploaded
+        """
+        verified_path = self._verify_path(path, self.root_user_directory)
+        if is_upload_file(verified_path.local_path.name):
+            raise InvalidFilePath
+        return verified_path
+
+    def verify_toolbox_path(self, path) -> VerifiedPath:
+        """
+        Resolves and stats the given path once, raising InvalidFilePath if it does
+        not exist within the toolbox directory
+        """
+        return self._verify_path(path, self.root_toolbox_directory)
+
+    def _verify_path(self, path, root_directory: Path) -> VerifiedPath:
+        local_path = Path(path).resolve()
+        if not (root_directory in local_path.parents or root_directory == local_path):
+            raise InvalidFilePath
+
+        try:
+            stat = local_path.stat()
+        except OSError as e:
+            raise InvalidFilePath from e
+
+        return VerifiedPath(local_path, stat)
 
     def is_allowed_user_file_path(self, local_path):
         return (
@@ -0,0 +1,290 @@
+from dataclasses import dataclass
+from flask import Request, Response, current_app
+from http import HTTPStatus
+from werkzeug.http import is_resource_modified, unquote_etag
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional, Union
+import secrets
+from .file_server import CHUNK_SIZE, Bytes, ServerFileResult
+from .metrics import ToolboxMetrics
+from .request_handler import SENDFILE_ENVIRON_KEY, call_on_close
+
+CONTENT_TYPE = "text/html; charset=utf-8"
+
+# Guard against clients requesting an excessive amount of small ranges,
+# which would be more expensive to serve than the full file
+MAX_RANGES = 16
+
+
+@dataclass
+class ByteRange:
+    start: Bytes
+    # Exclusive
+    stop: Bytes
+
+    @property
+    def length(self) -> Bytes:
+        return self.stop - self.start
+
+    def content_range(self, size: Bytes) -> str:
+        return f"bytes {self.start}-{self.stop - 1}/{size}"
+
+
+FileStreamPart = Union[bytes, ByteRange]
+Sendfile = Callable[[BinaryIO, Bytes, Bytes], Bytes]
+
+
+class FileStream:
+    """
+    Streams the given parts of a file in fixed size chunks. Each part is
+    either a byte range of the file to send, or raw bytes to send as-is - such
+    as multipart boundaries. The file is closed when the stream is closed.
+
+    If the server provides a sendfile callable, byte ranges are handed to it
+    directly instead of being read into memory.
+
+    When metrics are given, the stream is counted as an active file transfer until
+    it is closed, and the file contents sent are counted.
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        parts: List[FileStreamPart],
+        chunk_size: Bytes = CHUNK_SIZE,
+        sendfile: Optional[Sendfile] = None,
+        metrics: Optional[ToolboxMetrics] = None,
+    ):
+        self.file = file
+        self.parts = parts
+        self.chunk_size = chunk_size
+        self.sendfile = sendfile
+        self.metrics = metrics
+        self.is_transferring = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self.metrics is not None and not self.is_transferring:
+            self.is_transferring = True
+            self.metrics.start_file_transfer()
+
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+
+            if self.sendfile is not None:
+                # The server writes out the response headers and any previous parts
+                # when it is given a chunk, which must happen before the file contents
+                # are written directly to the socket
+                yield b""
+                sent = self.sendfile(self.file, part.start, part.length)
+                if self.metrics is not None:
+                    self.metrics.record_file_bytes_sent(sent)
+                continue
+
+            self.file.seek(part.start)
+            remaining = part.length
+            while remaining > 0:
+                chunk = self.file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if self.metrics is not None:
+                    self.metrics.record_file_bytes_sent(len(chunk))
+                yield chunk
+
+    def close(self):
+        if self.is_transferring:
+            self.is_transferring = False
+            self.metrics.finish_file_transfer()
+        self.file.close()
+
+
+def make_file_response(
+    request: Request,
+    file_result: ServerFileResult,
+    metrics: Optional[ToolboxMetrics] = None,
+) -> Response:
+    """
+    Creates a streamed response for the given file, honoring the conditional
+    request headers as well as the Range and If-Range request headers
+    """
+    if is_not_modified(request, file_result.etag, file_result.modified_at):
+        response = make_not_modified_response(file_result.etag)
+        response.last_modified = file_result.modified_at
+        return response
+
+    size = file_result.size
+    byte_ranges = _get_requested_byte_ranges(request, file_result)
+
+    if byte_ranges is None:
+        response = _make_response(
+            request, file_result, [ByteRange(0, size)], HTTPStatus.OK, size, metrics
+        )
+        response.headers["Content-Type"] = CONTENT_TYPE
+    elif len(byte_ranges) == 0:
+        response = current_app.response_class(
+            status=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+        )
+        response.headers["Content-Range"] = f"bytes */{size}"
+    elif len(byte_ranges) == 1:
+        byte_range = byte_ranges[0]
+        response = _make_response(
+            request,
+            file_result,
+            byte_ranges,
+            HTTPStatus.PARTIAL_CONTENT,
+            byte_range.length,
+            metrics,
+        )
+        response.headers["Content-Type"] = CONTENT_TYPE
+        response.headers["Content-Range"] = byte_range.content_range(size)
+    else:
+        boundary = secrets.token_hex(16)
+        parts = []
+        for byte_range in byte_ranges:
+            parts.append(
+                (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {CONTENT_TYPE}\r\n"
+                    f"Content-Range: {byte_range.content_range(size)}\r\n"
+                    "\r\n"
+                ).encode("ascii")
+            )
+            parts.append(byte_range)
+            parts.append(b"\r\n")
+        parts.append(f"--{boundary}--\r\n".encode("ascii"))
+
+        content_length = sum(
+            len(part) if isinstance(part, bytes) else part.length for part in parts
+        )
+        response = _make_response(
+            request,
+            file_result,
+            parts,
+            HTTPStatus.PARTIAL_CONTENT,
+            content_length,
+            metrics,
+        )
+        response.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+
+    response.accept_ranges = "bytes"
+    response.set_etag(file_result.etag)
+    response.last_modified = file_result.modified_at
+    # Allow clients to cache the file, but always revalidate it first
+    response.cache_control.no_cache = True
+    return response
+
+
+def is_not_modified(request: Request, etag: str, last_modified=None) -> bool:
+    """
+    Returns True if the client's cached copy matches the given validators,
+    via If-None-Match or If-Modified-Since
+    """
+    if request.method not in ("GET", "HEAD"):
+        return False
+
+    return not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    )
+
+
+def make_not_modified_response(etag: str, weak: bool = False) -> Response:
+    response = current_app.response_class(status=HTTPStatus.NOT_MODIFIED)
+    response.set_etag(etag, weak=weak)
+    response.cache_control.no_cache = True
+    return response
+
+
+def _make_response(
+    request: Request,
+    file_result: ServerFileResult,
+    parts: List[FileStreamPart],
+    status: HTTPStatus,
+    content_length: Bytes,
+    metrics: Optional[ToolboxMetrics] = None,
+) -> Response:
+    response = current_app.response_class(
+        _make_body(request.environ, file_result, parts, metrics),
+        status=status,
+        direct_passthrough=True,
+    )
+    response.content_length = content_length
+    return response
+
+
+def _make_body(
+    environ,
+    file_result: ServerFileResult,
+    parts: List[FileStreamPart],
+    metrics: Optional[ToolboxMetrics] = None,
+) -> Iterable[bytes]:
+    """
+    Prefers zero-copy file sending where the server supports it, falling
+    back to reading the file in chunks
+    """
+    file = file_result.open_file()
+    sendfile = environ.get(SENDFILE_ENVIRON_KEY)
+    if sendfile is not None:
+        return FileStream(file, parts, sendfile=sendfile, metrics=metrics)
+
+    # The standard WSGI file wrapper can only send a file from its current position
+    # until the end of the file. The server sends the file itself, so the file is
+    # counted as sent once the server has closed it.
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    is_full_file = parts == [ByteRange(0, file_result.size)]
+    if file_wrapper is not None and is_full_file:
+        body = file_wrapper(file, CHUNK_SIZE)
+        if metrics is None:
+            return body
+
+        def finish_file_transfer():
+            metrics.finish_file_transfer()
+            metrics.record_file_bytes_sent(file_result.size)
+
+        metrics.start_file_transfer()
+        return call_on_close(environ, body, finish_file_transfer)
+
+    return FileStream(file, parts, metrics=metrics)
+
+
+def _get_requested_byte_ranges(
+    request: Request, file_result: ServerFileResult
+) -> Optional[List[ByteRange]]:
+    """
+    Returns the satisfiable byte ranges requested by the client. None is
+    returned if the full file should be sent instead, and an empty list if
+    none of the requested ranges can be satisfied.
+    """
+    requested_range = request.range
+    if requested_range is None or requested_range.units != "bytes":
+        return None
+
+    if len(requested_range.ranges) > MAX_RANGES:
+        return None
+
+    if "If-Range" in request.headers and not _if_range_matches(request, file_result):
+        return None
+
+    size = file_result.size
+    byte_ranges = []
+    for start, stop in requested_range.ranges:
+        if start < 0:
+            start = max(size + start, 0)
+            stop = size
+        elif stop is None or stop > size:
+            stop = size
+
+        if start < stop:
+            byte_ranges.append(ByteRange(start, stop))
+
+    return byte_ranges
+
+
+def _if_range_matches(request: Request, file_result: ServerFileResult) -> bool:
+    if_range = request.if_range
+    if if_range.date is not None:
+        return if_range.date == file_result.modified_at
+
+    # If-Range requires a strong comparison, and weak entity tags never match
+    etag, is_weak = unquote_etag(request.headers["If-Range"])
+    return not is_weak and etag == file_result.etag
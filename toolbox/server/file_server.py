@@ -13,17 +13,35 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 import json
+import os
 from pathlib import Path
-from typing import List, Mapping, Union
+from typing import Any, BinaryIO, Callable, Dict, List, Mapping, Tuple, Union
+from functools import partial
+from collections import OrderedDict
+from stat import S_ISDIR, S_ISREG
+import logging
+import threading
+import time
 from .payload_generator import PayloadGenerator
-from .file_manager import FileManager
-from datetime import datetime
+from .file_manager import FileManager, InvalidFilePath, VerifiedPath, is_upload_file
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
 
 ServerPath = str
 LocalPath = Path
 ServerPathMap = Mapping[ServerPath, LocalPath]
 Bytes = int
 
+# Files are streamed to the client in fixed size chunks, so that memory usage stays
+# flat regardless of file size or the number of concurrent downloads
+CHUNK_SIZE: Bytes = 64 * 1024
+
+# Directory listings are rendered one page at a time, so that the time and memory
+# needed to render a page does not grow with the size of the directory
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
 
 @dataclass
 class ServerDirectoryItem:
@@ -45,12 +63,56 @@ class ServerDirectoryListing:
     user_files: List[ServerDirectoryItem]
     toolbox_files: List[ServerDirectoryItem]
     server_path: ServerPath
+    # A validator which changes whenever the directory contents change
+    etag: str
+    # Resolved
+    local_path: LocalPath
+    # Verifies that a path within the directory may be served, i.e. when archiving
+    verify_path: Callable[[LocalPath], VerifiedPath]
+
+
+@dataclass
+class ServerDirectoryPage:
+    """
+    A window of an already sorted directory listing
+    """
+
+    files: List[ServerDirectoryItem]
+    offset: int
+    limit: int
+    total: int
+
+    @property
+    def previous_offset(self) -> Optional[int]:
+        if self.offset == 0:
+            return None
+        return max(0, self.offset - self.limit)
+
+    @property
+    def next_offset(self) -> Optional[int]:
+        next_offset = self.offset + self.limit
+        if next_offset >= self.total:
+            return None
+        return next_offset
+
+    @property
+    def is_partial(self) -> bool:
+        return self.previous_offset is not None or self.next_offset is not None
 
 
 @dataclass
 class ServerFileResult:
+    """
+    A file ready to be streamed to the client. The file is only opened when
+    its contents are required, and the consumer is responsible for closing it.
+    """
+
     local_path: LocalPath
-    content: bytes
+    size: Bytes
+    modified_at: datetime
+    # A strong validator which changes whenever the file is replaced or modified
+    etag: str
+    open_file: Callable[[], BinaryIO]
 
 
 ServerResponse = Union[ServerInvalidFilePath, ServerDirectoryListing, ServerFileResult]
@@ -63,11 +125,244 @@ def as_server_directory_item(server_path, local_path) -> ServerDirectoryItem:
         name=Path(server_path).name,
         modified_at=datetime.fromtimestamp(stat.st_mtime),
         size=stat.st_size,
-        is_dir=local_path.is_dir(),
-        is_file=local_path.is_file(),
+        is_dir=S_ISDIR(stat.st_mode),
+        is_file=S_ISREG(stat.st_mode),
+    )
+
+
+def directory_item_sort_key(file: ServerDirectoryItem) -> Tuple[bool, str, str]:
+    """
+    Listings show directories first, then files, by name. The server path makes
+    the order unique, even if several toolbox entries share a name.
+    """
+    return (file.is_file, file.name, file.server_path)
+
+
+def as_server_file_result(local_path, stat, open_file) -> ServerFileResult:
+    return ServerFileResult(
+        local_path=local_path,
+        size=stat.st_size,
+        # HTTP dates have a resolution of seconds
+        modified_at=datetime.fromtimestamp(int(stat.st_mtime), timezone.utc),
+        etag=f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}",
+        open_file=open_file,
     )
 
 
+def as_directory_etag(stat) -> str:
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}"
+
+
+def as_server_directory_item_from_entry(server_path, entry) -> ServerDirectoryItem:
+    """
+    Creates a directory item from an os.DirEntry, which already knows its file
+    type without additional system calls
+    """
+    try:
+        stat = entry.stat()
+    except FileNotFoundError:
+        # Broken symlinks are listed as the link itself
+        stat = entry.stat(follow_symlinks=False)
+
+    return ServerDirectoryItem(
+        server_path=server_path,
+        name=entry.name,
+        modified_at=datetime.fromtimestamp(stat.st_mtime),
+        size=stat.st_size,
+        is_dir=entry.is_dir(),
+        is_file=entry.is_file(),
+    )
+
+
+def paginate(
+    files: List[ServerDirectoryItem], offset: int, limit: int
+) -> ServerDirectoryPage:
+    """
+    Returns the requested page of the given listing. Out of range values are clamped,
+    so that stale pagination links still show a page rather than an error.
+    """
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    offset = min(max(offset, 0), max(len(files) - 1, 0))
+    return ServerDirectoryPage(
+        files=files[offset : offset + limit],
+        offset=offset,
+        limit=limit,
+        total=len(files),
+    )
+
+
+def list_directory(
+    local_path: LocalPath, calculate_file_server_path_func
+) -> List[ServerDirectoryItem]:
+    files = []
+    with os.scandir(local_path) as entries:
+        for entry in entries:
+            if is_upload_file(entry.name):
+                continue
+            try:
+                item = as_server_directory_item_from_entry(
+                    server_path=calculate_file_server_path_func(Path(entry.path)),
+                    entry=entry,
+                )
+            except FileNotFoundError:
+                # The entry was removed or renamed after the directory was read
+                continue
+            files.append(item)
+    files.sort(key=directory_item_sort_key)
+    return files
+
+
+class DirectoryListingCache:
+    """
+    A least recently used cache of directory listings. A cached listing is reused
+    until its directory's modification time changes, which happens whenever an
+    entry is added, removed or renamed.
+    """
+
+    # Directories modified this recently may be modified again within the same
+    # timestamp resolution, and are not cached
+    MIN_AGE_NS = 1_000_000_000
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._listings: OrderedDict = OrderedDict()
+
+    def get_listing(
+        self,
+        local_path: LocalPath,
+        server_path: ServerPath,
+        directory_stat,
+        calculate_file_server_path_func,
+    ) -> List[ServerDirectoryItem]:
+        key = (local_path, server_path.rstrip("/"))
+        modified_at = directory_stat.st_mtime_ns
+
+        with self._lock:
+            cached = self._listings.get(key)
+            if cached is not None and cached[0] == modified_at:
+                self._listings.move_to_end(key)
+                return cached[1]
+
+        files = list_directory(local_path, calculate_file_server_path_func)
+        if time.time_ns() - modified_at < self.MIN_AGE_NS:
+            return files
+
+        with self._lock:
+            self._listings[key] = (modified_at, files)
+            self._listings.move_to_end(key)
+            while len(self._listings) > self.max_size:
+                self._listings.popitem(last=False)
+        return files
+
+
+class ToolboxFileIndex:
+    """
+    An in-memory index of the configured toolbox files, so that listing them
+    requires no filesystem calls. Once the index is older than the refresh
+    interval, it is refreshed in a background thread while the existing index
+    continues to be served.
+    """
+
+    REFRESH_INTERVAL_SECONDS = 30
+
+    def __init__(
+        self,
+        server_files: ServerPathMap,
+        refresh_interval: float = REFRESH_INTERVAL_SECONDS,
+    ):
+        self.server_files = server_files
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._is_refreshing = False
+        self._files: List[ServerDirectoryItem] = []
+        self._indexed_at = 0.0
+        self.refresh()
+
+    @property
+    def files(self) -> List[ServerDirectoryItem]:
+        is_stale = time.monotonic() - self._indexed_at > self.refresh_interval
+        if is_stale:
+            with self._lock:
+                should_refresh = not self._is_refreshing
+                self._is_refreshing = True
+            if should_refresh:
+                threading.Thread(
+                    target=self.refresh, name="toolbox-file-index", daemon=True
+                ).start()
+
+        return self._files
+
+    def refresh(self):
+        try:
+            files = []
+            for server_path, local_path in self.server_files.items():
+                try:
+                    files.append(
+                        as_server_directory_item(
+                            server_path=server_path, local_path=local_path
+                        )
+                    )
+                except FileNotFoundError:
+                    logger.warning("Toolbox file %s no longer exists", local_path)
+            files.sort(key=directory_item_sort_key)
+
+            self._files = files
+            self._indexed_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._is_refreshing = False
+
+
+@dataclass
+class ServerMount:
+    server_path: ServerPath
+    # Resolved
+    local_path: LocalPath
+
+
+@dataclass
+class PathTrieNode:
+    children: Dict[str, "PathTrieNode"]
+    value: Optional[Any] = None
+
+
+class PathTrie:
+    """
+    Maps paths, as sequences of path segments, to values. The value of the longest
+    matching path prefix is found with a single walk over the path's segments,
+    regardless of how many paths have been inserted.
+    """
+
+    def __init__(self):
+        self.root = PathTrieNode(children={})
+
+    def insert(self, parts: List[str], value: Any):
+        node = self.root
+        for part in parts:
+            node = node.children.setdefault(part, PathTrieNode(children={}))
+        node.value = value
+
+    def longest_prefix(self, parts: List[str]) -> Optional[Tuple[Any, int]]:
+        """
+        Returns the value of the longest inserted path which prefixes the given
+        path, alongside the number of path segments that it matched
+        """
+        node = self.root
+        match = None if node.value is None else (node.value, 0)
+        for depth, part in enumerate(parts, start=1):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.value is not None:
+                match = (node.value, depth)
+        return match
+
+
+def as_server_path_parts(server_path: ServerPath) -> List[str]:
+    return [part for part in server_path.split("/") if part]
+
+
 class ServerConfig:
     def __init__(
         self, root_toolbox_directory: str, config_path: str, file_manager: FileManager
@@ -75,10 +370,50 @@ class ServerConfig:
         self.root_toolbox_directory = root_toolbox_directory
         self.file_manager: FileManager = file_manager
         self.server_files: ServerPathMap = self._parse_config(config_path)
+        self.toolbox_file_index = ToolboxFileIndex(self.server_files)
+
+        self.mounts: List[ServerMount] = []
+        self.server_path_trie = PathTrie()
+        self.local_path_trie = PathTrie()
+        for server_path, local_path in self.server_files.items():
+            mount = ServerMount(
+                server_path=server_path, local_path=local_path.resolve()
+            )
+            self.mounts.append(mount)
+            self.server_path_trie.insert(as_server_path_parts(server_path), mount)
+            self.local_path_trie.insert(list(mount.local_path.parts), mount)
 
     def get_local_path(self, server_path: ServerPath) -> Optional[LocalPath]:
         return self.server_files.get(server_path, None)
 
+    def find_mount(
+        self, server_path: ServerPath
+    ) -> Optional[Tuple[ServerMount, List[str]]]:
+        """
+        Returns the mount with the longest server path matching the start of the
+        given server path, alongside the remaining path segments within the mount.
+        This allows for nested mounts, such as /static and /static/linux.
+        """
+        parts = as_server_path_parts(server_path)
+        match = self.server_path_trie.longest_prefix(parts)
+        if match is None:
+            return None
+
+        mount, depth = match
+        return mount, parts[depth:]
+
+    def find_local_mount(self, local_path: LocalPath) -> Optional[ServerMount]:
+        """
+        Returns the most specific mount that the given resolved local path exists
+        within, or None if the local path is not within any mount
+        """
+        match = self.local_path_trie.longest_prefix(list(local_path.parts))
+        if match is None:
+            return None
+
+        mount, _depth = match
+        return mount
+
     def items(self):
         return self.server_files.items()
 
@@ -105,6 +440,49 @@ class ServerConfig:
         return server_files
 
 
+class ServerConfigCache:
+    """
+    Parses the server config once, and only parses it again when the config
+    file's modification time changes. If the updated config is invalid, the
+    previously parsed config continues to be used.
+    """
+
+    def __init__(
+        self, root_toolbox_directory: str, config_path: str, file_manager: FileManager
+    ):
+        self.root_toolbox_directory = root_toolbox_directory
+        self.config_path = Path(config_path)
+        self.file_manager = file_manager
+        self._lock = threading.Lock()
+        self._server_config: Optional[ServerConfig] = None
+        self._config_modified_at: Optional[int] = None
+
+    def get(self) -> ServerConfig:
+        config_modified_at = self.config_path.stat().st_mtime_ns
+        if config_modified_at == self._config_modified_at:
+            return self._server_config
+
+        with self._lock:
+            if config_modified_at != self._config_modified_at:
+                try:
+                    self._server_config = ServerConfig(
+                        root_toolbox_directory=self.root_toolbox_directory,
+                        config_path=self.config_path,
+                        file_manager=self.file_manager,
+                    )
+                except ValueError:
+                    if self._server_config is None:
+                        raise
+                    logger.exception("Ignoring invalid config %s", self.config_path)
+                self._config_modified_at = config_modified_at
+
+        return self._server_config
+
+
+def is_within_path(local_path: LocalPath, parent_path: LocalPath) -> bool:
+    return local_path == parent_path or parent_path in local_path.parents
+
+
 def removeprefix(self: str, prefix: str) -> str:
     if self.startswith(prefix):
         return self[len(prefix) :]
@@ -113,9 +491,14 @@ def removeprefix(self: str, prefix: str) -> str:
 
 
 class UserFileServer:
-    def __init__(self, server_config: ServerConfig):
+    def __init__(
+        self,
+        server_config: ServerConfig,
+        directory_listing_cache: Optional[DirectoryListingCache] = None,
+    ):
         self.server_config = server_config
         self.file_manager = server_config.file_manager
+        self.directory_listing_cache = directory_listing_cache
 
     def serve_user_file_or_folder(self, server_path: ServerPath):
         """
@@ -124,92 +507,91 @@ class UserFileServer:
         If the given file or folder does not exist, a 404 is returned
         """
         root_user_directory = Path(current_app.config["ROOT_USER_DIRECTORY"])
-        local_path = (root_user_directory / server_path).resolve()
+        try:
+            verified_path = self.file_manager.verify_user_path(
+                root_user_directory / server_path
+            )
+        except InvalidFilePath:
+            return ServerInvalidFilePath()
 
         def calculate_file_server_path_func(file_path: Path) -> ServerPath:
             return f"/{file_path.relative_to(root_user_directory).as_posix()}"
 
         return self._serve_file_or_folder(
-            local_path, server_path, calculate_file_server_path_func
+            verified_path, server_path, calculate_file_server_path_func
         )
 
     # TODO: Split out user / toolbox files, this does both currently
     def _serve_file_or_folder(
         self,
-        local_path: LocalPath,
+        verified_path: VerifiedPath,
         server_path: ServerPath,
         calculate_file_server_path_func,
     ) -> ServerResponse:
         """
         Attempts to serve the given file or directory to the user.
 
-        If the local_path is a file, it sends a file to the user.
-        If the local_path is a folder, it renders the directory contents
+        If the verified_path is a file, it sends a file to the user.
+        If the verified_path is a folder, it renders the directory contents
 
-        To guard against arbitrary reads - the local_path must exist within the
-        restrict_to_path argument, otherwise a ServerInvalidFilePath object is returned.
+        To guard against arbitrary reads - the path must have already been verified
+        by the file manager, which ensures that it exists within the allowed directory.
         """
-
-        valid_child_path = (
-            self.file_manager.is_allowed_user_file_path(local_path)
-        ) and local_path.exists()
-        if not valid_child_path:
-            return ServerInvalidFilePath()
-
-        if local_path.is_file():
-            return self._read_user_file(local_path)
-        elif local_path.is_dir():
-            files = []
-            for child_path in local_path.iterdir():
-                files.append(
-                    as_server_directory_item(
-                        server_path=calculate_file_server_path_func(child_path),
-                        local_path=child_path,
-                    )
-                )
-            files.sort(key=lambda file: (file.is_file, file.name))
+        if verified_path.is_file:
+            return self._read_user_file(verified_path)
+        elif verified_path.is_dir:
+            files = self._list_directory(
+                verified_path.local_path,
+                server_path,
+                verified_path.stat,
+                calculate_file_server_path_func,
+            )
 
             return ServerDirectoryListing(
                 user_files=files,
-                toolbox_files=self._get_toolbox_files(),
+                toolbox_files=self.server_config.toolbox_file_index.files,
                 server_path=server_path,
+                etag=as_directory_etag(verified_path.stat),
+                local_path=verified_path.local_path,
+                verify_path=self.file_manager.verify_user_path,
             )
         else:
             return ServerInvalidFilePath()
 
-    def _get_toolbox_files(self) -> List[ServerDirectoryItem]:
-        toolbox_files = []
-        for server_path, local_path in self.server_config.items():
-            toolbox_files.append(
-                as_server_directory_item(server_path=server_path, local_path=local_path)
-            )
-        toolbox_files.sort(key=lambda file: (file.is_file, file.name))
+    def _list_directory(
+        self,
+        local_path: LocalPath,
+        server_path: ServerPath,
+        directory_stat,
+        calculate_file_server_path_func,
+    ) -> List[ServerDirectoryItem]:
+        if self.directory_listing_cache is None:
+            return list_directory(local_path, calculate_file_server_path_func)
 
-        return toolbox_files
+        return self.directory_listing_cache.get_listing(
+            local_path, server_path, directory_stat, calculate_file_server_path_func
+        )
 
-    def _read_user_file(self, local_path: LocalPath):
+    def _read_user_file(self, verified_path: VerifiedPath):
         """
-        Responds with the current file if it exists as a file
+        Responds with the current file, which is only opened if its contents are sent
         """
-        is_valid_path = (
-            self.file_manager.is_allowed_user_file_path(local_path)
-            and local_path.exists()
-            and local_path.is_file()
+        return as_server_file_result(
+            verified_path.local_path,
+            verified_path.stat,
+            partial(verified_path.open, "rb"),
         )
-        if not is_valid_path:
-            return ServerInvalidFilePath()
-
-        with self.file_manager.open_user_file(local_path, "rb") as file:
-            content = file.read()
-            return ServerFileResult(local_path=local_path, content=content)
-
-        return ServerInvalidFilePath()
 
 
 class ToolboxFileServer:
-    def __init__(self, server_config: ServerConfig):
+    def __init__(
+        self,
+        server_config: ServerConfig,
+        directory_listing_cache: Optional[DirectoryListingCache] = None,
+    ):
         self.server_config = server_config
         self.file_manager = server_config.file_manager
+        self.directory_listing_cache = directory_listing_cache
 
     def serve_toolbox_file_or_folder(self, server_path: ServerPath):
         """
@@ -217,132 +599,130 @@ class ToolboxFileServer:
 
         If the given file or folder does not exist, None is returned
         """
-        # First test if the file can be found as a direct mapping
-        server_path_namespace = None
-        local_path_mapping = self.server_config.get_local_path("/" + server_path)
-
-        # There may not be a local file found, but test if it exists as a namespace
-        if local_path_mapping is None:
-            server_path_namespace = server_path.split("/")[0]
-            local_path_mapping = self.server_config.get_local_path(
-                "/" + server_path_namespace
-            )
-
-        if local_path_mapping is None:
+        match = self.server_config.find_mount(server_path)
+        if match is None:
             return None
 
-        local_path = None
-        if server_path_namespace is None:
-            local_path = local_path_mapping
-        else:
-            relative_path = removeprefix(server_path, server_path_namespace)
-            if relative_path[0] == "/":
-                relative_path = relative_path[1:]
-            local_path = (local_path_mapping / relative_path).resolve()
+        mount, relative_parts = match
+        try:
+            verified_path = self.file_manager.verify_toolbox_path(
+                mount.local_path.joinpath(*relative_parts)
+            )
+        except InvalidFilePath:
+            return ServerInvalidFilePath()
 
-        def calculate_file_server_path_func(file_path: Path):
-            server_path_prefix = None
-            if server_path_namespace is None:
-                server_path_prefix = f"/{server_path}/"
-            else:
-                server_path_prefix = f"/{server_path_namespace}/"
+        # The requested path may lead outside of its mount, i.e. via '..' or symlinks,
+        # in which case it must still exist within another configured mount
+        local_path = verified_path.local_path
+        local_mount = mount
+        if not is_within_path(local_path, mount.local_path):
+            local_mount = self.server_config.find_local_mount(local_path)
+        if local_mount is None:
+            return ServerInvalidFilePath()
 
-            return f"{server_path_prefix}{str(file_path.relative_to(local_path_mapping).as_posix())}"
+        def calculate_file_server_path_func(file_path: Path):
+            relative_path = file_path.relative_to(local_mount.local_path).as_posix()
+            return f"{local_mount.server_path.rstrip('/')}/{relative_path}"
 
         return self._serve_file_or_folder(
-            local_path,
+            verified_path,
             server_path,
             calculate_file_server_path_func,
         )
 
     def _serve_file_or_folder(
         self,
-        local_path: LocalPath,
+        verified_path: VerifiedPath,
         server_path: ServerPath,
         calculate_file_server_path_func,
     ) -> ServerResponse:
         """
         Attempts to serve the given file or directory to the user.
 
-        If the local_path is a file, it sends a file to the user.
-        If the local_path is a folder, it renders the directory contents
+        If the verified_path is a file, it sends a file to the user.
+        If the verified_path is a folder, it renders the directory contents
 
-        To guard against arbitrary reads - the local_path must exist within the
-        restrict_to_path argument, otherwise a ServerInvalidFilePath object is returned.
+        To guard against arbitrary reads - the path must have already been verified
+        by the file manager, which ensures that it exists within the allowed directory.
         """
-
-        valid_child_path = (
-            self.file_manager.is_allowed_toolbox_file_path(local_path)
-        ) and local_path.exists()
-        if not valid_child_path:
-            return ServerInvalidFilePath()
-
-        if local_path.is_file():
-            return self._read_toolbox_file(local_path)
-        elif local_path.is_dir():
-            files = []
-            for child_path in local_path.iterdir():
-                files.append(
-                    as_server_directory_item(
-                        server_path=calculate_file_server_path_func(child_path),
-                        local_path=child_path,
-                    )
-                )
+        if verified_path.is_file:
+            return self._read_toolbox_file(verified_path)
+        elif verified_path.is_dir:
+            files = self._list_directory(
+                verified_path.local_path,
+                server_path,
+                verified_path.stat,
+                calculate_file_server_path_func,
+            )
 
             return ServerDirectoryListing(
                 user_files=files,
-                toolbox_files=self._get_toolbox_files(),
+                toolbox_files=self.server_config.toolbox_file_index.files,
                 server_path=server_path,
+                etag=as_directory_etag(verified_path.stat),
+                local_path=verified_path.local_path,
+                verify_path=self.verify_mounted_path,
             )
         else:
             return ServerInvalidFilePath()
 
-    def _get_toolbox_files(self) -> List[ServerDirectoryItem]:
-        toolbox_files = []
-        for server_path, local_path in self.server_config.items():
-            toolbox_files.append(
-                as_server_directory_item(server_path=server_path, local_path=local_path)
-            )
-
-        toolbox_files.sort(key=lambda file: file.name)
-        return toolbox_files
-
-    def _read_toolbox_file(self, local_path: LocalPath):
+    def verify_mounted_path(self, path) -> VerifiedPath:
         """
-        Responds with the current file if it exists as a file
+        Verifies the path with the file manager, raising InvalidFilePath if it does
+        not resolve to within a configured mount. i.e. a symlink within a mount which
+        leads to a toolbox file that is not configured to be served.
         """
-        is_valid_path = (
-            self.file_manager.is_allowed_toolbox_file_path(local_path)
-            and local_path.exists()
-            and local_path.is_file()
-        )
-        if not is_valid_path:
-            return ServerInvalidFilePath()
+        verified_path = self.file_manager.verify_toolbox_path(path)
+        if self.server_config.find_local_mount(verified_path.local_path) is None:
+            raise InvalidFilePath
+        return verified_path
 
-        is_allowed_path = any(
-            allowed_local_path in local_path.parents or allowed_local_path == local_path
-            for _server_path, allowed_local_path in self.server_config.items()
-        )
-        if not is_allowed_path:
-            return ServerInvalidFilePath()
+    def _list_directory(
+        self,
+        local_path: LocalPath,
+        server_path: ServerPath,
+        directory_stat,
+        calculate_file_server_path_func,
+    ) -> List[ServerDirectoryItem]:
+        if self.directory_listing_cache is None:
+            return list_directory(local_path, calculate_file_server_path_func)
 
-        with self.file_manager.open_toolbox_file(local_path, "rb") as file:
-            content = file.read()
-            return ServerFileResult(local_path=local_path, content=content)
+        return self.directory_listing_cache.get_listing(
+            local_path, server_path, directory_stat, calculate_file_server_path_func
+        )
 
-        return ServerInvalidFilePath()
+    def _read_toolbox_file(self, verified_path: VerifiedPath):
+        """
+        Responds with the current file, which is only opened if its contents are sent
+        """
+        return as_server_file_result(
+            verified_path.local_path,
+            verified_path.stat,
+            partial(verified_path.open, "rb"),
+        )
 
 
 class FileServer:
-    def __init__(self, server_config: ServerConfig):
+    def __init__(
+        self,
+        server_config: ServerConfig,
+        directory_listing_cache: Optional[DirectoryListingCache] = None,
+    ):
         self.server_config = server_config
         self.file_manager = server_config.file_manager
+        self.directory_listing_cache = directory_listing_cache
 
     def serve(self, server_path: ServerPath):
-        toolbox_file_server = ToolboxFileServer(server_config=self.server_config)
+        toolbox_file_server = ToolboxFileServer(
+            server_config=self.server_config,
+            directory_listing_cache=self.directory_listing_cache,
+        )
         toolbox_file = toolbox_file_server.serve_toolbox_file_or_folder(server_path)
         if toolbox_file is not None:
             return toolbox_file
 
-        user_file_server = UserFileServer(server_config=self.server_config)
+        user_file_server = UserFileServer(
+            server_config=self.server_config,
+            directory_listing_cache=self.directory_listing_cache,
+        )
         return user_file_server.serve_user_file_or_folder(server_path)
@@ -16,3 +16,12 @@ def pretty_date(date, now=None):
         return f"{math.floor(seconds / 3600)} hours ago"
     else:
         return f"{difference.days} days ago"
+
+
+def pretty_size(size):
+    if abs(size) < 1024:
+        return f"{size} B"
+    for unit in ["KiB", "MiB", "GiB"]:
+        size /= 1024
+        if abs(size) < 1024 or unit == "GiB":
+            return f"{size:.1f} {unit}"
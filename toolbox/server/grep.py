@@ -0,0 +1,264 @@
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+from .file_manager import is_upload_file
+from .file_server import Bytes
+
+logger = logging.getLogger(__name__)
+
+# Identifies a version of a file, which changes whenever the file is modified
+FileKey = Tuple[int, int, int]
+LineMatch = Tuple[int, str]
+
+DEFAULT_MAX_RESULTS = 10_000
+MAX_MATCHES_PER_FILE = 1000
+MAX_LINE_LENGTH = 500
+
+# Newlines are counted over memory mapped files in fixed size chunks, so that the
+# memory used does not grow with the distance between matches
+NEWLINE_CHUNK_SIZE: Bytes = 1024 * 1024
+
+
+@dataclass
+class GrepMatch:
+    # Relative to the searched directory
+    path: str
+    line_number: int
+    line: str
+
+
+def as_file_key(stat) -> FileKey:
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def count_newlines(data, start: int, end: int) -> int:
+    count = 0
+    for chunk_start in range(start, end, NEWLINE_CHUNK_SIZE):
+        chunk_end = min(chunk_start + NEWLINE_CHUNK_SIZE, end)
+        count += data[chunk_start:chunk_end].count(b"\n")
+    return count
+
+
+def grep_file(
+    local_path: str, pattern: bytes, flags: int, max_matches: int
+) -> List[LineMatch]:
+    """
+    Returns the line number and text of each line in the file which matches the
+    pattern. The file is memory mapped, so that the regex runs over the file's
+    contents without reading it into memory.
+
+    This runs within the process pool, and must be importable by its workers.
+    """
+    regex = re.compile(pattern, flags)
+    matches: List[LineMatch] = []
+    try:
+        with open(local_path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return matches
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                line_number = 1
+                line_start = 0
+                line_end = -1
+                for match in regex.finditer(data):
+                    # Each line is only reported once
+                    if match.start() <= line_end:
+                        continue
+
+                    previous_line_start = line_start
+                    line_start = data.rfind(b"\n", line_start, match.start()) + 1
+                    if line_start == 0:
+                        line_start = previous_line_start
+                    line_number += count_newlines(data, previous_line_start, line_start)
+
+                    line_end = data.find(b"\n", match.start())
+                    if line_end == -1:
+                        line_end = len(data)
+                    # Long lines, such as within binary files, are shortened to the
+                    # text surrounding the match
+                    text_start = max(line_start, match.start() - MAX_LINE_LENGTH // 2)
+                    line = data[
+                        text_start : min(line_end, text_start + MAX_LINE_LENGTH)
+                    ]
+                    matches.append(
+                        (line_number, line.decode("utf-8", errors="replace").rstrip())
+                    )
+                    if len(matches) >= max_matches:
+                        break
+    except (OSError, ValueError):
+        # The file was removed, replaced or can not be read
+        logger.debug("Unable to search %s", local_path, exc_info=True)
+    return matches
+
+
+class ContentSearcher:
+    """
+    Searches the contents of every file within a directory with a pool of worker
+    processes. Matches are yielded as each file is searched.
+
+    The matches found in each file are cached for recently used patterns, and files
+    which have the same inode, modification time and size as when they were last
+    searched are not searched again.
+    """
+
+    def __init__(
+        self,
+        root_directory: Path,
+        workers: Optional[int] = None,
+        max_cached_patterns: int = 8,
+    ):
+        self.root_directory = Path(root_directory)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_cached_patterns = max_cached_patterns
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+        self._cache: OrderedDict = OrderedDict()
+
+    def search(
+        self,
+        pattern: str,
+        ignore_case: bool = False,
+        max_results: int = DEFAULT_MAX_RESULTS,
+    ) -> Iterator[GrepMatch]:
+        """
+        Yields the lines matching the regex pattern. Raises re.error straight away if
+        the pattern is invalid.
+        """
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+        pattern_bytes = pattern.encode("utf-8")
+        re.compile(pattern_bytes, flags)
+        return self._search(pattern_bytes, flags, max_results)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _search(
+        self, pattern: bytes, flags: int, max_results: int
+    ) -> Iterator[GrepMatch]:
+        cached_files = self._get_cached_files((pattern, flags))
+        executor = self._get_executor()
+        max_pending = self.workers * 4
+        pending: Dict[Future, Tuple[str, FileKey]] = {}
+        seen_paths: Set[str] = set()
+
+        def iter_completed(block: bool) -> Iterator[Tuple[str, List[LineMatch]]]:
+            if not pending:
+                return
+            done, _not_done = wait(
+                pending, timeout=None if block else 0, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                path, file_key = pending.pop(future)
+                matches = future.result()
+                with self._lock:
+                    cached_files[path] = (file_key, matches)
+                yield path, matches
+
+        def iter_files_matches() -> Iterator[Tuple[str, List[LineMatch]]]:
+            for path, local_path, file_key in self._iter_files():
+                seen_paths.add(path)
+                with self._lock:
+                    cached = cached_files.get(path)
+
+                if cached is not None and cached[0] == file_key:
+                    yield path, cached[1]
+                else:
+                    future = executor.submit(
+                        grep_file, local_path, pattern, flags, MAX_MATCHES_PER_FILE
+                    )
+                    pending[future] = (path, file_key)
+
+                # Matches are yielded as soon as they are found, and no more files
+                # are queued while the pool is busy
+                yield from iter_completed(block=len(pending) >= max_pending)
+
+            while pending:
+                yield from iter_completed(block=True)
+
+            # Forget files which no longer exist
+            with self._lock:
+                for path in set(cached_files) - seen_paths:
+                    del cached_files[path]
+
+        result_count = 0
+        try:
+            for path, matches in iter_files_matches():
+                for line_number, line in matches:
+                    if result_count >= max_results:
+                        return
+                    yield GrepMatch(path, line_number, line)
+                    result_count += 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _iter_files(self) -> Iterator[Tuple[str, str, FileKey]]:
+        """
+        Yields the relative path, local path and key of each regular file within the
+        root directory. Symlinks are not followed.
+        """
+        pending = [str(self.root_directory)]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    entries = sorted(entries, key=lambda entry: entry.name)
+            except OSError:
+                continue
+
+            directories = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        if is_upload_file(entry.name):
+                            continue
+                        path = os.path.relpath(entry.path, self.root_directory)
+                        yield Path(path).as_posix(), entry.path, as_file_key(
+                            entry.stat(follow_symlinks=False)
+                        )
+                except OSError:
+                    continue
+            pending.extend(reversed(directories))
+
+    def _get_cached_files(self, key) -> Dict[str, Tuple[FileKey, List[LineMatch]]]:
+        with self._lock:
+            cached_files = self._cache.get(key)
+            if cached_files is None:
+                cached_files = {}
+                self._cache[key] = cached_files
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_cached_patterns:
+                self._cache.popitem(last=False)
+            return cached_files
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # A process pool can not be used after forking, so each worker process
+        # creates its own
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                # Worker processes are not forked from this process directly, as it
+                # may be running other threads which hold locks
+                start_method = (
+                    "forkserver"
+                    if "forkserver" in multiprocessing.get_all_start_methods()
+                    else "spawn"
+                )
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(start_method),
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
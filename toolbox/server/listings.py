@@ -0,0 +1,145 @@
+from dataclasses import dataclass
+from datetime import timezone
+from heapq import merge
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+import base64
+import binascii
+import json
+from .file_server import (
+    ServerDirectoryItem,
+    ServerDirectoryListing,
+    directory_item_sort_key,
+)
+
+SortKey = Tuple[bool, str, str]
+
+ITEM_KINDS = ("file", "directory")
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+@dataclass
+class ListingFilter:
+    kind: Optional[str] = None
+    # Lower case, without the leading dot
+    extensions: Optional[Set[str]] = None
+
+    def matches(self, item: ServerDirectoryItem) -> bool:
+        if self.kind is not None and as_item_kind(item) != self.kind:
+            return False
+        if self.extensions is not None:
+            _name, dot, extension = item.name.rpartition(".")
+            if not dot or extension.lower() not in self.extensions:
+                return False
+        return True
+
+
+@dataclass
+class ListingPage:
+    items: List[ServerDirectoryItem]
+    next_cursor: Optional[str]
+
+
+def as_item_kind(item: ServerDirectoryItem) -> str:
+    if item.is_dir:
+        return "directory"
+    if item.is_file:
+        return "file"
+    return "other"
+
+
+def as_listing_item(item: ServerDirectoryItem) -> Dict[str, Any]:
+    return {
+        "name": item.name,
+        "path": item.server_path,
+        "kind": as_item_kind(item),
+        "size": item.size,
+        "modified_at": item.modified_at.astimezone(timezone.utc).isoformat(),
+    }
+
+
+def encode_cursor(item: ServerDirectoryItem) -> str:
+    """
+    Cursors point just after the given item's position in the sort order, rather
+    than at an offset, so that paging stays consistent while files are added or
+    removed
+    """
+    data = json.dumps(directory_item_sort_key(item)).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> SortKey:
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        is_file, name, server_path = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+    if not (
+        isinstance(is_file, bool)
+        and isinstance(name, str)
+        and isinstance(server_path, str)
+    ):
+        raise InvalidCursor(cursor)
+    return (is_file, name, server_path)
+
+
+def items_after(
+    files: Sequence[ServerDirectoryItem], sort_key: Optional[SortKey]
+) -> Iterator[ServerDirectoryItem]:
+    """
+    Yields the items of the sorted listing which come after the given sort key,
+    found with a binary search rather than a scan
+    """
+    low = 0
+    if sort_key is not None:
+        high = len(files)
+        while low < high:
+            middle = (low + high) // 2
+            if directory_item_sort_key(files[middle]) <= sort_key:
+                low = middle + 1
+            else:
+                high = middle
+    return (files[index] for index in range(low, len(files)))
+
+
+def iter_listing(
+    directory_listing: ServerDirectoryListing,
+    listing_filter: ListingFilter,
+    sort_key: Optional[SortKey] = None,
+) -> Iterator[ServerDirectoryItem]:
+    """
+    Yields the matching items of the directory listing in sort order, starting after
+    the given sort key. The root listing includes the inbuilt toolbox files.
+    """
+    sections = [directory_listing.user_files]
+    if directory_listing.server_path == "":
+        sections.append(directory_listing.toolbox_files)
+
+    items = merge(
+        *(items_after(files, sort_key) for files in sections),
+        key=directory_item_sort_key,
+    )
+    return (item for item in items if listing_filter.matches(item))
+
+
+def list_page(
+    directory_listing: ServerDirectoryListing,
+    listing_filter: ListingFilter,
+    limit: int,
+    sort_key: Optional[SortKey] = None,
+) -> ListingPage:
+    items = list(
+        islice(iter_listing(directory_listing, listing_filter, sort_key), limit + 1)
+    )
+    if len(items) <= limit:
+        return ListingPage(items=items, next_cursor=None)
+    return ListingPage(items=items[:limit], next_cursor=encode_cursor(items[limit - 1]))
+
+
+def as_ndjson_lines(items: Iterator[ServerDirectoryItem]) -> Iterator[str]:
+    for item in items:
+        yield json.dumps(as_listing_item(item)) + "\n"
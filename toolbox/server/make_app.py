@@ -1,7 +1,8 @@
 from flask import (
     Blueprint,
     Flask,
-    render_template,
+    Response,
+    stream_template,
     make_response,
     app,
     abort,
@@ -10,23 +11,89 @@ from flask import (
     redirect,
     url_for,
     session,
+    g,
 )
+import atexit
 import logging
 import base64
-from typing import Optional
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from typing import Iterator, Optional
 from http import HTTPStatus
 from flask_wtf.csrf import CSRFProtect
 from .file_server import (
     ServerConfig,
+    ServerConfigCache,
+    DirectoryListingCache,
     FileServer,
     FileManager,
     ServerInvalidFilePath,
     ServerDirectoryListing,
+    ServerDirectoryPage,
     ServerFileResult,
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    paginate,
+)
+from .listings import (
+    ITEM_KINDS,
+    InvalidCursor,
+    ListingFilter,
+    as_listing_item,
+    as_ndjson_lines,
+    decode_cursor,
+    iter_listing,
+    list_page,
 )
 from . import formatters
+from .file_response import (
+    make_file_response,
+    is_not_modified,
+    make_not_modified_response,
+)
 from .color import Color
+from .archives import ARCHIVE_FORMATS, make_archive_response
+from .search import DEFAULT_SEARCH_LIMIT, SearchIndex, SearchEntry
+from .grep import DEFAULT_MAX_RESULTS, ContentSearcher, GrepMatch
+from .metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    MemoryMetricValues,
+    SharedMetricValues,
+    ToolboxMetrics,
+)
+from .access_log import AccessLog, AccessLogMiddleware, ConsoleSink, JsonLinesSink
+from .memory import DEFAULT_REPORT_LIMIT, GROUP_BY_KEYS, MemoryDiagnostics
+from .profiling import (
+    DEFAULT_SUMMARY_LIMIT,
+    ROUTE_ENVIRON_KEY,
+    SUMMARY_SORT_KEYS,
+    ProfilingMiddleware,
+    RequestProfiler,
+)
+from .upload_tokens import (
+    DEFAULT_UPLOAD_TOKEN_TTL,
+    MemoryUploadTokenStore,
+    SqliteUploadTokenStore,
+    UploadToken,
+    UploadTokenId,
+    UploadTokenStore,
+)
+from .uploads import (
+    UploadStreamFactory,
+    PartialUpload,
+    UploadOffsetMismatch,
+    UploadInProgress,
+    MAX_FORM_MEMORY_SIZE,
+    MAX_FORM_PARTS,
+)
+from werkzeug.datastructures import CombinedMultiDict
+from werkzeug.formparser import FormDataParser
 from .payload_generator import PayloadGenerator, TEMPLATE_DIRECTORY
+from .request_handler import call_on_close
 from flask_wtf.file import FileField, FileRequired
 from werkzeug.security import generate_password_hash, check_password_hash
 from pathlib import Path
@@ -34,7 +101,6 @@ from flask_wtf import FlaskForm
 from wtforms import StringField
 from wtforms.validators import DataRequired
 from dataclasses import dataclass
-from typing import Dict
 import secrets
 from http import HTTPStatus
 from .interfaces import allowed_interfaces, get_ip_address
@@ -50,19 +116,11 @@ class UploadTokenForm(FlaskForm):
     file_name = StringField("File Name", validators=[DataRequired()])
 
 
-UploadTokenId = str
-
-
-@dataclass
-class UploadToken:
-    id: UploadTokenId
-    file_name: str
-
-
 @dataclass
 class IndexViewModel:
     payload_generator: PayloadGenerator
     directory_listing: ServerDirectoryListing
+    user_files_page: ServerDirectoryPage
     upload_token_form: UploadForm
     upload_token: UploadToken
     has_uploads_enabled: bool
@@ -78,7 +136,31 @@ class ToolboxServerException(Exception):
     pass
 
 
-upload_tokens: Dict[UploadTokenId, UploadToken] = {}
+# Rendered templates are sent in chunks of at least this size, rather than one
+# small chunk per template statement
+STREAM_BUFFER_SIZE = 16 * 1024
+
+# The result label recorded for each kind of FileServer response
+SERVED_RESULTS = {
+    ServerFileResult: "file",
+    ServerDirectoryListing: "directory",
+    ServerInvalidFilePath: "not_found",
+}
+
+
+def buffer_stream(chunks: Iterator[str], buffer_size=STREAM_BUFFER_SIZE):
+    buffer = []
+    buffered_size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= buffer_size:
+            yield "".join(buffer)
+            buffer = []
+            buffered_size = 0
+    if buffer:
+        yield "".join(buffer)
+
 
 server = Blueprint(
     "serve", __name__, template_folder=TEMPLATE_DIRECTORY, static_folder=None
@@ -89,6 +171,47 @@ csrf = CSRFProtect()
 auth = HTTPBasicAuth()
 
 
+def get_request_route() -> str:
+    return (request.endpoint or "unknown").rpartition(".")[2]
+
+
+@server.before_request
+def start_request_metrics():
+    g.request_started_at = time.perf_counter()
+    # Profiles of the request are named after its route
+    request.environ[ROUTE_ENVIRON_KEY] = get_request_route()
+
+
+@server.after_request
+def record_request_metrics(response: Response) -> Response:
+    metrics = get_metrics(current_app)
+    route = get_request_route()
+    started_at = g.get("request_started_at", time.perf_counter())
+    metrics.requests.inc(
+        route=route, method=request.method, status=str(response.status_code)
+    )
+
+    # Streamed responses are only complete once the server closes them
+    is_recorded = False
+
+    def record_duration():
+        nonlocal is_recorded
+        if not is_recorded:
+            is_recorded = True
+            metrics.request_duration.observe(
+                time.perf_counter() - started_at, route=route
+            )
+
+    response.call_on_close(record_duration)
+    # Passthrough bodies, such as file streams, are handed to the server as-is and
+    # the response's own close callbacks are not called
+    if response.direct_passthrough:
+        response.response = call_on_close(
+            request.environ, response.response, record_duration
+        )
+    return response
+
+
 # No login required - shells can be accessed from anywhere
 @server.route("/shells/<name>")
 @server.route("/shells/<name>/<lport>")
@@ -123,22 +246,41 @@ def debug(namespace):
 @server.route("/uploads", methods=["POST"])
 @csrf.exempt
 def uploads():
-    upload_form = UploadForm(meta={"csrf": False})
-    if upload_form.validate_on_submit():
+    file_manager = get_file_manager(current_app)
+    max_upload_size = current_app.config.get("MAX_UPLOAD_SIZE")
+    # Stream uploaded files straight to disk, rather than buffering them in memory
+    upload_stream_factory = UploadStreamFactory(
+        file_manager, max_upload_size=max_upload_size
+    )
+
+    # Note that werkzeug applies max_form_memory_size to its multipart parsing buffer,
+    # which also holds back file data, so it would reject many larger binary files
+    form_data_parser = FormDataParser(
+        stream_factory=upload_stream_factory,
+        max_content_length=(
+            None if max_upload_size is None else max_upload_size + MAX_FORM_MEMORY_SIZE
+        ),
+        max_form_parts=MAX_FORM_PARTS,
+    )
+
+    try:
+        _stream, form, files = form_data_parser.parse_from_environ(request.environ)
+        upload_form = UploadForm(
+            formdata=CombinedMultiDict((files, form)), meta={"csrf": False}
+        )
+        if not upload_form.validate_on_submit():
+            return make_response(upload_form.errors, HTTPStatus.BAD_REQUEST)
+
+        upload_token_store = get_upload_token_store(current_app)
         upload_token_id = upload_form.token_id.data
-        upload_token = upload_tokens.get(upload_token_id, None)
+        upload_token = upload_token_store.get(upload_token_id)
 
         if upload_token is None:
             return make_response(
                 '{ "error": "token not valid" }\n', HTTPStatus.BAD_REQUEST
             )
 
-        file_manager = FileManager(
-            root_user_directory=current_app.config["ROOT_USER_DIRECTORY"],
-            root_toolbox_directory=current_app.config["ROOT_TOOLBOX_DIRECTORY"],
-        )
-
-        file = upload_form.file.data
+        upload_file = upload_form.file.data.stream
         file_name = upload_token.file_name
         new_file_path = Path(current_app.config["ROOT_USER_DIRECTORY"]) / file_name
 
@@ -147,16 +289,116 @@ def uploads():
                 '{ "error": "invalid path" }\n', HTTPStatus.BAD_REQUEST
             )
 
-        with file_manager.open_user_file(new_file_path, "wb") as new_file:
-            current_app.logger.info(
-                "Successfully wrote new file %s", Color.green(new_file_path)
+        # Only one upload can use the token, even if several are sent at once
+        if upload_token_store.consume(upload_token_id) is None:
+            return make_response(
+                '{ "error": "token not valid" }\n', HTTPStatus.BAD_REQUEST
             )
-            new_file.write(file.read())
 
-        upload_tokens.pop(upload_token_id, None)
+        upload_file.close()
+        file_manager.replace_user_file(upload_file.path, new_file_path.resolve())
+        current_app.logger.info(
+            "Successfully wrote new file %s", Color.green(new_file_path)
+        )
+        get_metrics(current_app).uploads.inc()
+
         return make_response('{ "success": true }\n', HTTPStatus.CREATED)
+    finally:
+        get_metrics(current_app).record_upload_bytes_received(
+            sum(upload_file.size for upload_file in upload_stream_factory.upload_files)
+        )
+        upload_stream_factory.close()
 
-    return make_response(upload_form.errors, HTTPStatus.BAD_REQUEST)
+
+# No login required - resumable uploads must provide a one time token. The current
+# offset can be requested with HEAD, chunks are appended with PATCH, and the upload is
+# completed with POST
+@server.route("/uploads/<token_id>", methods=["HEAD"])
+def partial_upload_offset(token_id):
+    upload_token = get_upload_token_store(current_app).get(token_id)
+    if upload_token is None:
+        return make_response("", HTTPStatus.NOT_FOUND)
+
+    partial_upload = get_partial_upload(current_app, upload_token)
+    response = make_response("", HTTPStatus.OK)
+    response.headers["Upload-Offset"] = str(partial_upload.offset)
+    return response
+
+
+@server.route("/uploads/<token_id>", methods=["PATCH"])
+@csrf.exempt
+def partial_upload_append(token_id):
+    upload_token = get_upload_token_store(current_app).get(token_id)
+    if upload_token is None:
+        return make_response('{ "error": "token not valid" }\n', HTTPStatus.BAD_REQUEST)
+
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return make_response(
+            '{ "error": "Upload-Offset header required" }\n', HTTPStatus.BAD_REQUEST
+        )
+
+    partial_upload = get_partial_upload(current_app, upload_token)
+    try:
+        new_offset = partial_upload.append(
+            request.stream,
+            offset=offset,
+            max_upload_size=current_app.config.get("MAX_UPLOAD_SIZE"),
+        )
+    except UploadOffsetMismatch as e:
+        response = make_response(
+            f'{{ "error": "offset mismatch", "offset": {e.offset} }}\n',
+            HTTPStatus.CONFLICT,
+        )
+        response.headers["Upload-Offset"] = str(e.offset)
+        return response
+    except UploadInProgress:
+        return make_response('{ "error": "upload in progress" }\n', HTTPStatus.CONFLICT)
+
+    get_metrics(current_app).record_upload_bytes_received(new_offset - offset)
+    response = make_response(f'{{ "offset": {new_offset} }}\n', HTTPStatus.OK)
+    response.headers["Upload-Offset"] = str(new_offset)
+    return response
+
+
+@server.route("/uploads/<token_id>", methods=["POST"])
+@csrf.exempt
+def partial_upload_commit(token_id):
+    upload_token_store = get_upload_token_store(current_app)
+    upload_token = upload_token_store.get(token_id)
+    if upload_token is None:
+        return make_response('{ "error": "token not valid" }\n', HTTPStatus.BAD_REQUEST)
+
+    new_file_path = (
+        Path(current_app.config["ROOT_USER_DIRECTORY"]) / upload_token.file_name
+    )
+    if not get_file_manager(current_app).is_allowed_user_file_path(new_file_path):
+        return make_response('{ "error": "invalid path" }\n', HTTPStatus.BAD_REQUEST)
+
+    partial_upload = get_partial_upload(current_app, upload_token)
+    # The upload is locked while it is moved into place, so only one request can
+    # complete it. The token is only used up once the file has been written, so that
+    # a failed commit can be retried.
+    try:
+        partial_upload.commit(new_file_path.resolve())
+    except FileNotFoundError:
+        return make_response(
+            '{ "error": "no data uploaded" }\n', HTTPStatus.BAD_REQUEST
+        )
+    except UploadInProgress:
+        # A chunk is still being appended, the upload can be completed again later
+        return make_response('{ "error": "upload in progress" }\n', HTTPStatus.CONFLICT)
+
+    upload_token_store.consume(token_id)
+    # Removes any chunk which was appended after the data was moved into place
+    partial_upload.discard()
+
+    current_app.logger.info(
+        "Successfully wrote new file %s", Color.green(new_file_path)
+    )
+    get_metrics(current_app).uploads.inc()
+    return make_response('{ "success": true }\n', HTTPStatus.CREATED)
 
 
 # No Login required - The root index is accessible so that it can easily serve arbitrary files
@@ -164,47 +406,243 @@ def uploads():
 @server.route("/<path:server_path>", methods=["GET"])
 def index(server_path):
     payload_generator = PayloadGenerator()
-    file_manager = FileManager(
-        root_user_directory=current_app.config["ROOT_USER_DIRECTORY"],
-        root_toolbox_directory=current_app.config["ROOT_TOOLBOX_DIRECTORY"],
-    )
-    server_config = ServerConfig(
-        root_toolbox_directory=current_app.config["ROOT_TOOLBOX_DIRECTORY"],
-        #  TODO: Remove config path and assume only built in files can be mapped
-        config_path=current_app.config["CONFIG_PATH"],
-        file_manager=file_manager,
+    server_config = get_server_config(current_app)
+    file_server = FileServer(
+        server_config=server_config,
+        directory_listing_cache=get_directory_listing_cache(current_app),
     )
-    file_server = FileServer(server_config=server_config)
     server_response = file_server.serve(server_path)
+    metrics = get_metrics(current_app)
+    metrics.served.inc(result=SERVED_RESULTS.get(type(server_response), "unknown"))
 
     if isinstance(server_response, ServerInvalidFilePath):
         return abort(HTTPStatus.NOT_FOUND)
 
     if isinstance(server_response, ServerFileResult):
-        response = make_response(server_response.content)
-        response.headers["Content-Type"] = "text/html; charset=utf-8"
-        return response
+        return make_file_response(request, server_response, metrics=metrics)
 
     if isinstance(server_response, ServerDirectoryListing):
+        archive_format = request.args.get("archive")
+        if archive_format is not None:
+            if archive_format not in ARCHIVE_FORMATS:
+                return abort(HTTPStatus.BAD_REQUEST)
+            return make_archive_response(server_response, archive_format)
+
         formdata = session.get("formdata")
+        upload_token_id = session.get("upload_token_id")
+        user_files_page = paginate(
+            server_response.user_files,
+            offset=request.args.get("offset", 0, type=int),
+            limit=request.args.get("limit", DEFAULT_PAGE_SIZE, type=int),
+        )
         upload_form = UploadTokenForm(data=formdata)
-
-        upload_token = upload_tokens.get(session.get("upload_token_id"))
+        upload_token = get_upload_token_store(current_app).get(upload_token_id)
         session.pop("upload_token_id", None)
-        return render_template(
-            "views/index.html",
-            view_model=IndexViewModel(
-                payload_generator=payload_generator,
-                directory_listing=server_response,
-                upload_token_form=upload_form,
-                upload_token=upload_token,
-                has_uploads_enabled=current_app.config["HAS_UPLOADS_ENABLED"],
-            ),
+        # The page is streamed as it is rendered, so that large listings can start
+        # being sent straight away. It is not given an ETag, as its csrf token is
+        # signed with a key which changes on restart and expires independently of
+        # the directory
+        return Response(
+            buffer_stream(
+                stream_template(
+                    "views/index.html",
+                    view_model=IndexViewModel(
+                        payload_generator=payload_generator,
+                        directory_listing=server_response,
+                        user_files_page=user_files_page,
+                        upload_token_form=upload_form,
+                        upload_token=upload_token,
+                        has_uploads_enabled=current_app.config["HAS_UPLOADS_ENABLED"],
+                    ),
+                )
+            )
         )
 
     return abort(HTTPStatus.INTERNAL_SERVER_ERROR, f"{str(server_response.__class__)}")
 
 
+def as_json_error(message: str, status: HTTPStatus) -> Response:
+    return Response(
+        f'{{ "error": "{message}" }}\n', status, mimetype="application/json"
+    )
+
+
+# No login required - a machine readable version of the index page's listings. Files
+# are listed as JSON pages, or streamed as newline delimited JSON with ?format=ndjson
+@server.route("/api/files/", defaults={"server_path": ""}, methods=["GET"])
+@server.route("/api/files/<path:server_path>", methods=["GET"])
+def list_files(server_path):
+    output_format = request.args.get("format", "json")
+    if output_format not in ("json", "ndjson"):
+        return as_json_error("invalid format", HTTPStatus.BAD_REQUEST)
+
+    kind = request.args.get("type")
+    if kind is not None and kind not in ITEM_KINDS:
+        return as_json_error("invalid type", HTTPStatus.BAD_REQUEST)
+
+    extensions = {
+        extension.strip().lstrip(".").lower()
+        for value in request.args.getlist("ext")
+        for extension in value.split(",")
+    }
+    listing_filter = ListingFilter(kind=kind, extensions=extensions or None)
+
+    # Newline delimited JSON streams the whole listing, unless a limit is given
+    limit = request.args.get(
+        "limit", DEFAULT_PAGE_SIZE if output_format == "json" else None, type=int
+    )
+    if limit is not None:
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+
+    file_server = FileServer(
+        server_config=get_server_config(current_app),
+        directory_listing_cache=get_directory_listing_cache(current_app),
+    )
+    server_response = file_server.serve(server_path)
+    if isinstance(server_response, ServerInvalidFilePath):
+        return as_json_error("not found", HTTPStatus.NOT_FOUND)
+    if not isinstance(server_response, ServerDirectoryListing):
+        return as_json_error("not a directory", HTTPStatus.BAD_REQUEST)
+
+    if is_not_modified(request, server_response.etag):
+        return make_not_modified_response(server_response.etag, weak=True)
+
+    cursor = request.args.get("cursor")
+    try:
+        sort_key = None if cursor is None else decode_cursor(cursor)
+    except InvalidCursor:
+        return as_json_error("invalid cursor", HTTPStatus.BAD_REQUEST)
+
+    if limit is None:
+        items = iter_listing(server_response, listing_filter, sort_key)
+        next_cursor = None
+    else:
+        listing_page = list_page(
+            server_response, listing_filter, limit=limit, sort_key=sort_key
+        )
+        items = listing_page.items
+        next_cursor = listing_page.next_cursor
+
+    if output_format == "ndjson":
+        response = Response(
+            buffer_stream(as_ndjson_lines(items)), mimetype="application/x-ndjson"
+        )
+    else:
+        body = {
+            "path": f"/{server_path}",
+            "files": [as_listing_item(item) for item in items],
+            "next_cursor": next_cursor,
+        }
+        response = Response(json.dumps(body) + "\n", mimetype="application/json")
+
+    if next_cursor is not None:
+        response.headers["Toolbox-Next-Cursor"] = next_cursor
+    response.set_etag(server_response.etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+# No login required - finds files and folders by name across the served directories
+@server.route("/search", methods=["GET"])
+def search():
+    query = request.args.get("q", "").strip()
+    if not query:
+        return as_json_error("query required", HTTPStatus.BAD_REQUEST)
+
+    limit = request.args.get("limit", DEFAULT_SEARCH_LIMIT, type=int)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    search_result = get_search_index(current_app).search(query, limit=limit)
+
+    body = {
+        "query": query,
+        "files": [as_search_item(entry) for entry in search_result.entries],
+        "is_truncated": search_result.is_truncated,
+        "is_complete": search_result.is_complete,
+    }
+    return Response(json.dumps(body) + "\n", mimetype="application/json")
+
+
+def as_search_item(entry: SearchEntry):
+    return {
+        "name": entry.name,
+        "path": entry.server_path,
+        "kind": "directory" if entry.is_dir else "file",
+    }
+
+
+# Login required - searches the contents of the user directory, such as uploaded loot.
+# Matching lines are streamed as newline delimited JSON as each file is searched
+@server.route("/grep", methods=["GET"])
+@auth.login_required
+def grep():
+    pattern = request.args.get("q", "")
+    if not pattern:
+        return as_json_error("query required", HTTPStatus.BAD_REQUEST)
+
+    max_results = request.args.get("max_results", DEFAULT_MAX_RESULTS, type=int)
+    try:
+        matches = get_content_searcher(current_app).search(
+            pattern,
+            ignore_case=request.args.get("ignore_case") in ("1", "true"),
+            max_results=max(max_results, 1),
+        )
+    except re.error:
+        return as_json_error("invalid pattern", HTTPStatus.BAD_REQUEST)
+
+    lines = (json.dumps(as_grep_item(match)) + "\n" for match in matches)
+    return Response(lines, mimetype="application/x-ndjson")
+
+
+def as_grep_item(match: GrepMatch):
+    return {
+        "path": f"/{match.path}",
+        "line_number": match.line_number,
+        "line": match.line,
+    }
+
+
+# Login required - metrics describe what is being served and uploaded
+@server.route("/metrics", methods=["GET"])
+@auth.login_required
+def metrics():
+    return Response(
+        get_metrics(current_app).render(), content_type=METRICS_CONTENT_TYPE
+    )
+
+
+# Login required - profiles describe the server's code and the files being served
+@server.route("/profiles", methods=["GET"])
+@auth.login_required
+def profiles():
+    profiler = get_profiler(current_app)
+    if profiler is None:
+        abort(HTTPStatus.NOT_FOUND)
+
+    sort = request.args.get("sort", "cumulative")
+    if sort not in SUMMARY_SORT_KEYS:
+        sort = "cumulative"
+    limit = request.args.get("limit", DEFAULT_SUMMARY_LIMIT, type=int)
+    return Response(
+        profiler.summary(sort=sort, limit=max(limit, 1)), mimetype="text/plain"
+    )
+
+
+# Login required - allocations describe the server's code and the files being served
+@server.route("/memory", methods=["GET"])
+@auth.login_required
+def memory():
+    memory_diagnostics = get_memory_diagnostics(current_app)
+    if memory_diagnostics is None:
+        abort(HTTPStatus.NOT_FOUND)
+
+    group_by = request.args.get("group_by", "lineno")
+    if group_by not in GROUP_BY_KEYS:
+        group_by = "lineno"
+    limit = request.args.get("limit", DEFAULT_REPORT_LIMIT, type=int)
+    report = memory_diagnostics.report(group_by=group_by, limit=max(limit, 1))
+    return Response(report.as_text(), mimetype="text/plain")
+
+
 # No login required - simply redirects to the index page
 @server.route("/tokens", methods=["GET"])
 def redirected():
@@ -222,26 +660,193 @@ def create_token():
             id=secrets.token_hex(16),
             file_name=form.file_name.data,
         )
-        upload_tokens[upload_token.id] = upload_token
+        get_upload_token_store(current_app).add(upload_token)
         session["upload_token_id"] = upload_token.id
 
     session["formdata"] = request.form
     return redirect(url_for("serve.index"))
 
 
-def validate_app(app):
-    file_manager = FileManager(
-        root_user_directory=app.config["ROOT_USER_DIRECTORY"],
-        root_toolbox_directory=app.config["ROOT_TOOLBOX_DIRECTORY"],
-    )
-
-    try:
-        ServerConfig(
+def get_file_manager(app) -> FileManager:
+    """
+    Returns the app's file manager, which is created once per app
+    """
+    file_manager = app.extensions.get("toolbox_file_manager")
+    if file_manager is None:
+        file_manager = FileManager(
+            root_user_directory=app.config["ROOT_USER_DIRECTORY"],
+            root_toolbox_directory=app.config["ROOT_TOOLBOX_DIRECTORY"],
+        )
+        app.extensions["toolbox_file_manager"] = file_manager
+    return file_manager
+
+
+def get_server_config(app) -> ServerConfig:
+    """
+    Returns the app's parsed server config, which is only parsed again when
+    the config file changes
+    """
+    server_config_cache = app.extensions.get("toolbox_server_config_cache")
+    if server_config_cache is None:
+        server_config_cache = ServerConfigCache(
             root_toolbox_directory=app.config["ROOT_TOOLBOX_DIRECTORY"],
-            #  TODO: Remove config path and assume only built in files can be mapped
+            #  TODO: Remove config path and assume only built in files can be mapped
             config_path=app.config["CONFIG_PATH"],
-            file_manager=file_manager,
+            file_manager=get_file_manager(app),
         )
+        app.extensions["toolbox_server_config_cache"] = server_config_cache
+    return server_config_cache.get()
+
+
+def get_directory_listing_cache(app) -> DirectoryListingCache:
+    """
+    Returns the app's cache of directory listings, which is shared across requests
+    """
+    directory_listing_cache = app.extensions.get("toolbox_directory_listing_cache")
+    if directory_listing_cache is None:
+        directory_listing_cache = DirectoryListingCache()
+        app.extensions["toolbox_directory_listing_cache"] = directory_listing_cache
+    return directory_listing_cache
+
+
+def get_search_index(app) -> SearchIndex:
+    """
+    Returns the app's search index of the user directory and the configured toolbox
+    files. The index is replaced when the config changes.
+    """
+    server_config = get_server_config(app)
+    roots = (("", Path(app.config["ROOT_USER_DIRECTORY"])),) + tuple(
+        (mount.server_path, mount.local_path) for mount in server_config.mounts
+    )
+
+    search_index = app.extensions.get("toolbox_search_index")
+    if search_index is None or search_index.roots != roots:
+        if search_index is not None:
+            search_index.stop()
+        search_index = SearchIndex(roots)
+        app.extensions["toolbox_search_index"] = search_index
+    search_index.start()
+    return search_index
+
+
+def get_content_searcher(app) -> ContentSearcher:
+    """
+    Returns the app's content searcher, which caches the results of recent searches
+    """
+    root_user_directory = Path(app.config["ROOT_USER_DIRECTORY"])
+    content_searcher = app.extensions.get("toolbox_content_searcher")
+    if (
+        content_searcher is None
+        or content_searcher.root_directory != root_user_directory
+    ):
+        content_searcher = ContentSearcher(root_user_directory)
+        app.extensions["toolbox_content_searcher"] = content_searcher
+    return content_searcher
+
+
+def get_metrics(app) -> ToolboxMetrics:
+    """
+    Returns the app's metrics. They are shared between worker processes through
+    METRICS_DIRECTORY when it is configured, and are otherwise held in memory.
+    """
+    metrics = app.extensions.get("toolbox_metrics")
+    if metrics is None:
+        metrics_directory = app.config.get("METRICS_DIRECTORY")
+        if metrics_directory is None:
+            metrics = ToolboxMetrics(MemoryMetricValues())
+        else:
+            metrics = ToolboxMetrics(SharedMetricValues(metrics_directory))
+        app.extensions["toolbox_metrics"] = metrics
+    return metrics
+
+
+def get_profiler(app) -> Optional[RequestProfiler]:
+    """
+    Returns the app's request profiler, when the server was started with profiling
+    """
+    return app.extensions.get("toolbox_profiler")
+
+
+def get_memory_diagnostics(app) -> Optional[MemoryDiagnostics]:
+    """
+    Returns the app's memory diagnostics, when the server was started with them
+    """
+    return app.extensions.get("toolbox_memory_diagnostics")
+
+
+def get_upload_token_store(app) -> UploadTokenStore:
+    """
+    Returns the app's upload token store. Tokens are stored in a SQLite database
+    when UPLOAD_TOKEN_STORE_PATH is configured, so that they can be shared between
+    worker processes, and are otherwise held in memory.
+    """
+    upload_token_store = app.extensions.get("toolbox_upload_token_store")
+    if upload_token_store is None:
+
+        def discard_partial_upload(upload_token: UploadToken):
+            get_partial_upload(app, upload_token).discard()
+
+        options = dict(
+            ttl=app.config.get("UPLOAD_TOKEN_TTL", DEFAULT_UPLOAD_TOKEN_TTL),
+            on_evict=discard_partial_upload,
+        )
+        upload_token_store_path = app.config.get("UPLOAD_TOKEN_STORE_PATH")
+        if upload_token_store_path is None:
+            upload_token_store = MemoryUploadTokenStore(**options)
+        else:
+            upload_token_store = SqliteUploadTokenStore(
+                upload_token_store_path, **options
+            )
+        app.extensions["toolbox_upload_token_store"] = upload_token_store
+    return upload_token_store
+
+
+def get_partial_upload_directory(app) -> Path:
+    """
+    Returns the directory which holds resumable uploads until they are completed.
+    It is kept outside of the user directory so that incomplete uploads are never
+    served. The directory sits alongside the upload token store when one is
+    configured, so that it is shared between worker processes, and is otherwise a
+    temporary directory which is removed when the server exits.
+    """
+    partial_upload_directory = app.extensions.get("toolbox_partial_upload_directory")
+    if partial_upload_directory is None:
+        upload_token_store_path = app.config.get("UPLOAD_TOKEN_STORE_PATH")
+        if upload_token_store_path is None:
+            partial_upload_directory = Path(
+                tempfile.mkdtemp(prefix="toolbox-partial-uploads-")
+            )
+            atexit.register(
+                remove_partial_upload_directory, partial_upload_directory, os.getpid()
+            )
+        else:
+            upload_token_store_path = Path(upload_token_store_path)
+            partial_upload_directory = upload_token_store_path.with_name(
+                f"{upload_token_store_path.name}.partial"
+            )
+            partial_upload_directory.mkdir(mode=0o700, exist_ok=True)
+        app.extensions["toolbox_partial_upload_directory"] = partial_upload_directory
+    return partial_upload_directory
+
+
+def remove_partial_upload_directory(partial_upload_directory: Path, pid: int):
+    # Forked worker processes inherit exit handlers, only the creating process
+    # removes the directory
+    if os.getpid() == pid:
+        shutil.rmtree(partial_upload_directory, ignore_errors=True)
+
+
+def get_partial_upload(app, upload_token: UploadToken) -> PartialUpload:
+    return PartialUpload(
+        get_file_manager(app),
+        get_partial_upload_directory(app),
+        upload_token.partial_upload_id,
+    )
+
+
+def validate_app(app):
+    try:
+        get_server_config(app)
     except ValueError as e:
         raise ToolboxServerException(
             f"{str(e)}\nConfiguration problem occurred. Ensure that {Color.green('install.sh')} has been run."
@@ -260,6 +865,15 @@ def make_app(
     config_path,
     use_debugger=False,
     use_reloader=False,
+    max_upload_size=None,
+    upload_token_ttl=DEFAULT_UPLOAD_TOKEN_TTL,
+    upload_token_store_path=None,
+    metrics_directory=None,
+    access_log_path=None,
+    profile_directory=None,
+    profile_sample_rate=None,
+    profile_path_pattern=None,
+    memory_diagnostics=False,
 ) -> Flask:
     app = Flask(
         __name__,
@@ -271,6 +885,10 @@ def make_app(
     app.config["CONFIG_PATH"] = config_path
     app.config["TEMPLATES_AUTO_RELOAD"] = use_reloader
     app.config["HAS_UPLOADS_ENABLED"] = password is not None
+    app.config["MAX_UPLOAD_SIZE"] = max_upload_size
+    app.config["UPLOAD_TOKEN_TTL"] = upload_token_ttl
+    app.config["UPLOAD_TOKEN_STORE_PATH"] = upload_token_store_path
+    app.config["METRICS_DIRECTORY"] = metrics_directory
     secret_key = secrets.token_bytes(32)
     app.secret_key = secret_key
     csrf.init_app(app)
@@ -288,12 +906,33 @@ def make_app(
             return False
         return check_password_hash(credentials.password, password)
 
-    # TODO: Add middleware logging for IP, time, user agent details, highlighting on 404s etc.
-    # log = logging.getLogger("werkzeug")
-    # log.disabled = True
+    if profile_directory is not None:
+        profiler = RequestProfiler(
+            profile_directory,
+            sample_rate=profile_sample_rate,
+            path_pattern=profile_path_pattern,
+        )
+        app.extensions["toolbox_profiler"] = profiler
+        app.wsgi_app = ProfilingMiddleware(app.wsgi_app, profiler)
+
+    if memory_diagnostics:
+        diagnostics = MemoryDiagnostics()
+        diagnostics.start()
+        app.extensions["toolbox_memory_diagnostics"] = diagnostics
+
+    sinks = [ConsoleSink()]
+    if access_log_path is not None:
+        sinks.append(JsonLinesSink(access_log_path))
+    access_log = AccessLog(sinks)
+    app.extensions["toolbox_access_log"] = access_log
+    app.wsgi_app = AccessLogMiddleware(app.wsgi_app, access_log)
 
     app.logger.setLevel(logging.INFO)
     app.register_blueprint(server)
     validate_app(app)
+    # Created before any worker processes are forked, so that they share it
+    get_partial_upload_directory(app)
+    # Start indexing straight away, rather than on the first search
+    get_search_index(app)
 
     return app
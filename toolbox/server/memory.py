@@ -0,0 +1,173 @@
+from dataclasses import dataclass
+from typing import List, Optional
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from .file_server import Bytes
+from .formatters import pretty_size
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+Seconds = float
+
+DEFAULT_TRACEBACK_FRAMES = 1
+DEFAULT_REPORT_LIMIT = 20
+GROUP_BY_KEYS = ["lineno", "filename"]
+
+# Allocations made by tracemalloc itself, or while importing modules, are not useful
+IGNORED_TRACES = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def get_rss() -> Optional[Bytes]:
+    """
+    Returns the resident memory of this process, when it can be read from /proc
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss() -> Optional[Bytes]:
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes elsewhere
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def format_location(traceback: tracemalloc.Traceback, group_by: str) -> str:
+    frame = traceback[0]
+    if group_by == "filename":
+        return frame.filename
+    return f"{frame.filename}:{frame.lineno}"
+
+
+def format_sign(value: int) -> str:
+    return "+" if value > 0 else ""
+
+
+@dataclass
+class MemoryReport:
+    # Memory traced by tracemalloc, since tracing started
+    current: Bytes
+    peak: Bytes
+    tracing_overhead: Bytes
+    rss: Optional[Bytes]
+    peak_rss: Optional[Bytes]
+    group_by: str
+    top_statistics: List[tracemalloc.Statistic]
+    # Not known for the first report, as there is no previous snapshot
+    changes: Optional[List[tracemalloc.StatisticDiff]]
+    seconds_since_previous: Optional[Seconds]
+
+    def as_text(self) -> str:
+        lines = [
+            f"Traced memory: current {pretty_size(self.current)}, "
+            f"peak {pretty_size(self.peak)}, "
+            f"tracemalloc overhead {pretty_size(self.tracing_overhead)}"
+        ]
+        if self.rss is not None or self.peak_rss is not None:
+            rss = "-" if self.rss is None else pretty_size(self.rss)
+            peak_rss = "-" if self.peak_rss is None else pretty_size(self.peak_rss)
+            lines.append(f"Process memory: RSS {rss}, peak RSS {peak_rss}")
+
+        lines.append("")
+        lines.append(f"Top {len(self.top_statistics)} allocations by {self.group_by}:")
+        for statistic in self.top_statistics:
+            lines.append(
+                f"{pretty_size(statistic.size):>12} {statistic.count:>10} blocks  "
+                f"{format_location(statistic.traceback, self.group_by)}"
+            )
+
+        lines.append("")
+        if self.changes is None:
+            lines.append(
+                "No previous snapshot to compare against. "
+                "The next report shows the changes since this one."
+            )
+            return "\n".join(lines) + "\n"
+
+        lines.append(
+            f"Top {len(self.changes)} changes since the previous snapshot, "
+            f"{self.seconds_since_previous:.1f}s ago:"
+        )
+        for change in self.changes:
+            size_diff = (
+                f"{format_sign(change.size_diff)}{pretty_size(change.size_diff)}"
+            )
+            count_diff = f"{format_sign(change.count_diff)}{change.count_diff}"
+            lines.append(
+                f"{size_diff:>12} {count_diff:>10} blocks  "
+                f"{format_location(change.traceback, self.group_by)}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+class MemoryDiagnostics:
+    """
+    Traces memory allocations with tracemalloc, and reports the lines which hold the
+    most memory alongside what has changed since the previous report. Tracing slows
+    down every allocation and the previous snapshot is kept in memory, so this is
+    only enabled when requested.
+
+    Tracing continues in forked worker processes, and each process reports only its
+    own memory.
+    """
+
+    def __init__(self, traceback_frames: int = DEFAULT_TRACEBACK_FRAMES):
+        self.traceback_frames = traceback_frames
+        self._lock = threading.Lock()
+        self._previous_snapshot: Optional[tracemalloc.Snapshot] = None
+        self._previous_taken_at: Optional[float] = None
+
+    def start(self):
+        # Tracing may already have been started with PYTHONTRACEMALLOC
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.traceback_frames)
+
+    def report(
+        self, group_by: str = "lineno", limit: int = DEFAULT_REPORT_LIMIT
+    ) -> MemoryReport:
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_TRACES)
+        taken_at = time.monotonic()
+        with self._lock:
+            previous_snapshot = self._previous_snapshot
+            previous_taken_at = self._previous_taken_at
+            self._previous_snapshot = snapshot
+            self._previous_taken_at = taken_at
+
+        changes = None
+        seconds_since_previous = None
+        if previous_snapshot is not None:
+            changes = [
+                change
+                for change in snapshot.compare_to(previous_snapshot, group_by)
+                if change.size_diff or change.count_diff
+            ][:limit]
+            seconds_since_previous = taken_at - previous_taken_at
+
+        return MemoryReport(
+            current=current,
+            peak=peak,
+            tracing_overhead=tracemalloc.get_tracemalloc_memory(),
+            rss=get_rss(),
+            peak_rss=get_peak_rss(),
+            group_by=group_by,
+            top_statistics=snapshot.statistics(group_by)[:limit],
+            changes=changes,
+            seconds_since_previous=seconds_since_previous,
+        )
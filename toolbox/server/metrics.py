@@ -0,0 +1,503 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+import json
+import mmap
+import os
+import struct
+import threading
+from .file_server import Bytes
+
+Seconds = float
+LabelValues = Tuple[str, ...]
+# The suffix of a sample's name and its label values, i.e. a histogram bucket
+SampleKey = Tuple[str, LabelValues]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_LATENCY_BUCKETS: Tuple[Seconds, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(label_names: Sequence[str], label_values: Sequence[str]) -> str:
+    if not label_names:
+        return ""
+    labels = ",".join(
+        f'{name}="{escape_label_value(str(value))}"'
+        for name, value in zip(label_names, label_values)
+    )
+    return f"{{{labels}}}"
+
+
+class MetricValues(ABC):
+    """
+    Holds the value of each sample of a registry's metrics
+    """
+
+    @abstractmethod
+    def add(self, name: str, key: SampleKey, amount: float):
+        """
+        Adds the amount to the sample's value, which starts at zero
+        """
+
+    @abstractmethod
+    def set(self, name: str, key: SampleKey, value: float):
+        """
+        Replaces the sample's value
+        """
+
+    @abstractmethod
+    def read(self, name: str, include_exited: bool = True) -> Dict[SampleKey, float]:
+        """
+        Returns the value of each sample of the given metric. When values are shared
+        between processes, those of processes which have exited are only included
+        when include_exited is set.
+        """
+
+
+class MemoryMetricValues(MetricValues):
+    """
+    Holds metric values in memory, where they are only visible to the current
+    process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, Dict[SampleKey, float]] = {}
+
+    def add(self, name: str, key: SampleKey, amount: float):
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name: str, key: SampleKey, value: float):
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def read(self, name: str, include_exited: bool = True) -> Dict[SampleKey, float]:
+        with self._lock:
+            return dict(self._values.get(name, {}))
+
+
+METRICS_FILE_SUFFIX = ".metrics"
+INITIAL_METRICS_FILE_SIZE: Bytes = 64 * 1024
+# A metrics file starts with the number of bytes used by its entries. Each entry is
+# the length of its key, the key and then its value, aligned to 8 bytes.
+USED_SIZE = struct.Struct("<Q")
+KEY_LENGTH = struct.Struct("<I")
+VALUE = struct.Struct("<d")
+
+
+def align_value_offset(offset: int) -> int:
+    return (offset + VALUE.size - 1) // VALUE.size * VALUE.size
+
+
+def encode_sample_key(name: str, key: SampleKey) -> bytes:
+    suffix, label_values = key
+    return json.dumps([name, suffix, label_values]).encode("utf-8")
+
+
+def decode_sample_key(encoded_key: bytes) -> Tuple[str, SampleKey]:
+    name, suffix, label_values = json.loads(encoded_key)
+    return name, (suffix, tuple(label_values))
+
+
+def iter_metrics_file_entries(data) -> Iterator[Tuple[bytes, int]]:
+    """
+    Yields the key and value offset of each entry within a metrics file
+    """
+    if len(data) < USED_SIZE.size:
+        return
+    (used_size,) = USED_SIZE.unpack_from(data, 0)
+    offset = USED_SIZE.size
+    while offset < min(used_size, len(data)):
+        (key_length,) = KEY_LENGTH.unpack_from(data, offset)
+        key_offset = offset + KEY_LENGTH.size
+        value_offset = align_value_offset(key_offset + key_length)
+        yield bytes(data[key_offset : key_offset + key_length]), value_offset
+        offset = value_offset + VALUE.size
+
+
+def is_process_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsFile:
+    """
+    A memory mapped file of one process's metric values. The size of the entries is
+    written after each new entry, so that other processes never read an entry
+    which is only partly written.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = max(os.fstat(self._fd).st_size, INITIAL_METRICS_FILE_SIZE)
+        os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+        self._offsets: Dict[Tuple[str, SampleKey], int] = {}
+        self._used_size = USED_SIZE.size
+        # A file left by an exited process with the same pid is added to
+        for encoded_key, value_offset in iter_metrics_file_entries(self._mmap):
+            self._offsets[decode_sample_key(encoded_key)] = value_offset
+            self._used_size = value_offset + VALUE.size
+        USED_SIZE.pack_into(self._mmap, 0, self._used_size)
+
+    def add(self, name: str, key: SampleKey, amount: float):
+        value_offset = self._offsets.get((name, key))
+        if value_offset is None:
+            self._append(name, key, amount)
+        else:
+            (value,) = VALUE.unpack_from(self._mmap, value_offset)
+            VALUE.pack_into(self._mmap, value_offset, value + amount)
+
+    def set(self, name: str, key: SampleKey, value: float):
+        value_offset = self._offsets.get((name, key))
+        if value_offset is None:
+            self._append(name, key, value)
+        else:
+            VALUE.pack_into(self._mmap, value_offset, value)
+
+    def _append(self, name: str, key: SampleKey, value: float):
+        encoded_key = encode_sample_key(name, key)
+        key_offset = self._used_size + KEY_LENGTH.size
+        value_offset = align_value_offset(key_offset + len(encoded_key))
+        used_size = value_offset + VALUE.size
+        if used_size > len(self._mmap):
+            self._resize(max(used_size, len(self._mmap) * 2))
+
+        KEY_LENGTH.pack_into(self._mmap, self._used_size, len(encoded_key))
+        self._mmap[key_offset : key_offset + len(encoded_key)] = encoded_key
+        VALUE.pack_into(self._mmap, value_offset, value)
+        USED_SIZE.pack_into(self._mmap, 0, used_size)
+        self._offsets[(name, key)] = value_offset
+        self._used_size = used_size
+
+    def _resize(self, size: Bytes):
+        self._mmap.close()
+        os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+
+
+class SharedMetricValues(MetricValues):
+    """
+    Shares metric values between forked worker processes. Each process writes its
+    values to its own memory mapped file within the directory, so that recording a
+    value never waits on another process, and reading sums the files of every
+    process.
+
+    The files of exited processes are kept, so that counters and histograms never
+    decrease when a worker is replaced. Gauges describe the current state of each
+    process, and only include the processes which are still running.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._file: Optional[MetricsFile] = None
+
+    def _get_file(self) -> MetricsFile:
+        # Forked processes inherit the file of their parent, and must write their
+        # own instead
+        pid = os.getpid()
+        if self._pid != pid:
+            self._file = MetricsFile(self.directory / f"{pid}{METRICS_FILE_SUFFIX}")
+            self._pid = pid
+        return self._file
+
+    def add(self, name: str, key: SampleKey, amount: float):
+        with self._lock:
+            self._get_file().add(name, key, amount)
+
+    def set(self, name: str, key: SampleKey, value: float):
+        with self._lock:
+            self._get_file().set(name, key, value)
+
+    def read(self, name: str, include_exited: bool = True) -> Dict[SampleKey, float]:
+        values: Dict[SampleKey, float] = {}
+        for path in self.directory.glob(f"*{METRICS_FILE_SUFFIX}"):
+            if not include_exited and not is_process_running(int(path.stem)):
+                continue
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                continue
+            for encoded_key, value_offset in iter_metrics_file_entries(data):
+                if value_offset + VALUE.size > len(data):
+                    break
+                entry_name, key = decode_sample_key(encoded_key)
+                if entry_name == name:
+                    (value,) = VALUE.unpack_from(data, value_offset)
+                    values[key] = values.get(key, 0) + value
+        return values
+
+
+class Metric(ABC):
+    """
+    A named metric with a value for each combination of label values. Values are
+    held in memory by the current process, unless the metric is registered with a
+    registry which shares them.
+    """
+
+    type = "untyped"
+    # Whether the values recorded by processes which have exited are still reported
+    include_exited = True
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values: MetricValues = MemoryMetricValues()
+
+    def _as_label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(
+                f"{self.name} requires the labels {', '.join(self.label_names)}"
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _read(self) -> Dict[SampleKey, float]:
+        return self.values.read(self.name, include_exited=self.include_exited)
+
+    @abstractmethod
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """
+        Yields the name suffix, formatted labels and value of each sample
+        """
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class ValueMetric(Metric):
+    def get(self, **labels: str) -> float:
+        return self._read().get(("", self._as_label_values(labels)), 0)
+
+    def _add(self, amount: float, labels: Dict[str, str]):
+        self.values.add(self.name, ("", self._as_label_values(labels)), amount)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for (_suffix, label_values), value in sorted(self._read().items()):
+            yield "", format_labels(self.label_names, label_values), value
+
+
+class Counter(ValueMetric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        self._add(amount, labels)
+
+
+class Gauge(ValueMetric):
+    """
+    A value which can go up and down. When values are shared between processes,
+    the gauge reports the sum of the values of the running processes.
+    """
+
+    type = "gauge"
+    include_exited = False
+
+    def inc(self, amount: float = 1, **labels: str):
+        self._add(amount, labels)
+
+    def dec(self, amount: float = 1, **labels: str):
+        self._add(-amount, labels)
+
+    def set(self, value: float, **labels: str):
+        self.values.set(self.name, ("", self._as_label_values(labels)), value)
+
+
+class Histogram(Metric):
+    """
+    Counts observations into fixed buckets, so that recording a value only needs a
+    binary search and a few additions
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # The upper bound of each bucket, the last bucket being +Inf
+        self._bucket_bounds = tuple(
+            format_value(upper_bound) for upper_bound in self.buckets + (float("inf"),)
+        )
+
+    def observe(self, value: float, **labels: str):
+        label_values = self._as_label_values(labels)
+        # Each bucket holds the count of observations within it, and is made
+        # cumulative when rendered
+        upper_bound = self._bucket_bounds[bisect_left(self.buckets, value)]
+        self.values.add(self.name, ("_bucket", label_values + (upper_bound,)), 1)
+        self.values.add(self.name, ("_sum", label_values), value)
+
+    def get_count(self, **labels: str) -> int:
+        label_values = self._as_label_values(labels)
+        values = self._read()
+        return int(
+            sum(
+                values.get(("_bucket", label_values + (upper_bound,)), 0)
+                for upper_bound in self._bucket_bounds
+            )
+        )
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        values = self._read()
+        bucket_label_names = self.label_names + ("le",)
+        observed_label_values = sorted(
+            label_values for suffix, label_values in values if suffix == "_sum"
+        )
+        for label_values in observed_label_values:
+            cumulative_count = 0
+            for upper_bound in self._bucket_bounds:
+                bucket_label_values = label_values + (upper_bound,)
+                cumulative_count += values.get(("_bucket", bucket_label_values), 0)
+                bucket_labels = format_labels(bucket_label_names, bucket_label_values)
+                yield "_bucket", bucket_labels, cumulative_count
+            labels = format_labels(self.label_names, label_values)
+            yield "_sum", labels, values[("_sum", label_values)]
+            yield "_count", labels, cumulative_count
+
+
+class MetricsRegistry:
+    def __init__(self, values: Optional[MetricValues] = None):
+        self.values = MemoryMetricValues() if values is None else values
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"{metric.name} is already registered")
+        metric.values = self.values
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format
+        """
+        return "".join(metric.render() for metric in self.metrics.values())
+
+
+class ToolboxMetrics:
+    """
+    The metrics recorded by the server. Worker processes share their metrics when
+    given SharedMetricValues, and otherwise each records its own.
+    """
+
+    def __init__(self, values: Optional[MetricValues] = None):
+        self.registry = MetricsRegistry(values)
+        self.requests = self.registry.register(
+            Counter(
+                "toolbox_http_requests_total",
+                "The number of requests handled by each route",
+                ["route", "method", "status"],
+            )
+        )
+        self.request_duration = self.registry.register(
+            Histogram(
+                "toolbox_http_request_duration_seconds",
+                "The time taken to send each route's responses",
+                ["route"],
+            )
+        )
+        self.served = self.registry.register(
+            Counter(
+                "toolbox_served_total",
+                "The number of server paths resolved, by the kind of result",
+                ["result"],
+            )
+        )
+        self.file_transfers = self.registry.register(
+            Counter(
+                "toolbox_file_transfers_total",
+                "The number of file downloads started",
+            )
+        )
+        self.active_file_transfers = self.registry.register(
+            Gauge(
+                "toolbox_file_transfers_active",
+                "The number of file downloads currently being sent",
+            )
+        )
+        self.file_bytes_sent = self.registry.register(
+            Counter(
+                "toolbox_file_bytes_sent_total",
+                "The number of bytes of file contents sent",
+            )
+        )
+        self.uploads = self.registry.register(
+            Counter(
+                "toolbox_uploads_total",
+                "The number of completed uploads",
+            )
+        )
+        self.upload_bytes_received = self.registry.register(
+            Counter(
+                "toolbox_upload_bytes_received_total",
+                "The number of bytes of uploaded files received",
+            )
+        )
+
+    def start_file_transfer(self):
+        self.file_transfers.inc()
+        self.active_file_transfers.inc()
+
+    def finish_file_transfer(self):
+        self.active_file_transfers.dec()
+
+    def record_file_bytes_sent(self, size: Bytes):
+        self.file_bytes_sent.inc(size)
+
+    def record_upload_bytes_received(self, size: Bytes):
+        if size > 0:
+            self.upload_bytes_received.inc(size)
+
+    def render(self) -> str:
+        return self.registry.render()
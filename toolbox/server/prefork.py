@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+import logging
+import os
+import signal
+import threading
+import time
+from .request_handler import ToolboxRequestHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 16
+
+# Wait before replacing a worker which exited unexpectedly, so that a worker which
+# crashes on startup does not result in a busy loop of forking
+WORKER_RESTART_DELAY = 1
+
+STOP_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+
+class PooledRequestHandler(ToolboxRequestHandler):
+    # Idle keep-alive connections would otherwise hold on to a pool thread forever
+    timeout = 60
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """
+    A WSGI server which handles each connection on a fixed size pool of threads,
+    rather than starting a new thread per connection. The listening socket is
+    bound on creation, so that it can be shared with forked worker processes.
+    """
+
+    multithread = True
+
+    def __init__(
+        self,
+        host,
+        port,
+        app,
+        threads: int = DEFAULT_THREADS,
+        multiprocess: bool = False,
+        handler=PooledRequestHandler,
+    ):
+        self.multiprocess = multiprocess
+        self.threads = threads
+        self.executor = None
+        super().__init__(host, port, app, handler=handler)
+
+    def serve_forever(self, poll_interval=0.5):
+        # Threads can not survive a fork, so the pool is only created within the
+        # process which serves requests
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.threads, thread_name_prefix="toolbox-worker"
+        )
+        try:
+            super().serve_forever(poll_interval=poll_interval)
+        finally:
+            # Wait for any in-flight requests to complete
+            self.executor.shutdown(wait=True)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve_prefork(server: ThreadPoolWSGIServer, workers: int):
+    """
+    Serves requests from the given server's listening socket with the given number
+    of forked worker processes. Workers which exit unexpectedly are replaced.
+
+    On SIGTERM or SIGINT each worker stops accepting new connections, and finishes
+    its in-flight requests before exiting.
+    """
+    if workers == 1:
+        _run_worker(server)
+        server.server_close()
+        return
+
+    worker_pids = set()
+    is_stopping = False
+
+    def stop(_signum, _frame):
+        nonlocal is_stopping
+        is_stopping = True
+        for worker_pid in worker_pids:
+            try:
+                os.kill(worker_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def start_worker():
+        # Signals are blocked while forking, so that a new worker can never run the
+        # parent's signal handlers before it has installed its own
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        worker_pid = os.fork()
+        if worker_pid == 0:
+            exit_code = 0
+            try:
+                _run_worker(server)
+            except BaseException:
+                logger.exception("Worker %s failed", os.getpid())
+                exit_code = 1
+            finally:
+                # Avoid running any of the parent process's cleanup handlers
+                os._exit(exit_code)
+        worker_pids.add(worker_pid)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        start_worker()
+
+    while worker_pids:
+        try:
+            worker_pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        worker_pids.discard(worker_pid)
+        if not is_stopping:
+            logger.warning(
+                "Worker %s exited unexpectedly with wait status %s, restarting",
+                worker_pid,
+                status,
+            )
+            time.sleep(WORKER_RESTART_DELAY)
+            if not is_stopping:
+                start_worker()
+
+    server.server_close()
+
+
+def _run_worker(server: ThreadPoolWSGIServer):
+    def stop(_signum, _frame):
+        # shutdown blocks until serve_forever returns, which can not happen while
+        # this signal handler is running on the serving thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    if server.multiprocess:
+        # The parent process handles interrupts and stops each worker with SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    else:
+        signal.signal(signal.SIGINT, stop)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+
+    server.serve_forever()
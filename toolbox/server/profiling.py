@@ -0,0 +1,215 @@
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Pattern
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from .request_handler import call_on_close, is_file_wrapper
+
+logger = logging.getLogger(__name__)
+
+Seconds = float
+
+# Set by the app to the name of the route which handled the request
+ROUTE_ENVIRON_KEY = "toolbox.route"
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_SUMMARY_LIMIT = 30
+SUMMARY_SORT_KEYS = ["cumulative", "tottime", "calls"]
+
+
+class RequestProfiler:
+    """
+    Profiles a sample of requests with cProfile. Each profile is written to its own
+    .prof file, which can be opened with pstats or snakeviz, and is added to a running
+    summary of the hottest functions across every profiled request.
+
+    Only one request in each process is profiled at a time, as Python 3.12+ allows
+    only one active profiler. Requests which would be sampled while another request
+    is being profiled are counted as skipped.
+    """
+
+    def __init__(
+        self,
+        output_directory: Path,
+        sample_rate: Optional[float] = None,
+        path_pattern: Optional[Pattern] = None,
+    ):
+        self.output_directory = Path(output_directory)
+        self.path_pattern = path_pattern
+        # Requests matching a pattern are all profiled unless a rate is given
+        if sample_rate is None:
+            sample_rate = 1.0 if path_pattern is not None else DEFAULT_SAMPLE_RATE
+        self.sample_rate = sample_rate
+        self.profiled_count = 0
+        self.skipped_count = 0
+        self._stats: Optional[pstats.Stats] = None
+        self._stats_lock = threading.Lock()
+        self._profiling_lock = threading.Lock()
+        self._sequence = 0
+
+    def should_profile(self, path: str) -> bool:
+        if self.path_pattern is not None and not self.path_pattern.search(path):
+            return False
+        return random.random() < self.sample_rate
+
+    def try_start(self) -> bool:
+        """
+        Returns whether the request can be profiled. finish must then be called once
+        the request has been served.
+        """
+        if self._profiling_lock.acquire(blocking=False):
+            return True
+        with self._stats_lock:
+            self.skipped_count += 1
+        return False
+
+    def finish(self, profile: cProfile.Profile, route: str, duration: Seconds) -> Path:
+        """
+        Writes the profile of a request, and adds it to the running summary
+        """
+        try:
+            profile.create_stats()
+            with self._stats_lock:
+                self._sequence += 1
+                path = self.output_directory / as_profile_file_name(
+                    route, duration, self._sequence
+                )
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self.profiled_count += 1
+        finally:
+            self._profiling_lock.release()
+
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(path)
+        return path
+
+    def summary(
+        self, sort: str = "cumulative", limit: int = DEFAULT_SUMMARY_LIMIT
+    ) -> str:
+        """
+        Formats the hottest functions across all profiled requests of this process
+        """
+        stream = io.StringIO()
+        stream.write(
+            f"{self.profiled_count} request(s) profiled, {self.skipped_count} skipped "
+            f"while another request was being profiled. "
+            f"Profiles are written to {self.output_directory}\n"
+        )
+        with self._stats_lock:
+            if self._stats is not None:
+                self._stats.stream = stream
+                self._stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+
+def as_profile_file_name(route: str, duration: Seconds, sequence: int) -> str:
+    """
+    Names a profile after when the request was served, its route and its duration,
+    so that slow requests are easy to find. The process id keeps the names of
+    profiles from different worker processes apart.
+    """
+    safe_route = re.sub(r"[^A-Za-z0-9_.-]", "_", route)
+    return (
+        f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{safe_route}-"
+        f"{round(duration * 1000)}ms-{os.getpid()}-{sequence}.prof"
+    )
+
+
+class ProfiledResponse:
+    """
+    Wraps a WSGI response to profile producing each chunk of the body. The time spent
+    waiting for the client to receive each chunk is not profiled, and each chunk may
+    be produced by a different thread, as with the asyncio server.
+    """
+
+    def __init__(self, app_iter: Iterable[bytes], request_profile: "RequestProfile"):
+        self.app_iter = app_iter
+        self.request_profile = request_profile
+
+    def __iter__(self) -> Iterator[bytes]:
+        profile = self.request_profile.profile
+        iterator = iter(self.app_iter)
+        while True:
+            profile.enable()
+            try:
+                chunk = next(iterator, None)
+            finally:
+                profile.disable()
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.request_profile.profile.enable()
+                try:
+                    self.app_iter.close()
+                finally:
+                    self.request_profile.profile.disable()
+        finally:
+            self.request_profile.finish()
+
+
+class RequestProfile:
+    def __init__(self, environ, profiler: RequestProfiler):
+        self.environ = environ
+        self.profiler = profiler
+        self.profile = cProfile.Profile()
+        self.started_at = time.perf_counter()
+        self.is_finished = False
+
+    def finish(self):
+        if self.is_finished:
+            return
+        self.is_finished = True
+        try:
+            self.profiler.finish(
+                self.profile,
+                route=self.environ.get(ROUTE_ENVIRON_KEY, "unknown"),
+                duration=time.perf_counter() - self.started_at,
+            )
+        except Exception:
+            logger.exception("Failed to write request profile")
+
+
+class ProfilingMiddleware:
+    """
+    WSGI middleware which profiles a sample of requests, from when the app is called
+    until the response has been fully sent
+    """
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if not self.profiler.should_profile(path) or not self.profiler.try_start():
+            return self.app(environ, start_response)
+
+        request_profile = RequestProfile(environ, self.profiler)
+        request_profile.profile.enable()
+        try:
+            app_iter = self.app(environ, start_response)
+        except BaseException:
+            request_profile.profile.disable()
+            request_profile.finish()
+            raise
+        request_profile.profile.disable()
+
+        # The server's own file wrapper is returned as-is, so that it can still send
+        # the file itself
+        if is_file_wrapper(environ, app_iter):
+            return call_on_close(environ, app_iter, request_profile.finish)
+        return ProfiledResponse(app_iter, request_profile)
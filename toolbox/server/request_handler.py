@@ -0,0 +1,69 @@
+from typing import BinaryIO, Callable, Iterable
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.wsgi import ClosingIterator
+from .file_server import Bytes
+
+# Environ key for a callable which writes a range of an open file directly to the
+# client's socket, without copying the file contents through Python
+SENDFILE_ENVIRON_KEY = "toolbox.sendfile"
+
+
+def is_file_wrapper(environ, app_iter: Iterable[bytes]) -> bool:
+    """
+    Returns whether the response was created by the server's wsgi.file_wrapper.
+    Servers only send such files themselves, i.e. with sendfile, when they are given
+    back their own file wrapper object.
+    """
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    return isinstance(file_wrapper, type) and isinstance(app_iter, file_wrapper)
+
+
+def call_on_close(
+    environ, app_iter: Iterable[bytes], callback: Callable[[], None]
+) -> Iterable[bytes]:
+    """
+    Calls the callback once the server closes the response. File wrappers are
+    returned as-is with the callback added to their close method, so that the server
+    can still send the file itself, and other responses are wrapped.
+    """
+    if not is_file_wrapper(environ, app_iter):
+        return ClosingIterator(app_iter, callback)
+
+    close = getattr(app_iter, "close", None)
+
+    def close_file_wrapper():
+        try:
+            if close is not None:
+                close()
+        finally:
+            callback()
+
+    app_iter.close = close_file_wrapper
+    return app_iter
+
+
+class ToolboxRequestHandler(WSGIRequestHandler):
+    """
+    Request handler which exposes zero-copy file sending to the application
+    via the SENDFILE_ENVIRON_KEY environ entry
+    """
+
+    def make_environ(self):
+        environ = super().make_environ()
+        environ[SENDFILE_ENVIRON_KEY] = self.sendfile
+        return environ
+
+    def sendfile(self, file: BinaryIO, offset: Bytes, count: Bytes) -> Bytes:
+        """
+        Sends count bytes of the file starting at offset to the client. Uses
+        os.sendfile where available, and falls back to regular writes otherwise -
+        such as for TLS connections.
+
+        The response headers must have already been written before calling this.
+        """
+        self.wfile.flush()
+        return self.connection.sendfile(file, offset, count)
+
+    def log_request(self, code="-", size="-"):
+        # Requests are recorded by the application's AccessLogMiddleware instead
+        pass
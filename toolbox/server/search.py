@@ -0,0 +1,316 @@
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from heapq import nsmallest
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import logging
+import os
+import re
+import threading
+from .file_manager import is_upload_file
+from .file_server import LocalPath, ServerPath
+
+logger = logging.getLogger(__name__)
+
+# Roots are indexed as pairs of server paths and local paths. The user directory
+# is served from the empty server path.
+SearchRoots = Tuple[Tuple[ServerPath, LocalPath], ...]
+# Whether a directory entry is a directory, and whether it is indexed itself
+EntryKind = Tuple[bool, bool]
+
+DEFAULT_SEARCH_LIMIT = 100
+
+GLOB_CHARACTERS = re.compile(r"[*?[]")
+GLOB_TOKENS = re.compile(r"\*|\?|\[[^\]]*\]")
+
+
+@dataclass
+class SearchEntry:
+    server_path: ServerPath
+    name: str
+    local_path: str
+    is_dir: bool
+    # Lower case name, so that searches are case insensitive
+    search_name: str
+
+
+@dataclass
+class IndexedDirectory:
+    server_path: ServerPath
+    modified_at: int
+    # The entry id and kind of each child
+    children: Dict[str, Tuple[int, EntryKind]]
+
+
+@dataclass
+class SearchResult:
+    entries: List[SearchEntry]
+    # Whether there were more matches than the requested limit
+    is_truncated: bool
+    # Whether the initial build of the index has completed
+    is_complete: bool
+
+
+def as_trigrams(value: str) -> Set[str]:
+    return {value[index : index + 3] for index in range(len(value) - 2)}
+
+
+def as_query_trigrams(query: str) -> Set[str]:
+    """
+    Returns the trigrams which any name matching the lower case query must contain.
+    For glob patterns, only the literal text between wildcards is used.
+    """
+    if not GLOB_CHARACTERS.search(query):
+        return as_trigrams(query)
+
+    trigrams = set()
+    for literal in GLOB_TOKENS.split(query):
+        trigrams |= as_trigrams(literal)
+    return trigrams
+
+
+def as_child_server_path(server_path: ServerPath, name: str) -> ServerPath:
+    return f"{server_path.rstrip('/')}/{name}"
+
+
+class SearchIndex:
+    """
+    An in-memory index of the names of every file and folder beneath the search
+    roots. Each name is indexed by its trigrams, so that a substring or glob search
+    only needs to check the names which contain all of the query's trigrams.
+
+    The index is built in a background thread, which then periodically checks the
+    modification time of each indexed directory - and only scans the directories
+    which have changed. The thread is started lazily in each process that uses the
+    index, so that the index can be created before the server forks its workers.
+    """
+
+    REFRESH_INTERVAL_SECONDS = 10
+
+    def __init__(
+        self, roots: SearchRoots, refresh_interval: float = REFRESH_INTERVAL_SECONDS
+    ):
+        self.roots = roots
+        self.refresh_interval = refresh_interval
+        # Paths beneath a mount which are themselves mounted are served from the
+        # more specific mount, and are only indexed from it
+        self._mount_server_paths = {
+            server_path for server_path, _local_path in roots if server_path
+        }
+        self._pid: Optional[int] = None
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.is_ready = threading.Event()
+        self._next_entry_id = 0
+        self._entries: Dict[int, SearchEntry] = {}
+        self._trigrams: Dict[str, Set[int]] = {}
+        self._directories: Dict[str, IndexedDirectory] = {}
+
+    def start(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        # A forked process has a copy of the parent's index, which may be partially
+        # built and no longer has its indexing thread
+        if self._pid is not None:
+            self._reset()
+        self._pid = pid
+        threading.Thread(
+            target=self._build_and_refresh, name="toolbox-search-index", daemon=True
+        ).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> SearchResult:
+        """
+        Finds the entries whose name contains the query, or whose name matches the
+        query if it is a glob pattern such as *.exe. Queries containing a '/' are
+        matched against the full server path instead.
+        """
+        query = query.lower()
+        is_glob = GLOB_CHARACTERS.search(query) is not None
+        is_path_query = "/" in query
+
+        with self._lock:
+            if is_path_query:
+                candidates: Iterable[SearchEntry] = self._entries.values()
+            else:
+                candidates = self._find_candidates(as_query_trigrams(query))
+
+            matches = []
+            for entry in candidates:
+                value = (
+                    entry.server_path.lower() if is_path_query else entry.search_name
+                )
+                if fnmatchcase(value, query) if is_glob else query in value:
+                    matches.append(entry)
+
+        return SearchResult(
+            entries=nsmallest(limit, matches, key=lambda entry: entry.server_path),
+            is_truncated=len(matches) > limit,
+            is_complete=self.is_ready.is_set(),
+        )
+
+    def _find_candidates(self, trigrams: Set[str]) -> Iterable[SearchEntry]:
+        if not trigrams:
+            return self._entries.values()
+
+        # Intersect the smallest sets first
+        entry_id_sets = sorted(
+            (self._trigrams.get(trigram, set()) for trigram in trigrams), key=len
+        )
+        entry_ids = entry_id_sets[0].intersection(*entry_id_sets[1:])
+        return [self._entries[entry_id] for entry_id in entry_ids]
+
+    def build(self):
+        for server_path, local_path in self.roots:
+            local_path = str(local_path)
+            is_dir = os.path.isdir(local_path)
+            if server_path:
+                with self._lock:
+                    self._add_entry(server_path, local_path, is_dir)
+            if is_dir:
+                self._index_directories([(local_path, server_path)])
+        self.is_ready.set()
+
+    def refresh(self):
+        """
+        Scans any indexed directories which have been modified since they were
+        last scanned, and indexes their changed entries
+        """
+        with self._lock:
+            directories = [
+                (local_path, directory.modified_at)
+                for local_path, directory in self._directories.items()
+            ]
+
+        for local_path, modified_at in directories:
+            try:
+                current_modified_at = os.stat(local_path).st_mtime_ns
+            except OSError:
+                current_modified_at = None
+            if current_modified_at != modified_at:
+                self._index_directories([(local_path, None)])
+
+    def _build_and_refresh(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception("Failed to build the search index")
+            self.is_ready.set()
+
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the search index")
+
+    def _index_directories(self, pending: List[Tuple[str, Optional[ServerPath]]]):
+        """
+        Scans each pending directory, replacing its previously indexed entries. Any
+        new sub directories are scanned too. The server path is only required for
+        directories which have not been indexed before.
+        """
+        while pending:
+            local_path, server_path = pending.pop()
+            try:
+                modified_at, children = self._scan_directory(local_path)
+            except OSError:
+                with self._lock:
+                    self._remove_directory(local_path)
+                continue
+
+            with self._lock:
+                directory = self._directories.get(local_path)
+                if directory is None:
+                    if server_path is None:
+                        continue
+                    directory = IndexedDirectory(
+                        server_path=server_path, modified_at=modified_at, children={}
+                    )
+                    self._directories[local_path] = directory
+                directory.modified_at = modified_at
+
+                for name in set(directory.children) - set(children):
+                    self._remove_entry(directory.children.pop(name)[0])
+
+                for name, kind in children.items():
+                    child = directory.children.get(name)
+                    if child is not None:
+                        entry_id, indexed_kind = child
+                        if indexed_kind == kind:
+                            continue
+                        # Replaced by a different kind of entry, such as a file
+                        # replaced by a directory of the same name
+                        self._remove_entry(entry_id)
+                        del directory.children[name]
+
+                    child_server_path = as_child_server_path(
+                        directory.server_path, name
+                    )
+                    if child_server_path in self._mount_server_paths:
+                        continue
+                    child_local_path = os.path.join(local_path, name)
+                    is_dir, should_index = kind
+                    entry_id = self._add_entry(
+                        child_server_path, child_local_path, is_dir
+                    )
+                    directory.children[name] = (entry_id, kind)
+                    if should_index:
+                        pending.append((child_local_path, child_server_path))
+
+    def _scan_directory(self, local_path: str) -> Tuple[int, Dict[str, EntryKind]]:
+        """
+        Returns the directory's modification time, and the kind of each of its
+        children. Symlinked directories are not indexed, to avoid indexing loops.
+        """
+        modified_at = os.stat(local_path).st_mtime_ns
+        children = {}
+        with os.scandir(local_path) as entries:
+            for entry in entries:
+                if is_upload_file(entry.name):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    should_index = is_dir and not entry.is_symlink()
+                except OSError:
+                    is_dir, should_index = False, False
+                children[entry.name] = (is_dir, should_index)
+        return modified_at, children
+
+    def _add_entry(self, server_path: ServerPath, local_path: str, is_dir: bool) -> int:
+        entry_id = self._next_entry_id
+        self._next_entry_id += 1
+        name = server_path.rstrip("/").rpartition("/")[2]
+        entry = SearchEntry(
+            server_path=server_path,
+            name=name,
+            local_path=local_path,
+            is_dir=is_dir,
+            search_name=name.lower(),
+        )
+        self._entries[entry_id] = entry
+        for trigram in as_trigrams(entry.search_name):
+            self._trigrams.setdefault(trigram, set()).add(entry_id)
+        return entry_id
+
+    def _remove_entry(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        for trigram in as_trigrams(entry.search_name):
+            entry_ids = self._trigrams[trigram]
+            entry_ids.discard(entry_id)
+            if not entry_ids:
+                del self._trigrams[trigram]
+        if entry.is_dir:
+            self._remove_directory(entry.local_path)
+
+    def _remove_directory(self, local_path: str):
+        directory = self._directories.pop(local_path, None)
+        if directory is None:
+            return
+        for entry_id, _kind in directory.children.values():
+            self._remove_entry(entry_id)
@@ -1,7 +1,15 @@
+from pathlib import Path
+from werkzeug.debug import DebuggedApplication
 from werkzeug.serving import run_simple
 from .interfaces import allowed_interfaces, get_ip_address
 from .make_app import make_app, ToolboxServerException
+from .request_handler import ToolboxRequestHandler
+from .prefork import DEFAULT_THREADS, ThreadPoolWSGIServer, serve_prefork
+from .async_server import DEFAULT_THREADS as DEFAULT_ASYNC_THREADS, serve_async
+from .uploads import MAX_FORM_MEMORY_SIZE
 from .color import Color
+from .upload_tokens import DEFAULT_UPLOAD_TOKEN_TTL
+import tempfile
 
 
 def serve(
@@ -14,7 +22,31 @@ def serve(
     config_path,
     use_debugger=False,
     use_reloader=False,
+    max_upload_size=None,
+    workers=None,
+    threads=None,
+    use_async=False,
+    upload_token_ttl=DEFAULT_UPLOAD_TOKEN_TTL,
+    upload_token_store_path=None,
+    access_log_path=None,
+    profile_directory=None,
+    profile_sample_rate=None,
+    profile_path_pattern=None,
+    memory_diagnostics=False,
 ):
+    # Upload tokens and metrics must be shared between worker processes, the
+    # temporary directory is removed when the server exits
+    temporary_directory = None
+    metrics_directory = None
+    if (workers or 1) > 1:
+        temporary_directory = tempfile.TemporaryDirectory(prefix="toolbox-")
+        metrics_directory = Path(temporary_directory.name) / "metrics"
+        metrics_directory.mkdir()
+        if upload_token_store_path is None:
+            upload_token_store_path = (
+                Path(temporary_directory.name) / "upload_tokens.db"
+            )
+
     try:
         app = make_app(
             host=host,
@@ -26,6 +58,15 @@ def serve(
             config_path=config_path,
             use_debugger=use_debugger,
             use_reloader=use_reloader,
+            max_upload_size=max_upload_size,
+            upload_token_ttl=upload_token_ttl,
+            upload_token_store_path=upload_token_store_path,
+            metrics_directory=metrics_directory,
+            access_log_path=access_log_path,
+            profile_directory=profile_directory,
+            profile_sample_rate=profile_sample_rate,
+            profile_path_pattern=profile_path_pattern,
+            memory_diagnostics=memory_diagnostics,
         )
     except ToolboxServerException as e:
         print(str(e))
@@ -43,4 +84,47 @@ def serve(
             )
 
     print(server_details)
-    run_simple(host, port, app, use_debugger=use_debugger, use_reloader=True)
+
+    if use_async:
+        threads = threads or DEFAULT_ASYNC_THREADS
+        max_request_body_size = None
+        if max_upload_size is not None:
+            max_request_body_size = max_upload_size + MAX_FORM_MEMORY_SIZE
+        if use_debugger:
+            app = DebuggedApplication(app, evalex=True)
+
+        print(f" * Running on http://{host}:{port}")
+        print(f" * Serving asynchronously with {threads} thread(s)")
+        serve_async(
+            app,
+            host,
+            port,
+            threads=threads,
+            max_request_body_size=max_request_body_size,
+        )
+        return
+
+    # The development server is used unless a number of workers or threads is requested
+    if workers is None and threads is None:
+        run_simple(
+            host,
+            port,
+            app,
+            use_debugger=use_debugger,
+            use_reloader=use_reloader,
+            request_handler=ToolboxRequestHandler,
+        )
+        return
+
+    workers = workers or 1
+    threads = threads or DEFAULT_THREADS
+    if use_debugger:
+        app = DebuggedApplication(app, evalex=True)
+    server = ThreadPoolWSGIServer(
+        host, port, app, threads=threads, multiprocess=workers > 1
+    )
+    print(f" * Running on http://{host}:{server.port}")
+    print(f" * Serving with {workers} worker(s) of {threads} thread(s)")
+    serve_prefork(server, workers=workers)
+    if temporary_directory is not None:
+        temporary_directory.cleanup()
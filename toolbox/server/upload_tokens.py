@@ -0,0 +1,279 @@
+from abc import ABC, abstractmethod
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+UploadTokenId = str
+Seconds = float
+
+DEFAULT_UPLOAD_TOKEN_TTL: Seconds = 24 * 60 * 60
+DEFAULT_EVICTION_INTERVAL: Seconds = 60
+
+
+def create_partial_upload_id() -> str:
+    return secrets.token_hex(16)
+
+
+@dataclass
+class UploadToken:
+    id: UploadTokenId
+    file_name: str
+    # Names the token's partially uploaded data, so that the data can not be
+    # located from the token, or the token from the data
+    partial_upload_id: str = field(
+        default_factory=create_partial_upload_id, compare=False
+    )
+
+
+class UploadTokenStore(ABC):
+    """
+    Holds upload tokens until they are used, or until they expire after the given
+    time to live. Expired tokens are evicted by a background thread, which is
+    started lazily in each process that uses the store - so that a store can be
+    created before the server forks its worker processes.
+
+    The on_evict callback is called with each evicted token, i.e. so that any
+    partially uploaded data for the token can be removed.
+    """
+
+    def __init__(
+        self,
+        ttl: Seconds = DEFAULT_UPLOAD_TOKEN_TTL,
+        eviction_interval: Seconds = DEFAULT_EVICTION_INTERVAL,
+        on_evict: Optional[Callable[[UploadToken], None]] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.ttl = ttl
+        self.eviction_interval = eviction_interval
+        self.on_evict = on_evict
+        self.clock = clock
+        self._eviction_lock = threading.Lock()
+        self._eviction_pid: Optional[int] = None
+
+    def add(self, upload_token: UploadToken):
+        self._start_eviction()
+        self._add(upload_token, expires_at=self.clock() + self.ttl)
+
+    def get(self, token_id: Optional[UploadTokenId]) -> Optional[UploadToken]:
+        """
+        Returns the token if it exists and has not expired, without using it
+        """
+        if token_id is None:
+            return None
+        self._start_eviction()
+        return self._get(token_id, now=self.clock())
+
+    def consume(self, token_id: Optional[UploadTokenId]) -> Optional[UploadToken]:
+        """
+        Atomically removes and returns the token if it exists and has not expired.
+        When multiple requests attempt to use the same token, only one receives it.
+        """
+        if token_id is None:
+            return None
+        self._start_eviction()
+        now = self.clock()
+        consumed = self._consume(token_id)
+        if consumed is None:
+            return None
+
+        upload_token, expires_at = consumed
+        if expires_at <= now:
+            # Removed before the eviction thread found it, and cleaned up the same
+            self._evicted([upload_token])
+            return None
+        return upload_token
+
+    def evict_expired(self) -> List[UploadToken]:
+        evicted_tokens = self._evict_expired(now=self.clock())
+        self._evicted(evicted_tokens)
+        return evicted_tokens
+
+    def _evicted(self, evicted_tokens: List[UploadToken]):
+        if self.on_evict is None:
+            return
+        for upload_token in evicted_tokens:
+            try:
+                self.on_evict(upload_token)
+            except Exception:
+                logger.exception("Failed to clean up upload token %s", upload_token.id)
+
+    def _start_eviction(self):
+        pid = os.getpid()
+        if self._eviction_pid == pid:
+            return
+
+        with self._eviction_lock:
+            if self._eviction_pid == pid:
+                return
+            self._eviction_pid = pid
+            threading.Thread(target=self._evict_forever, daemon=True).start()
+
+    def _evict_forever(self):
+        while True:
+            time.sleep(self.eviction_interval)
+            try:
+                self.evict_expired()
+            except Exception:
+                logger.exception("Failed to evict expired upload tokens")
+
+    @abstractmethod
+    def _add(self, upload_token: UploadToken, expires_at: float):
+        """
+        Stores the token until the given expiry time
+        """
+
+    @abstractmethod
+    def _get(self, token_id: UploadTokenId, now: float) -> Optional[UploadToken]:
+        """
+        Returns the token if it exists and expires after now
+        """
+
+    @abstractmethod
+    def _consume(self, token_id: UploadTokenId) -> Optional[Tuple[UploadToken, float]]:
+        """
+        Removes the token if it exists, and returns it along with its expiry time
+        """
+
+    @abstractmethod
+    def _evict_expired(self, now: float) -> List[UploadToken]:
+        """
+        Removes and returns the tokens which have expired by now
+        """
+
+
+class MemoryUploadTokenStore(UploadTokenStore):
+    """
+    Stores upload tokens within the current process only
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._upload_tokens: Dict[UploadTokenId, Tuple[UploadToken, float]] = {}
+
+    def _add(self, upload_token: UploadToken, expires_at: float):
+        with self._lock:
+            self._upload_tokens[upload_token.id] = (upload_token, expires_at)
+
+    def _get(self, token_id: UploadTokenId, now: float) -> Optional[UploadToken]:
+        upload_token, expires_at = self._upload_tokens.get(token_id, (None, 0))
+        if expires_at <= now:
+            return None
+        return upload_token
+
+    def _consume(self, token_id: UploadTokenId) -> Optional[Tuple[UploadToken, float]]:
+        with self._lock:
+            return self._upload_tokens.pop(token_id, None)
+
+    def _evict_expired(self, now: float) -> List[UploadToken]:
+        with self._lock:
+            expired_token_ids = [
+                token_id
+                for token_id, (_upload_token, expires_at) in self._upload_tokens.items()
+                if expires_at <= now
+            ]
+            return [
+                self._upload_tokens.pop(token_id)[0] for token_id in expired_token_ids
+            ]
+
+
+class SqliteUploadTokenStore(UploadTokenStore):
+    """
+    Stores upload tokens in a local SQLite database, so that they can be shared
+    between worker processes. A new connection is used for each operation, as
+    connections can not be shared across forked processes.
+    """
+
+    def __init__(self, database_path: Path, **kwargs):
+        super().__init__(**kwargs)
+        self.database_path = Path(database_path)
+        with closing(self._connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS upload_tokens ("
+                "id TEXT PRIMARY KEY, file_name TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, partial_upload_id TEXT NOT NULL"
+                ")"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # Transactions are managed explicitly
+        return sqlite3.connect(self.database_path, timeout=10, isolation_level=None)
+
+    def _add(self, upload_token: UploadToken, expires_at: float):
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO upload_tokens "
+                "(id, file_name, expires_at, partial_upload_id) VALUES (?, ?, ?, ?)",
+                (
+                    upload_token.id,
+                    upload_token.file_name,
+                    expires_at,
+                    upload_token.partial_upload_id,
+                ),
+            )
+
+    def _get(self, token_id: UploadTokenId, now: float) -> Optional[UploadToken]:
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT id, file_name, partial_upload_id FROM upload_tokens "
+                "WHERE id = ? AND expires_at > ?",
+                (token_id, now),
+            ).fetchone()
+        return None if row is None else self._upload_token(row)
+
+    def _consume(self, token_id: UploadTokenId) -> Optional[Tuple[UploadToken, float]]:
+        with closing(self._connect()) as connection:
+            # Take the write lock up front, so that only one process can read and
+            # remove the token
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT id, file_name, partial_upload_id, expires_at "
+                    "FROM upload_tokens WHERE id = ?",
+                    (token_id,),
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "DELETE FROM upload_tokens WHERE id = ?", (token_id,)
+                    )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+        return self._upload_token(row), row[3]
+
+    def _evict_expired(self, now: float) -> List[UploadToken]:
+        with closing(self._connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = connection.execute(
+                    "SELECT id, file_name, partial_upload_id FROM upload_tokens "
+                    "WHERE expires_at <= ?",
+                    (now,),
+                ).fetchall()
+                connection.execute(
+                    "DELETE FROM upload_tokens WHERE expires_at <= ?", (now,)
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+        return [self._upload_token(row) for row in rows]
+
+    @staticmethod
+    def _upload_token(row: tuple) -> UploadToken:
+        return UploadToken(id=row[0], file_name=row[1], partial_upload_id=row[2])
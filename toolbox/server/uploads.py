@@ -0,0 +1,195 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional
+from werkzeug.exceptions import RequestEntityTooLarge
+import os
+from .file_manager import FileManager
+from .file_server import CHUNK_SIZE, Bytes
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where partial uploads are not locked
+    fcntl = None
+
+# Uploads are streamed to disk, only the small non-file form fields are held in memory
+MAX_FORM_MEMORY_SIZE: Bytes = 64 * 1024
+
+# An upload only consists of the file and its token
+MAX_FORM_PARTS = 8
+
+
+class UploadFile:
+    """
+    A file which an upload is streamed into. The maximum upload size is
+    enforced as the file is written to, so that oversized uploads are
+    rejected without being fully received.
+    """
+
+    def __init__(self, file: BinaryIO, max_upload_size: Optional[Bytes]):
+        self.file = file
+        self.max_upload_size = max_upload_size
+        self.size: Bytes = 0
+
+    @property
+    def path(self) -> Path:
+        return Path(self.file.name)
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.max_upload_size is not None and self.size > self.max_upload_size:
+            raise RequestEntityTooLarge(
+                f"Upload exceeds the maximum size of {self.max_upload_size} bytes"
+            )
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class UploadStreamFactory:
+    """
+    A werkzeug stream factory which streams uploaded files into temporary files
+    within the user directory, so that they can be atomically renamed into place
+    once the upload is complete. Any temporary files which were not renamed are
+    removed when the factory is closed.
+    """
+
+    def __init__(self, file_manager: FileManager, max_upload_size: Optional[Bytes]):
+        self.file_manager = file_manager
+        self.max_upload_size = max_upload_size
+        self.upload_files: List[UploadFile] = []
+
+    def __call__(
+        self,
+        total_content_length: Optional[int],
+        content_type: Optional[str],
+        filename: Optional[str],
+        content_length: Optional[int] = None,
+    ) -> UploadFile:
+        if self.max_upload_size is not None and (total_content_length or 0) > (
+            self.max_upload_size + MAX_FORM_MEMORY_SIZE
+        ):
+            raise RequestEntityTooLarge(
+                f"Upload exceeds the maximum size of {self.max_upload_size} bytes"
+            )
+
+        upload_file = UploadFile(
+            self.file_manager.create_user_temporary_file(),
+            max_upload_size=self.max_upload_size,
+        )
+        self.upload_files.append(upload_file)
+        return upload_file
+
+    def close(self):
+        for upload_file in self.upload_files:
+            upload_file.close()
+            upload_file.path.unlink(missing_ok=True)
+
+
+def lock_file(file: BinaryIO) -> bool:
+    """
+    Takes an exclusive lock on the open file without waiting, which is released
+    when the file is closed. Returns False if another process holds the lock.
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, offset: Bytes):
+        super().__init__(f"Expected upload offset {offset}")
+        self.offset = offset
+
+
+class UploadInProgress(Exception):
+    pass
+
+
+class PartialUpload:
+    """
+    A resumable upload which is sent as a series of chunks. The received data is
+    kept on disk until the upload is committed, so that failed chunks can be retried
+    from the last received offset. The data is kept outside of the user directory,
+    and is named by the token's partial upload id rather than the token itself, so
+    that it is never served and can not be used to find the token.
+
+    Each chunk and the commit hold an exclusive lock on the file while they run, so
+    that only one request in any worker process writes to an upload at a time.
+    """
+
+    def __init__(self, file_manager: FileManager, directory: Path, upload_id: str):
+        self.file_manager = file_manager
+        self.path = Path(directory) / f"{upload_id}.part"
+
+    @property
+    def offset(self) -> Bytes:
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def append(
+        self,
+        stream: BinaryIO,
+        offset: Bytes,
+        max_upload_size: Optional[Bytes],
+        chunk_size: Bytes = CHUNK_SIZE,
+    ) -> Bytes:
+        """
+        Appends the stream's contents at the given offset, which must match the
+        amount of data received so far. Returns the new offset.
+        """
+        with self._open_locked("ab") as file:
+            current_offset = file.tell()
+            if offset != current_offset:
+                raise UploadOffsetMismatch(current_offset)
+
+            upload_file = UploadFile(file, max_upload_size=max_upload_size)
+            upload_file.size = current_offset
+            try:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    upload_file.write(chunk)
+            except RequestEntityTooLarge:
+                file.truncate(current_offset)
+                raise
+
+            return file.tell()
+
+    def commit(self, destination_path: Path):
+        """
+        Moves the received data into place. Raises FileNotFoundError if no data has
+        been received.
+        """
+        with self._open_locked("rb"):
+            self.file_manager.move_into_user_directory(self.path, destination_path)
+
+    def discard(self):
+        self.path.unlink(missing_ok=True)
+
+    @contextmanager
+    def _open_locked(self, mode: str) -> Iterator[BinaryIO]:
+        file = open(self.path, mode)
+        try:
+            if not lock_file(file):
+                raise UploadInProgress
+            # The upload may have been committed or discarded while the lock was
+            # being taken, in which case the opened file is no longer the upload
+            try:
+                is_current = os.stat(self.path).st_ino == os.fstat(file.fileno()).st_ino
+            except FileNotFoundError:
+                is_current = False
+            if not is_current:
+                raise UploadInProgress
+            yield file
+        finally:
+            # Also releases the lock
+            file.close()